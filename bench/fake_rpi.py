@@ -0,0 +1,155 @@
+import argparse
+import json
+import random
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+INITIAL_PROPERTIES = {
+    'temperatureHe1': 40.5, 'temperatureHe2': 41., 'temperatureHe3': 39.5, 'temperatureFeed': 55.,
+    'hysteresis': 2, 'temperatureOutside': -3.5, 'temperatureInside': 21.,
+    'valveOpened1': False, 'valveOpened2': True, 'valveOpened3': False, 'valveOpened4': False,
+    'valveActivated1': True, 'valveActivated2': True, 'valveActivated3': True, 'valveActivated4': True,
+    'mode': 'manual',
+}
+
+
+class FakeRpi:
+    """
+    Stand-in for the RPi HVAC controller HTTP API with latency and failure injection.
+    Serves "/<name>/properties/<property>", "/<name>/actions/<action>" and "/<name>/all/properties" for any name,
+    "/_stats" returns the number of calls per method and path and "/_reset" clears them
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0, jitter: float = 0,
+                 failure_rate: float = 0, timeout_rate: float = 0, empty_rate: float = 0):
+        """
+        :param host: listen host
+        :param port: listen port, a free one if 0
+        :param latency: added response latency in seconds
+        :param jitter: maximum random latency added on top in seconds
+        :param failure_rate: share of requests answered with 500
+        :param timeout_rate: share of requests which never get an answer within 60 seconds
+        :param empty_rate: share of "/all/properties" requests answered with an empty object
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.timeout_rate = timeout_rate
+        self.empty_rate = empty_rate
+        self.properties = dict(INITIAL_PROPERTIES)
+        self.calls = Counter()
+        self._lock = Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+
+    @property
+    def address(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'{host}:{port}'
+
+    def start(self) -> 'FakeRpi':
+        Thread(daemon=True, target=self._server.serve_forever, name='fake-rpi').start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.calls)
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+    def _handler(self):
+        rpi = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status: int, body=None):
+                data = json.dumps(body).encode('utf-8') if body is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _handle(self, method: str):
+                parts = self.path.strip('/').split('/')
+                if parts[0] == '_stats':
+                    return self._reply(200, rpi.stats())
+                if parts[0] == '_reset':
+                    rpi.reset()
+                    return self._reply(200, True)
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+                path = '/' + '/'.join(parts[1:])
+                with rpi._lock:
+                    rpi.calls[f'{method} {path}'] += 1
+                if random.random() < rpi.timeout_rate:
+                    time.sleep(60)
+                time.sleep(rpi.latency + random.uniform(0, rpi.jitter))
+                if random.random() < rpi.failure_rate:
+                    return self._reply(500)
+                if method == 'GET' and path == '/all/properties':
+                    return self._reply(200, {} if random.random() < rpi.empty_rate else rpi.properties)
+                if len(parts) == 3 and parts[1] == 'properties' and parts[2] in rpi.properties:
+                    name = parts[2]
+                    if method == 'GET':
+                        return self._reply(200, rpi.properties[name])
+                    if method == 'PUT':
+                        current = rpi.properties[name]
+                        if isinstance(current, bool):
+                            rpi.properties[name] = body == 'true'
+                        elif isinstance(current, str):
+                            rpi.properties[name] = body
+                        else:
+                            rpi.properties[name] = float(body)
+                        return self._reply(200)
+                if method == 'POST' and len(parts) == 3 and parts[1] == 'actions':
+                    for action, opened in (('openValve', True), ('closeValve', False)):
+                        if parts[2].startswith(action) and f'valveOpened{parts[2][len(action):]}' in rpi.properties:
+                            rpi.properties[f'valveOpened{parts[2][len(action):]}'] = opened
+                            return self._reply(200)
+                self._reply(404)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_PUT(self):
+                self._handle('PUT')
+
+            def do_POST(self):
+                self._handle('POST')
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake RPi HVAC controller')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0, help='Response latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0, help='Maximum random extra latency in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0, help='Share of requests answered with 500')
+    parser.add_argument('--timeout-rate', type=float, default=0, help='Share of requests never answered')
+    parser.add_argument('--empty-rate', type=float, default=0, help='Share of empty "/all/properties" replies')
+    args = parser.parse_args()
+    rpi = FakeRpi(args.host, args.port, args.latency, args.jitter, args.failure_rate, args.timeout_rate,
+                  args.empty_rate)
+    print(f'Fake RPi listening on {rpi.address}')
+    rpi.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
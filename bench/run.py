@@ -0,0 +1,203 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'flask_server'))
+
+USER = ('bench', 'bench')
+SUPERUSER = ('bench-su', 'bench-su')
+os.environ.setdefault('USERNAME', USER[0])
+os.environ.setdefault('PASSWORD', USER[1])
+os.environ.setdefault('SU_USERNAME', SUPERUSER[0])
+os.environ.setdefault('SU_PASSWORD', SUPERUSER[1])
+
+from werkzeug.serving import make_server  # noqa: E402
+
+from fake_rpi import FakeRpi  # noqa: E402
+from rpi_interface import HvacRpi, hvac_url  # noqa: E402
+from server import Server  # noqa: E402
+from transport import RpiTransport  # noqa: E402
+
+# Scenario name to the (method, path, JSON body, superuser) requests clients cycle through
+SCENARIOS = {
+    'full_state': [('get', '/fullState', None, False)],
+    'property_get': [
+        ('get', '/temperatureHe/1', None, False),
+        ('get', '/temperatureOutside', None, False),
+        ('get', '/temperatureInside', None, False),
+        ('get', '/temperatureFeed', None, False),
+        ('get', '/hysteresis', None, False),
+        ('get', '/mode', None, False),
+        ('get', '/valve/2', None, False),
+        ('get', '/valveActivated/3', None, False),
+    ],
+    'write': [
+        ('post', '/temperatureFeed', {'value': 50}, False),
+        ('post', '/valve/1', {'action': 'open'}, True),
+        ('post', '/temperatureFeed', {'value': 55}, False),
+        ('post', '/valve/1', {'action': 'close'}, True),
+        ('post', '/mode', {'type': 'autoWinter'}, True),
+        ('post', '/mode', {'type': 'manual'}, True),
+    ],
+}
+
+# Result metric to whether a higher value is better
+METRICS = {'p50_ms': False, 'p99_ms': False, 'rps': True, 'upstream_per_request': False}
+
+
+def percentile(values: list, share: float) -> float:
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+def run_scenario(base_url: str, rpi: FakeRpi, requests_cycle: list, concurrency: int, duration: float,
+                 warmup: float) -> dict:
+    """
+    Drives the server with concurrent clients
+    :param base_url: server URL
+    :param rpi: fake RPi the server talks to
+    :param requests_cycle: (method, path, JSON body, superuser) requests every client cycles through
+    :param concurrency: number of concurrent clients
+    :param duration: measured time in seconds
+    :param warmup: unmeasured time before the measurement in seconds
+    :return: scenario results
+    """
+    stop = Event()
+    measuring = Event()
+
+    def client(offset: int):
+        session = requests.Session()
+        latencies, errors = [], 0
+        for method, path, body, superuser in itertools.islice(itertools.cycle(requests_cycle), offset, None):
+            if stop.is_set():
+                break
+            started = time.perf_counter()
+            try:
+                response = session.request(method, base_url + path, json=body,
+                                           auth=SUPERUSER if superuser else USER, timeout=30)
+                failed = response.status_code != 200
+            except requests.RequestException:
+                failed = True
+            if measuring.is_set():
+                latencies.append(time.perf_counter() - started)
+                errors += failed
+        session.close()
+        return latencies, errors
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(client, i) for i in range(concurrency)]
+        time.sleep(warmup)
+        rpi.reset()
+        measuring.set()
+        started = time.perf_counter()
+        time.sleep(duration)
+        measuring.clear()
+        elapsed = time.perf_counter() - started
+        upstream = sum(rpi.stats().values())
+        stop.set()
+        results = [future.result() for future in futures]
+    latencies = [latency for client_latencies, _ in results for latency in client_latencies]
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': sum(errors for _, errors in results),
+        'p50_ms': round(percentile(latencies, .5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, .99) * 1000, 3),
+        'rps': round(count / elapsed, 1),
+        'upstream_calls': upstream,
+        'upstream_per_request': round(upstream / count, 4) if count else 0.,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Prints the results next to the baseline
+    :param results: scenario name to results
+    :param baseline: scenario name to baseline results
+    :param tolerance: allowed relative regression
+    :return: regression descriptions
+    """
+    regressions = []
+    print(f'{"scenario":<14}{"metric":<22}{"baseline":>12}{"current":>12}{"change":>10}')
+    for scenario, values in results.items():
+        for metric, higher_is_better in METRICS.items():
+            current, previous = values[metric], baseline.get(scenario, {}).get(metric)
+            if previous is None:
+                print(f'{scenario:<14}{metric:<22}{"-":>12}{current:>12}')
+                continue
+            change = (current - previous) / previous if previous else 0.
+            regressed = (-change if higher_is_better else change) > tolerance and abs(current - previous) > 1e-3
+            print(f'{scenario:<14}{metric:<22}{previous:>12}{current:>12}{change:>+10.1%}{"  REGRESSION" if regressed else ""}')
+            if regressed:
+                regressions.append(f'{scenario} {metric}: {previous} -> {current}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the server against a fake RPi')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma separated scenario names')
+    parser.add_argument('--concurrency', type=int, default=16, help='Number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=5, help='Measured seconds per scenario')
+    parser.add_argument('--warmup', type=float, default=1, help='Unmeasured seconds before each scenario')
+    parser.add_argument('--rpi-latency', type=float, default=0.005, help='Fake RPi latency in seconds')
+    parser.add_argument('--rpi-jitter', type=float, default=0.005, help='Fake RPi latency jitter in seconds')
+    parser.add_argument('--rpi-failure-rate', type=float, default=0, help='Share of fake RPi 500 replies')
+    parser.add_argument('--baseline', default=os.path.join(BENCH_DIR, 'baseline.json'), help='Baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=.25, help='Allowed relative regression')
+    parser.add_argument('--output', help='File the JSON results are written to')
+    args = parser.parse_args()
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    rpi = FakeRpi(latency=args.rpi_latency, jitter=args.rpi_jitter, failure_rate=args.rpi_failure_rate).start()
+    unit = HvacRpi(transport=RpiTransport(hvac_url(rpi.address, 'hvac')), name='bench')
+    server = Server('127.0.0.1', 0, False, units={'bench': unit})
+    http_server = make_server('127.0.0.1', 0, server.app, threaded=True)
+    Thread(daemon=True, target=http_server.serve_forever, name='bench-server').start()
+    server.units.start()
+    base_url = f'http://127.0.0.1:{http_server.server_port}'
+
+    results = {}
+    for name in args.scenarios.split(','):
+        results[name] = run_scenario(base_url, rpi, SCENARIOS[name], args.concurrency, args.duration, args.warmup)
+        print(f'{name}: {json.dumps(results[name])}')
+    http_server.shutdown()
+    rpi.stop()
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'concurrency': args.concurrency,
+        'rpi_latency': args.rpi_latency,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f'Baseline stored in {args.baseline}')
+        return
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)['results'], args.tolerance)
+        if regressions:
+            print('Regressions:\n' + '\n'.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
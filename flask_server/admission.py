@@ -0,0 +1,135 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Hashable, Optional
+
+from flask import current_app, request
+
+from metrics import Counter
+
+REJECTED = Counter('hvac_rate_limited_total', 'Requests rejected by the client rate limits', ('kind',))
+
+
+class TokenBucket:
+    """
+    Allows a burst of requests and then a steady rate
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """
+        Takes a token if there is one
+        :param now: monotonic time
+        :return: 0 if a token was taken, otherwise the time until the next one in seconds
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Token buckets by key, the least recently used buckets are dropped beyond max_keys
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 10000):
+        """
+        :param rate: allowed requests per second
+        :param burst: allowed burst of requests
+        :param max_keys: maximum number of tracked keys
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def take(self, key: Hashable) -> float:
+        """
+        Takes a token of a key
+        :param key: limited key, e.g. a client and route
+        :return: 0 if allowed, otherwise the time until the key is allowed again in seconds
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket.take(now)
+
+
+class RequestLimits:
+    """
+    Per client and route rate limits of the API, reads and writes are limited separately
+    """
+
+    def __init__(self, read_rate: float = 20, read_burst: float = 40, write_rate: float = 1,
+                 write_burst: float = 5, max_clients: int = 10000, client_header: str = 'X-Forwarded-For',
+                 proxy_hops: int = 0):
+        """
+        :param read_rate: allowed reading requests per second of a client on a route
+        :param read_burst: allowed burst of reading requests of a client on a route
+        :param write_rate: allowed other requests per second of a client on a route
+        :param write_burst: allowed burst of other requests of a client on a route
+        :param max_clients: maximum number of tracked client routes
+        :param client_header: header the reverse proxies append the address of their peer to
+        :param proxy_hops: number of trusted reverse proxies in front of the server, the header is not trusted if 0.
+        Only the entries appended by the trusted proxies are used, the ones before can be set by the client
+        """
+        self.reads = RateLimiter(read_rate, read_burst, max_clients)
+        self.writes = RateLimiter(write_rate, write_burst, max_clients)
+        self.client_header = client_header
+        self.proxy_hops = proxy_hops
+
+    def client(self) -> Optional[str]:
+        """
+        Gets the address of the client of the current request
+        :return: client address
+        """
+        if self.proxy_hops:
+            forwarded = request.headers.get(self.client_header, '').split(',')
+            if len(forwarded) >= self.proxy_hops:
+                client = forwarded[-self.proxy_hops].strip()
+                if client:
+                    return client
+        return request.remote_addr
+
+    @staticmethod
+    def is_read() -> bool:
+        """
+        Tells whether the current request only reads. GET requests do, other requests do if their resource
+        has a reads_only() telling so, e.g. a batch of reads
+        :return: whether the request is limited as a read
+        """
+        if request.method in ('GET', 'HEAD'):
+            return True
+        view = current_app.view_functions.get(request.endpoint)
+        reads_only = getattr(getattr(view, 'view_class', None), 'reads_only', None)
+        return reads_only is not None and reads_only()
+
+    def admit(self):
+        """
+        Flask before_request hook rejecting the requests over their limit with 429
+        """
+        if request.method == 'OPTIONS':
+            return None
+        read = self.is_read()
+        unit = request.view_args.get('unit') if request.view_args else None
+        retry_after = (self.reads if read else self.writes).take((self.client(), request.endpoint, unit))
+        if not retry_after:
+            return None
+        REJECTED.labels('read' if read else 'write').inc()
+        return 'Too many requests', 429, {'Retry-After': str(max(int(retry_after + .5), 1))}
@@ -0,0 +1,95 @@
+import numpy as np
+
+from archive import RECORD, CODE_MODES, StateArchive
+
+RECORD_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('he_temperatures', '<f4', (3,)),
+    ('feed_temperature', '<f4'),
+    ('inside_temperature', '<f4'),
+    ('outside_temperature', '<f4'),
+    ('hysteresis', '<f4'),
+    ('valves_opened', 'u1'),
+    ('valves_activated', 'u1'),
+    ('mode', 'u1'),
+    ('padding', 'u1'),
+])
+assert RECORD_DTYPE.itemsize == RECORD.size
+
+VALVES = 4
+
+
+def load_records(archive: StateArchive, start: float, end: float) -> np.ndarray:
+    """
+    Gets archived records as a structured array, a single segment is not copied
+    :param archive: state archive
+    :param start: range start UNIX timestamp
+    :param end: range end UNIX timestamp
+    :return: RECORD_DTYPE array
+    """
+    chunks = [np.frombuffer(records, RECORD_DTYPE) for records in archive.read(start, end)]
+    if not chunks:
+        return np.empty(0, RECORD_DTYPE)
+    return chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+
+
+def sample_durations(times: np.ndarray, end: float, max_gap: float) -> np.ndarray:
+    """
+    Gets how long each sample was valid, gaps longer than max_gap count as max_gap
+    :param times: sample UNIX timestamps
+    :param end: range end UNIX timestamp
+    :param max_gap: maximum sample validity in seconds
+    :return: durations in seconds
+    """
+    return np.minimum(np.diff(times, append=max(end, times[-1])), max_gap)
+
+
+def compute_stats(records: np.ndarray, end: float, base_temperature: float = 15.5, setpoint: float = None,
+                  max_gap: float = 600) -> dict:
+    """
+    Computes heating statistics over archived records
+    :param records: RECORD_DTYPE array ordered by time
+    :param end: range end UNIX timestamp
+    :param base_temperature: heating degree-days base temperature in Celsius
+    :param setpoint: feed temperature setpoint, the median feed temperature if not given
+    :param max_gap: maximum sample validity in seconds
+    :return: statistics dict
+    """
+    if not len(records):
+        return {'samples': 0}
+    durations = sample_durations(records['time'], end, max_gap)
+    total = float(durations.sum()) or 1.
+
+    outside = records['outside_temperature'].astype(np.float64)
+    degree_days = float(np.dot(np.maximum(base_temperature - outside, 0), durations) / 86400)
+
+    bits = (records['valves_opened'][:, None] >> np.arange(VALVES, dtype=np.uint8)) & 1
+    valves = [{'duty_cycle': float(np.dot(bits[:, i], durations) / total),
+               'switches': int(np.count_nonzero(np.diff(bits[:, i])))} for i in range(VALVES)]
+
+    mode_time = np.bincount(records['mode'], weights=durations, minlength=len(CODE_MODES))
+    modes = {CODE_MODES[code].value: float(mode_time[code]) for code in CODE_MODES}
+
+    feed = records['feed_temperature'].astype(np.float64)
+    setpoint = float(np.median(feed)) if setpoint is None else setpoint
+    deviation = feed - setpoint
+    outside_band = np.abs(deviation) > records['hysteresis']
+    feed_deviation = {
+        'setpoint': setpoint,
+        'mean': float(np.dot(deviation, durations) / total),
+        'mean_abs': float(np.dot(np.abs(deviation), durations) / total),
+        'rms': float(np.sqrt(np.dot(deviation ** 2, durations) / total)),
+        'max_abs': float(np.abs(deviation).max()),
+        'outside_hysteresis': float(np.dot(outside_band, durations) / total),
+    }
+    return {
+        'samples': int(len(records)),
+        'start': float(records['time'][0]),
+        'end': float(end),
+        'covered_seconds': float(durations.sum()),
+        'heating_degree_days': degree_days,
+        'base_temperature': base_temperature,
+        'valves': valves,
+        'mode_seconds': modes,
+        'feed_deviation': feed_deviation,
+    }
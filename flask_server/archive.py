@@ -0,0 +1,160 @@
+import bisect
+import mmap
+import os
+import struct
+import time
+from threading import Lock
+from typing import Iterator, List, Tuple
+
+from rpi_interface import Mode, RpiState
+
+# Timestamp, 3 HE temperatures, feed, inside, outside, hysteresis, valves opened bitmask,
+# valves activated bitmask, mode code and a padding byte, 40 bytes per sample
+RECORD = struct.Struct('<d7f3Bx')
+MODE_CODES = {Mode.MANUAL: 0, Mode.AUTO_WINTER: 1, Mode.AUTO_SUMMER: 2}
+CODE_MODES = {code: mode for mode, code in MODE_CODES.items()}
+
+
+def pack_state(state: RpiState, timestamp: float) -> bytes:
+    """
+    Packs a state into a fixed-width archive record
+    :param state: RPi state
+    :param timestamp: UNIX timestamp
+    :return: RECORD.size bytes
+    """
+    opened = sum(1 << i for i, value in enumerate(state.valves_states) if value)
+    activated = sum(1 << i for i, value in enumerate(state.valves_activated_states) if value)
+    return RECORD.pack(timestamp, *state.he_temperatures, state.feed_temperature, state.inside_temperature,
+                       state.outside_temperature, state.hysteresis, opened, activated, MODE_CODES[state.mode])
+
+
+class _Segment:
+    """
+    Append-only record file covering a fixed time span, read through a memory map
+    """
+
+    def __init__(self, path: str, start: int, index_stride: int):
+        self.path = path
+        self.start = start
+        self.index_stride = index_stride
+        self.count = os.path.getsize(path) // RECORD.size if os.path.exists(path) else 0
+        self.index = []
+        self._map = None
+        self._mapped_count = 0
+        self._file = None
+        view = self.view()
+        for i in range(0, self.count, index_stride):
+            self.index.append(RECORD.unpack_from(view, i * RECORD.size)[0])
+        self.last_time = RECORD.unpack_from(view, (self.count - 1) * RECORD.size)[0] if self.count else float('-inf')
+
+    def append(self, record: bytes, timestamp: float):
+        if self._file is None:
+            self._file = open(self.path, 'ab', buffering=0)
+            self._file.truncate(self.count * RECORD.size)
+        self._file.write(record)
+        if self.count % self.index_stride == 0:
+            self.index.append(timestamp)
+        self.count += 1
+        self.last_time = timestamp
+
+    def view(self) -> memoryview:
+        if self._mapped_count != self.count:
+            with open(self.path, 'rb') as file:
+                self._map = mmap.mmap(file.fileno(), self.count * RECORD.size, access=mmap.ACCESS_READ)
+            self._mapped_count = self.count
+        return memoryview(self._map) if self._map is not None else memoryview(b'')
+
+    def _search(self, view: memoryview, timestamp: float, right: bool) -> int:
+        block = bisect.bisect_right(self.index, timestamp) if right else bisect.bisect_left(self.index, timestamp)
+        low = max(block - 1, 0) * self.index_stride
+        high = min(block * self.index_stride + 1, self.count)
+        while low < high:
+            middle = (low + high) // 2
+            value = RECORD.unpack_from(view, middle * RECORD.size)[0]
+            if value < timestamp or (right and value == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def slice(self, start: float, end: float) -> memoryview:
+        view = self.view()
+        first = self._search(view, start, False)
+        last = self._search(view, end, True)
+        return view[first * RECORD.size:last * RECORD.size]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class StateArchive:
+    """
+    Long-term archive of fixed-width state records in time segmented, memory-mapped files.
+    Range reads bisect a sparse in-memory time index and return slices of the mapped files
+    """
+
+    def __init__(self, path: str, segment_span: int = 7 * 86400, index_stride: int = 256):
+        """
+        :param path: archive directory
+        :param segment_span: time span of a segment file in seconds
+        :param index_stride: number of records per sparse index entry
+        """
+        self.path = path
+        self.segment_span = segment_span
+        self.index_stride = index_stride
+        self._lock = Lock()
+        os.makedirs(path, exist_ok=True)
+        self._segments = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith('.rec'):
+                self._segments.append(_Segment(os.path.join(path, name), int(name[:-4]), index_stride))
+        self._starts = [segment.start for segment in self._segments]
+
+    def append(self, state: RpiState, timestamp: float = None):
+        """
+        Appends a state sample, samples older than the last one are dropped
+        :param state: RPi state
+        :param timestamp: UNIX timestamp, current time if not given
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        record = pack_state(state, timestamp)
+        start = int(timestamp // self.segment_span * self.segment_span)
+        with self._lock:
+            if self._segments and timestamp <= self._segments[-1].last_time:
+                return
+            if not self._segments or self._segments[-1].start != start:
+                if self._segments:
+                    self._segments[-1].close()
+                self._segments.append(_Segment(os.path.join(self.path, f'{start:010d}.rec'), start, self.index_stride))
+                self._starts.append(start)
+            self._segments[-1].append(record, timestamp)
+
+    def read(self, start: float, end: float) -> List[memoryview]:
+        """
+        Gets the records within a time range without copying them
+        :param start: range start UNIX timestamp
+        :param end: range end UNIX timestamp
+        :return: memory-mapped record slices, one per segment
+        """
+        with self._lock:
+            first = max(bisect.bisect_right(self._starts, start) - 1, 0)
+            last = bisect.bisect_right(self._starts, end)
+            slices = [segment.slice(start, end) for segment in self._segments[first:last]]
+        return [records for records in slices if len(records)]
+
+    def records(self, start: float, end: float) -> Iterator[Tuple]:
+        """
+        Iterates over decoded records within a time range
+        :param start: range start UNIX timestamp
+        :param end: range end UNIX timestamp
+        :return: RECORD tuples
+        """
+        for records in self.read(start, end):
+            yield from RECORD.iter_unpack(records)
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
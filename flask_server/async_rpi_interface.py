@@ -0,0 +1,460 @@
+import asyncio
+import time
+from typing import Iterable
+
+import aiohttp
+
+from polling import PollScheduler
+from transport import CircuitBreaker, CircuitOpenError, UPSTREAM_ERRORS, UPSTREAM_LATENCY
+from rpi_interface import UnitState, Mode, RpiState, REFRESHES, FIELD_PROPERTIES, PROPERTY_NAMES, HVAC_URL, \
+    state_from_properties
+
+
+class AsyncRpiTransport:
+    """
+    Keep-alive asyncio HTTP transport to a single RPi HVAC controller.
+    The client session is created lazily so it is bound to the loop it is used in
+    """
+
+    def __init__(self, url: str, connect_timeout: float = 3.05, read_timeout: float = 10, pool_size: int = 8,
+                 breaker: CircuitBreaker = None):
+        """
+        :param url: controller base URL, e.g. "http://host:port/hvac"
+        :param connect_timeout: TCP connect timeout in seconds
+        :param read_timeout: response read timeout in seconds
+        :param pool_size: maximum number of simultaneous connections
+        :param breaker: circuit breaker, a default one if not given
+        """
+        self.url = url.rstrip('/')
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self._timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self._pool_size = pool_size
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._pool_size)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+        return self._session
+
+    async def request(self, method: str, path: str, **kwargs) -> aiohttp.ClientResponse:
+        """
+        Make a request relative to the controller URL. The body is read before returning
+        :param method: request method, e.g. "get" or "post"
+        :param path: path relative to the controller URL, e.g. "/properties/mode"
+        :param kwargs: request parameters, check aiohttp.ClientSession.request function
+        :return: aiohttp.ClientResponse
+        :raises CircuitOpenError: the RPi kept failing and the circuit breaker is open
+        """
+        method = method.upper()
+        try:
+            self.breaker.before()
+        except CircuitOpenError:
+            UPSTREAM_ERRORS.labels(method, path, 'circuit_open').inc()
+            raise
+        started = time.perf_counter()
+        try:
+            async with self._get_session().request(method, f'{self.url}{path}', **kwargs) as response:
+                await response.read()
+        except BaseException as e:
+            # A request cancelled by a timeout, e.g. the wait_for of get_all_states, also ends a half-open trial
+            kind = 'cancelled' if isinstance(e, asyncio.CancelledError) else 'error'
+            UPSTREAM_ERRORS.labels(method, path, kind).inc()
+            self.breaker.failure()
+            raise
+        finally:
+            UPSTREAM_LATENCY.labels(method, path).observe(time.perf_counter() - started)
+        if response.status >= 500:
+            UPSTREAM_ERRORS.labels(method, path, 'status').inc()
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        return response
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+_default_transport = None
+
+
+def get_default_transport() -> AsyncRpiTransport:
+    """
+    Gets the async transport to the controller configured in the environment
+    :return: shared AsyncRpiTransport
+    """
+    global _default_transport
+    if _default_transport is None:
+        if HVAC_URL is None:
+            raise Exception('RPI_HOST is not set, the RPi transport has to be given explicitly')
+        _default_transport = AsyncRpiTransport(HVAC_URL)
+    return _default_transport
+
+
+async def make_request(method: str, path: str, transport: AsyncRpiTransport = None,
+                       **kwargs) -> aiohttp.ClientResponse:
+    """
+    Make a generic request
+    :param method: request method, e.g. "get" or "post"
+    :param path: request path relative to the HVAC URL, e.g. "/properties/mode"
+    :param transport: transport to use, the default transport if not given
+    :param kwargs: request parameters, check aiohttp.ClientSession.request function
+    :return: aiohttp.ClientResponse with the body already read
+    """
+    if transport is None:
+        transport = get_default_transport()
+    response = await transport.request(method, path, **kwargs)
+    if response.status // 100 != 2:
+        raise Exception(f'RPi replied with code {response.status}')
+    return response
+
+
+async def get_property(name: str, transport: AsyncRpiTransport = None):
+    """
+    Gets a single RPi property
+    :param name: property name, e.g. "temperatureFeed"
+    :param transport: transport to use, the default transport if not given
+    :return: property value
+    """
+    response = await make_request('get', f'/properties/{name}', transport)
+    return await response.json(content_type=None)
+
+
+async def gather_properties(names: Iterable[str], transport: AsyncRpiTransport = None) -> dict:
+    """
+    Gets several RPi properties concurrently
+    :param names: property names, e.g. ("valveOpened1", "valveOpened2")
+    :param transport: transport to use, the default transport if not given
+    :return: property name to value mapping
+    """
+    names = tuple(names)
+    values = await asyncio.gather(*(get_property(name, transport) for name in names))
+    return dict(zip(names, values))
+
+
+async def get_he_temperature(number: int, transport: AsyncRpiTransport = None) -> float:
+    """
+    Gets heat exchanger temperature with a given number
+    :param number: heat exchanger number
+    :param transport: transport to use, the default transport if not given
+    :return: temperature in Celsius
+    """
+    if not (0 < number < 4):
+        raise Exception(f'Heat exchanger can be 1-3, not {number}')
+    return await get_property(f'temperatureHe{number}', transport)
+
+
+async def get_he_temperatures(transport: AsyncRpiTransport = None) -> list:
+    """
+    Gets all heat exchanger temperatures concurrently
+    :param transport: transport to use, the default transport if not given
+    :return: temperatures in Celsius ordered by heat exchanger number
+    """
+    return list(await asyncio.gather(*(get_he_temperature(number, transport) for number in range(1, 4))))
+
+
+async def get_outside_temperature(transport: AsyncRpiTransport = None) -> float:
+    """
+    Gets outside temperature
+    :param transport: transport to use, the default transport if not given
+    :return: temperature in Celsius
+    """
+    return await get_property('temperatureOutside', transport)
+
+
+async def get_inside_temperature(transport: AsyncRpiTransport = None) -> float:
+    """
+    Gets inside temperature
+    :param transport: transport to use, the default transport if not given
+    :return: temperature in Celsius
+    """
+    return await get_property('temperatureInside', transport)
+
+
+async def get_valve_opened(number: int, transport: AsyncRpiTransport = None) -> bool:
+    """
+    Gets valve state with a given number
+    :param number: valve number
+    :param transport: transport to use, the default transport if not given
+    :return: valve opened status
+    """
+    if not (0 < number < 5):
+        raise Exception(f'Valve can be 1-4, not {number}')
+    return await get_property(f'valveOpened{number}', transport)
+
+
+async def get_valves_opened(transport: AsyncRpiTransport = None) -> list:
+    """
+    Gets all valve states concurrently
+    :param transport: transport to use, the default transport if not given
+    :return: valve opened statuses ordered by valve number
+    """
+    return list(await asyncio.gather(*(get_valve_opened(number, transport) for number in range(1, 5))))
+
+
+async def get_feed_temperature(transport: AsyncRpiTransport = None) -> float:
+    """
+    Gets feed temperature
+    :param transport: transport to use, the default transport if not given
+    :return: feed temperature
+    """
+    return await get_property('temperatureFeed', transport)
+
+
+async def set_feed_temperature(temperature: int, transport: AsyncRpiTransport = None) -> bool:
+    """
+    Sets feed temperature
+    :param temperature: feed temperature
+    :param transport: transport to use, the default transport if not given
+    :return: operation success
+    """
+    response = await make_request('put', '/properties/temperatureFeed', transport, data=f'{temperature}')
+    return response.status // 100 == 2
+
+
+async def get_hysteresis(transport: AsyncRpiTransport = None) -> float:
+    """
+    Gets hysteresis
+    :param transport: transport to use, the default transport if not given
+    :return: hysteresis
+    """
+    return await get_property('hysteresis', transport)
+
+
+async def set_hysteresis(hysteresis: float, transport: AsyncRpiTransport = None) -> bool:
+    """
+    Sets hysteresis
+    :param hysteresis: hysteresis
+    :param transport: transport to use, the default transport if not given
+    :return: operation success
+    """
+    response = await make_request('put', '/properties/hysteresis', transport, data=f'{hysteresis}')
+    return response.status // 100 == 2
+
+
+async def get_mode(transport: AsyncRpiTransport = None) -> Mode:
+    """
+    Gets operation mode
+    :param transport: transport to use, the default transport if not given
+    :return: operation mode
+    """
+    return Mode(await get_property('mode', transport))
+
+
+async def set_mode(mode: Mode, transport: AsyncRpiTransport = None) -> bool:
+    """
+    Sets operation mode
+    :param mode: operation mode
+    :param transport: transport to use, the default transport if not given
+    :return: operation success
+    """
+    response = await make_request('put', '/properties/mode', transport, data=mode.value)
+    return response.status // 100 == 2
+
+
+async def get_valve_activated(number: int, transport: AsyncRpiTransport = None) -> bool:
+    """
+    Gets valve activated status
+    :param number: valve number
+    :param transport: transport to use, the default transport if not given
+    :return: valve activated status
+    """
+    return await get_property(f'valveActivated{number}', transport)
+
+
+async def get_valves_activated(transport: AsyncRpiTransport = None) -> list:
+    """
+    Gets all valve activated statuses concurrently
+    :param transport: transport to use, the default transport if not given
+    :return: valve activated statuses ordered by valve number
+    """
+    return list(await asyncio.gather(*(get_valve_activated(number, transport) for number in range(1, 5))))
+
+
+async def set_valve_activated(number: int, activated: bool, transport: AsyncRpiTransport = None) -> bool:
+    """
+    Sets valve activated status
+    :param number: valve number
+    :param activated: is valve activated
+    :param transport: transport to use, the default transport if not given
+    :return: operation success
+    """
+    if not (0 < number < 5):
+        raise Exception(f'Valve can be 1-4, not {number}')
+    response = await make_request('put', f'/properties/valveActivated{number}', transport,
+                                  data=f'{"true" if activated else "false"}')
+    return response.status // 100 == 2
+
+
+async def open_valve(number: int, transport: AsyncRpiTransport = None) -> bool:
+    """
+    Opens valve with a given number
+    :param number: valve number
+    :param transport: transport to use, the default transport if not given
+    :return: operation success
+    """
+    if not (0 < number < 5):
+        raise Exception(f'Valve can be 1-4, not {number}')
+    response = await make_request('post', f'/actions/openValve{number}', transport)
+    return response.status // 100 == 2
+
+
+async def close_valve(number: int, transport: AsyncRpiTransport = None) -> bool:
+    """
+    Closes valve with a given number
+    :param number: valve number
+    :param transport: transport to use, the default transport if not given
+    :return: operation success
+    """
+    if not (0 < number < 5):
+        raise Exception(f'Valve can be 1-4, not {number}')
+    response = await make_request('post', f'/actions/closeValve{number}', transport)
+    return response.status // 100 == 2
+
+
+async def get_all_states_by_property(transport: AsyncRpiTransport = None) -> RpiState:
+    """
+    Gets RPI full state by fetching every property concurrently
+    :param transport: transport to use, the default transport if not given
+    :return: full state
+    """
+    return state_from_properties(await gather_properties(PROPERTY_NAMES, transport))
+
+
+async def get_all_states(transport: AsyncRpiTransport = None, timeout: float = None) -> RpiState:
+    """
+    Gets RPI full state, falls back to concurrent per-property requests
+    when "/all/properties" fails or does not answer within the timeout
+    :param transport: transport to use, the default transport if not given
+    :param timeout: "/all/properties" timeout in seconds, transport read timeout if not given
+    :return: full state
+    """
+    try:
+        response = await asyncio.wait_for(make_request('get', '/all/properties', transport), timeout)
+        response_data = await response.json(content_type=None)
+    except Exception:
+        return await get_all_states_by_property(transport)
+    if not response_data:
+        raise Exception('RPi replied with an empty state')
+    return state_from_properties(response_data)
+
+
+class AsyncHvacRpi(UnitState):
+    """
+    Asyncio counterpart of HvacRpi, sharing its served state handling. Refreshes and writes are coroutines
+    and the updater is a task. Has to be created and used inside a single running event loop
+    """
+
+    def __init__(self, log=None, transport: AsyncRpiTransport = None, scheduler: PollScheduler = None,
+                 all_properties_timeout: float = None, name: str = None):
+        """
+        :param transport: async transport, the default one if not given
+        :param all_properties_timeout: "/all/properties" timeout in seconds before falling back to
+        per-property requests, the transport read timeout if not given
+        """
+        self._transport = transport if transport is not None else get_default_transport()
+        self._pr_lock = asyncio.Lock()
+        self._async_wake = asyncio.Event()
+        self._all_properties_timeout = all_properties_timeout
+        self._loop = None
+        super().__init__(log=log, scheduler=scheduler, name=name)
+
+    async def _update_values(self):
+        async with self._pr_lock:
+            self.log('Starting update')
+            try:
+                state = await get_all_states(self._transport, self._all_properties_timeout)
+            except Exception:
+                REFRESHES.labels(self._metric_unit, 'failure').inc()
+                raise
+            self._merge_refresh(FIELD_PROPERTIES.keys(), state=state)
+            REFRESHES.labels(self._metric_unit, 'success').inc()
+            self.log('Update finished')
+
+    async def refresh(self):
+        """
+        Refreshes the full state from the RPi
+        """
+        try:
+            await self._update_values()
+        except BaseException:
+            self._refresh_failed = True
+            raise
+
+    async def _updater(self):
+        self.log('Starting task')
+        while True:
+            self._async_wake.clear()
+            if self._scheduler.due_fields():
+                try:
+                    await self.refresh()
+                except CircuitOpenError as e:
+                    delay = self._scheduler.failed(retry_after=e.retry_after)
+                    self.log(f'RPi circuit is open, retrying in {delay:.1f} s')
+                except Exception as e:
+                    delay = self._scheduler.failed()
+                    self.log(f'Update failed, retrying in {delay:.1f} s: {e}')
+            try:
+                await asyncio.wait_for(self._async_wake.wait(), max(self._scheduler.next_delay(), .05))
+            except asyncio.TimeoutError:
+                pass
+
+    def _wake_updater(self):
+        # Subscribers may wake the updater from other threads
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._async_wake.set)
+        super()._wake_updater()
+
+    def start_updater(self):
+        self.log('Requesting an update')
+        self._loop = asyncio.get_event_loop()
+        self._updater_thread = self._loop.create_task(self._updater())
+
+    async def stop_updater(self):
+        """
+        Cancels the updater task and waits for it to end
+        """
+        task, self._updater_thread = self._updater_thread, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def set_feed_temperature(self, temperature) -> bool:
+        status = await set_feed_temperature(temperature, self._transport)
+        if status:
+            self._apply_write('feed_temperature', temperature)
+        return status
+
+    async def set_hysteresis(self, hysteresis) -> bool:
+        status = await set_hysteresis(hysteresis, self._transport)
+        if status:
+            self._apply_write('hysteresis', hysteresis)
+        return status
+
+    async def set_mode(self, mode: Mode) -> bool:
+        status = await set_mode(mode, self._transport)
+        if status:
+            self._apply_write('mode', Mode(mode))
+        return status
+
+    async def set_valve_activated(self, number, activated) -> bool:
+        status = await set_valve_activated(number, activated, self._transport)
+        if status:
+            self._apply_write('valves_activated_states', bool(activated), number)
+        return status
+
+    async def open_valve(self, number: int) -> bool:
+        status = await open_valve(number, self._transport)
+        if status:
+            self._apply_write('valves_states', True, number)
+        return status
+
+    async def close_valve(self, number: int) -> bool:
+        status = await close_valve(number, self._transport)
+        if status:
+            self._apply_write('valves_states', False, number)
+        return status
@@ -0,0 +1,130 @@
+import base64
+import binascii
+import functools
+import hashlib
+import hmac
+from collections import OrderedDict
+from threading import Lock
+from typing import Iterable, Optional, Tuple, Union
+
+from flask import g, request, Response
+
+
+def _credentials_digest(username: str, password: str) -> bytes:
+    return hashlib.sha256(f'{username}:{password}'.encode('utf-8')).digest()
+
+
+class RoleAuth:
+    """
+    HTTP Basic authentication with roles. Credentials are kept as digests only and every header is checked
+    against all of them in constant time, the resulting user and roles are cached per header digest
+    so a polling client's header is decoded and verified only once
+    """
+
+    def __init__(self, cache_size: int = 256):
+        """
+        :param cache_size: maximum number of distinct Authorization headers remembered
+        """
+        self.cache_size = cache_size
+        # (credentials digest, username, roles)
+        self._users = []
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    def add_user(self, user: str, password: str, roles: Union[str, Iterable[str]] = ()):
+        """
+        Adds a user, the password is not stored
+        :param user: username
+        :param password: password
+        :param roles: role or roles of the user
+        """
+        roles = frozenset((roles,) if isinstance(roles, str) else roles)
+        self._users.append((_credentials_digest(user, password), user, roles))
+        with self._lock:
+            self._cache.clear()
+
+    def _verify(self, header: str) -> Optional[Tuple[str, frozenset]]:
+        """
+        Decodes Basic credentials and matches them against every user without an early exit
+        :param header: Authorization header value
+        :return: username and roles, None if the credentials are invalid
+        """
+        scheme, _, token = header.partition(' ')
+        if scheme.lower() != 'basic':
+            return None
+        try:
+            username, separator, password = base64.b64decode(token.strip(), validate=True).decode('utf-8') \
+                .partition(':')
+        except (binascii.Error, UnicodeDecodeError):
+            return None
+        if not separator:
+            return None
+        digest = _credentials_digest(username, password)
+        found = None
+        for user_digest, user, roles in self._users:
+            if hmac.compare_digest(digest, user_digest) and found is None:
+                found = (user, roles)
+        return found
+
+    def authenticate(self, header: Optional[str]) -> Optional[Tuple[str, frozenset]]:
+        """
+        Gets the user an Authorization header belongs to
+        :param header: Authorization header value
+        :return: username and roles, None if the header is missing or invalid
+        """
+        if not header:
+            return None
+        key = hashlib.sha256(header.encode('utf-8')).digest()
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        user = self._verify(header)
+        with self._lock:
+            self._cache[key] = user
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return user
+
+    def current_user(self) -> Optional[Tuple[str, frozenset]]:
+        """
+        Gets the user of the current request, the header is authenticated once per request
+        :return: username and roles, None if not authenticated
+        """
+        if 'auth_user' not in g:
+            g.auth_user = self.authenticate(request.headers.get('Authorization'))
+        return g.auth_user
+
+    @staticmethod
+    def no_authentication() -> Response:
+        return Response('Could not verify your access level for that URL.\n'
+                        'You have to login with proper credentials', 401,
+                        {'WWW-Authenticate': 'Basic realm="Login Required"'})
+
+    @staticmethod
+    def no_authorization() -> Response:
+        return Response('You do not have access to this resource', 403)
+
+    def require(self, users: Iterable[str] = (), roles: Iterable[str] = ()):
+        """
+        Decorator allowing only the given users or roles, any authenticated user if neither is given
+        :param users: allowed usernames
+        :param roles: allowed roles
+        """
+        users = frozenset((users,) if isinstance(users, str) else users)
+        roles = frozenset((roles,) if isinstance(roles, str) else roles)
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                user = self.current_user()
+                if user is None:
+                    return self.no_authentication()
+                username, user_roles = user
+                if (users or roles) and username not in users and not roles & user_roles:
+                    return self.no_authorization()
+                return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
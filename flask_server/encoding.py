@@ -0,0 +1,44 @@
+import gzip
+import json
+
+import brotli
+import msgpack
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+# Response media types in order of preference, a client accepting anything gets the first one
+MIMETYPES = (JSON, MSGPACK, 'application/x-msgpack')
+# Content codings in order of preference
+ENCODINGS = ('br', 'gzip', 'identity')
+# Media types compressed when the client accepts it
+COMPRESSIBLE = frozenset((*MIMETYPES, 'text/plain'))
+# Smaller bodies are sent uncompressed by the generic response compression
+MIN_COMPRESS_SIZE = 512
+
+
+def encode(data, mimetype: str) -> bytes:
+    """
+    Serializes JSON compatible data
+    :param data: data to serialize
+    :param mimetype: one of MIMETYPES
+    :return: encoded data
+    """
+    if mimetype == JSON:
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """
+    Applies a content coding
+    :param body: response body
+    :param encoding: one of ENCODINGS
+    :return: encoded body
+    """
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    if encoding == 'gzip':
+        # No timestamp, so equal bodies stay equal
+        return gzip.compress(body, mtime=0)
+    return body
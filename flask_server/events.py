@@ -0,0 +1,126 @@
+import json
+import time
+from collections import deque
+from threading import Condition
+from typing import Callable, Iterator, List, Optional, Tuple
+
+
+def state_diff(old: dict, new: dict) -> dict:
+    """
+    Gets the fields that differ between two serialized states
+    :param old: previous state dict
+    :param new: new state dict
+    :return: changed field name to new value mapping
+    """
+    return {name: value for name, value in new.items() if old.get(name) != value}
+
+
+class StateEvents:
+    """
+    Sequence numbered feed of field-level state diffs.
+    Keeps the last diffs so reconnecting clients can resume from their last sequence number
+    """
+
+    def __init__(self, state: dict, history_size: int = 256):
+        """
+        :param state: initial serialized state
+        :param history_size: number of diffs kept for resuming clients
+        """
+        self._condition = Condition()
+        self._events = deque(maxlen=history_size)
+        self._sequence = 0
+        self._state = state
+        self._subscribers = 0
+        self.on_subscribe = None
+
+    @property
+    def subscribers(self) -> int:
+        return self._subscribers
+
+    def publish(self, state: dict, event: str = 'diff', data: dict = None):
+        """
+        Publishes a new state, a diff against the previous state is sent to the subscribers
+        :param state: new serialized state
+        :param event: event name
+        :param data: event data, the state diff if not given
+        """
+        with self._condition:
+            if data is None:
+                data = state_diff(self._state, state)
+            self._state = state
+            if not data:
+                return
+            self._sequence += 1
+            self._events.append((self._sequence, event, data))
+            self._condition.notify_all()
+
+    def changes(self, since: int = None, timeout: float = 0) -> Tuple[int, Optional[List[tuple]], dict]:
+        """
+        Waits for events newer than a sequence number
+        :param since: last sequence number seen by the client, None to get the full state
+        :param timeout: maximum wait in seconds when there are no newer events
+        :return: current sequence number, (sequence, event, data) list or None when the client
+        has to resync from the returned full state, full state
+        """
+        if timeout <= 0:
+            return self._changes(since, timeout)
+        with self._condition:
+            self._subscribers += 1
+        if self.on_subscribe is not None:
+            self.on_subscribe()
+        try:
+            return self._changes(since, timeout)
+        finally:
+            with self._condition:
+                self._subscribers -= 1
+
+    def _changes(self, since: int, timeout: float) -> Tuple[int, Optional[List[tuple]], dict]:
+        with self._condition:
+            if since is not None and since == self._sequence and timeout > 0:
+                self._condition.wait_for(lambda: self._sequence != since, timeout)
+            sequence, state = self._sequence, self._state
+            if since is None or since > sequence or (self._events and since < self._events[0][0] - 1):
+                return sequence, None, state
+            return sequence, [event for event in self._events if event[0] > since], state
+
+    def stream(self, since: int = None, heartbeat: float = 15) -> Iterator[str]:
+        """
+        Generates a Server-Sent Events stream
+        :param since: last sequence number seen by the client, None to start with the full state
+        :param heartbeat: keep-alive comment interval in seconds
+        :return: SSE formatted chunks
+        """
+        with self._condition:
+            self._subscribers += 1
+        if self.on_subscribe is not None:
+            self.on_subscribe()
+        try:
+            yield from sse_stream(self._changes, since, heartbeat)
+        finally:
+            with self._condition:
+                self._subscribers -= 1
+
+
+def sse_stream(changes: Callable[[Optional[int], float], tuple], since: int = None,
+               heartbeat: float = 15) -> Iterator[str]:
+    """
+    Generates a Server-Sent Events stream from a changes feed
+    :param changes: StateEvents.changes compatible callable
+    :param since: last sequence number seen by the client, None to start with the full state
+    :param heartbeat: keep-alive comment interval in seconds
+    :return: SSE formatted chunks
+    """
+    while True:
+        sequence, events, state = changes(since, heartbeat)
+        if events is None:
+            yield _sse(sequence, 'snapshot', state)
+        elif events:
+            for event in events:
+                yield _sse(*event)
+        else:
+            yield f': keepalive {int(time.time())}\n\n'
+        since = sequence
+
+
+def _sse(sequence: int, event: str, data: dict) -> str:
+    return f'id: {sequence}\nevent: {event}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
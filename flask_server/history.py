@@ -0,0 +1,237 @@
+import bisect
+import sqlite3
+import time
+from array import array
+from threading import Lock
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from rpi_interface import RpiState
+
+# History series names in sample column order
+SERIES = ('he_temperature1', 'he_temperature2', 'he_temperature3', 'feed_temperature', 'inside_temperature',
+          'outside_temperature', 'valve_opened1', 'valve_opened2', 'valve_opened3', 'valve_opened4')
+
+# Rollup resolution in seconds to default retention in seconds, 0 is the raw samples resolution
+RETENTION = {
+    0: 2 * 86400,
+    60: 14 * 86400,
+    900: 90 * 86400,
+    3600: 730 * 86400,
+}
+
+
+def state_samples(state: RpiState) -> Tuple[float, ...]:
+    """
+    Gets the history sample values of a state
+    :param state: RPi state
+    :return: values ordered as SERIES
+    """
+    return (*state.he_temperatures, state.feed_temperature, state.inside_temperature, state.outside_temperature,
+            *(float(opened) for opened in state.valves_states))
+
+
+class _Bucket:
+    """
+    Running min/max/sum of every series within one rollup bucket
+    """
+    __slots__ = ('start', 'count', 'minimum', 'maximum', 'total')
+
+    def __init__(self, start: int, values: Sequence[float]):
+        self.start = start
+        self.count = 1
+        self.minimum = array('d', values)
+        self.maximum = array('d', values)
+        self.total = array('d', values)
+
+    def add(self, values: Sequence[float]):
+        self.count += 1
+        for i, value in enumerate(values):
+            if value < self.minimum[i]:
+                self.minimum[i] = value
+            if value > self.maximum[i]:
+                self.maximum[i] = value
+            self.total[i] += value
+
+    def row(self, resolution: int) -> tuple:
+        aggregates = []
+        for i in range(len(SERIES)):
+            aggregates += (self.minimum[i], self.maximum[i], self.total[i] / self.count)
+        return (resolution, self.start, self.count, *aggregates)
+
+
+class HistoryStore:
+    """
+    Temperature and valve history. Recent raw samples are kept in memory as array-backed columns,
+    every sample and the 1 minute, 15 minutes and 1 hour min/max/avg rollups are stored in SQLite
+    """
+
+    def __init__(self, path: str, retention: Dict[int, float] = None, max_points: int = 2000):
+        """
+        :param path: SQLite database path
+        :param retention: resolution in seconds to retention in seconds
+        :param max_points: maximum number of points a query without an explicit resolution returns
+        """
+        self.retention = {**RETENTION, **(retention or {})}
+        self.max_points = max_points
+        self._lock = Lock()
+        self._times = array('d')
+        self._columns = [array('d') for _ in SERIES]
+        self._buckets = {resolution: None for resolution in self.retention if resolution}
+        self._last_purge = 0.
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(f'CREATE TABLE IF NOT EXISTS samples (time REAL PRIMARY KEY, '
+                         f'{", ".join(f"{name} REAL" for name in SERIES)})')
+        self._db.execute(f'CREATE TABLE IF NOT EXISTS rollups (resolution INTEGER, bucket INTEGER, count INTEGER, '
+                         f'{", ".join(f"{name}_{aggregate} REAL" for name in SERIES for aggregate in ("min", "max", "avg"))}, '
+                         f'PRIMARY KEY (resolution, bucket))')
+        self._db.commit()
+        self._load_recent()
+        self._load_open_buckets()
+
+    def _load_recent(self):
+        since = time.time() - self.retention[0]
+        for row in self._db.execute('SELECT * FROM samples WHERE time >= ? ORDER BY time', (since,)):
+            self._times.append(row[0])
+            for column, value in zip(self._columns, row[1:]):
+                column.append(value)
+
+    def _load_open_buckets(self):
+        # The bucket of the latest sample is written only once the next bucket starts, it is rebuilt from the samples
+        # so a restart without close() does not lose it
+        last = self._db.execute('SELECT MAX(time) FROM samples').fetchone()[0]
+        if last is None:
+            return
+        for resolution in self._buckets:
+            start = int(last // resolution * resolution)
+            bucket = None
+            for row in self._db.execute('SELECT * FROM samples WHERE time >= ? ORDER BY time', (start,)):
+                if bucket is None:
+                    bucket = _Bucket(start, row[1:])
+                else:
+                    bucket.add(row[1:])
+            self._buckets[resolution] = bucket
+
+    def append(self, state: RpiState, timestamp: float = None):
+        """
+        Appends a state sample
+        :param state: RPi state
+        :param timestamp: UNIX timestamp, current time if not given
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        values = state_samples(state)
+        with self._lock:
+            if self._times and timestamp <= self._times[-1]:
+                return
+            self._times.append(timestamp)
+            for column, value in zip(self._columns, values):
+                column.append(value)
+            self._db.execute(f'INSERT INTO samples VALUES ({", ".join("?" * (len(SERIES) + 1))})',
+                             (timestamp, *values))
+            for resolution, bucket in self._buckets.items():
+                start = int(timestamp // resolution * resolution)
+                if bucket is not None and bucket.start == start:
+                    bucket.add(values)
+                    continue
+                if bucket is not None:
+                    self._write_bucket(resolution, bucket)
+                self._buckets[resolution] = _Bucket(start, values)
+            self._db.commit()
+            if timestamp - self._last_purge > 3600:
+                self._purge(timestamp)
+
+    def _write_bucket(self, resolution: int, bucket: _Bucket):
+        self._db.execute(f'INSERT OR REPLACE INTO rollups VALUES ({", ".join("?" * (len(SERIES) * 3 + 3))})',
+                         bucket.row(resolution))
+
+    def _purge(self, now: float):
+        self._last_purge = now
+        cut = bisect.bisect_left(self._times, now - self.retention[0])
+        if cut:
+            del self._times[:cut]
+            for column in self._columns:
+                del column[:cut]
+        self._db.execute('DELETE FROM samples WHERE time < ?', (now - self.retention[0],))
+        for resolution, retention in self.retention.items():
+            if resolution:
+                self._db.execute('DELETE FROM rollups WHERE resolution = ? AND bucket < ?',
+                                 (resolution, now - retention))
+        self._db.commit()
+
+    def pick_resolution(self, start: float, end: float, now: float = None) -> int:
+        """
+        Picks the finest resolution which still covers the start and does not exceed the maximum number of points
+        :param start: range start UNIX timestamp
+        :param end: range end UNIX timestamp
+        :param now: current UNIX timestamp
+        :return: resolution in seconds, 0 for raw samples
+        """
+        now = time.time() if now is None else now
+        resolutions = sorted(self.retention)
+        for resolution in resolutions:
+            points = (end - start) / (resolution or 30)
+            if start >= now - self.retention[resolution] and points <= self.max_points:
+                return resolution
+        return resolutions[-1]
+
+    def query(self, start: float, end: float, series: Iterable[str] = None, resolution: int = None) -> dict:
+        """
+        Gets the history within a time range
+        :param start: range start UNIX timestamp
+        :param end: range end UNIX timestamp
+        :param series: series names, all series if not given
+        :param resolution: resolution in seconds, picked from the range if not given
+        :return: {"resolution", "time", "series"} where series maps names to value lists for raw samples
+        and to {"min", "max", "avg"} lists for rollups
+        """
+        series = list(series) if series is not None else list(SERIES)
+        for name in series:
+            if name not in SERIES:
+                raise Exception(f'Unknown history series {name}')
+        if resolution is None:
+            resolution = self.pick_resolution(start, end)
+        if resolution not in self.retention:
+            raise Exception(f'Resolution can be one of {sorted(self.retention)}, not {resolution}')
+        with self._lock:
+            if resolution:
+                times, values = self._query_rollups(start, end, series, resolution)
+            elif self._times and start >= self._times[0]:
+                times, values = self._query_memory(start, end, series)
+            else:
+                times, values = self._query_samples(start, end, series)
+        return {'resolution': resolution, 'time': times, 'series': values}
+
+    def _query_memory(self, start: float, end: float, series: List[str]) -> Tuple[list, dict]:
+        first = bisect.bisect_left(self._times, start)
+        last = bisect.bisect_right(self._times, end)
+        return self._times[first:last].tolist(), {
+            name: self._columns[SERIES.index(name)][first:last].tolist() for name in series}
+
+    def _query_samples(self, start: float, end: float, series: List[str]) -> Tuple[list, dict]:
+        rows = self._db.execute(f'SELECT time, {", ".join(series)} FROM samples '
+                                f'WHERE time >= ? AND time <= ? ORDER BY time', (start, end)).fetchall()
+        return [row[0] for row in rows], {name: [row[i + 1] for row in rows] for i, name in enumerate(series)}
+
+    def _query_rollups(self, start: float, end: float, series: List[str], resolution: int) -> Tuple[list, dict]:
+        columns = [f'{name}_{aggregate}' for name in series for aggregate in ('min', 'max', 'avg')]
+        rows = self._db.execute(f'SELECT bucket, {", ".join(columns)} FROM rollups '
+                                f'WHERE resolution = ? AND bucket >= ? AND bucket <= ? ORDER BY bucket',
+                                (resolution, start // resolution * resolution, end)).fetchall()
+        bucket = self._buckets.get(resolution)
+        if bucket is not None and start // resolution * resolution <= bucket.start <= end:
+            indexes = [SERIES.index(name) for name in series]
+            rows.append((bucket.start, *(value for i in indexes for value in
+                                         (bucket.minimum[i], bucket.maximum[i], bucket.total[i] / bucket.count))))
+        values = {}
+        for i, name in enumerate(series):
+            values[name] = {aggregate: [row[1 + i * 3 + j] for row in rows]
+                            for j, aggregate in enumerate(('min', 'max', 'avg'))}
+        return [row[0] for row in rows], values
+
+    def close(self):
+        with self._lock:
+            for resolution, bucket in self._buckets.items():
+                if bucket is not None:
+                    self._write_bucket(resolution, bucket)
+            self._db.commit()
+            self._db.close()
@@ -0,0 +1,67 @@
+import json
+import logging
+import os
+import time
+from threading import Lock
+from typing import Optional, Tuple
+
+from rpi_interface import RpiState
+
+# Bumped whenever the RpiState fields change, files of other versions are ignored
+VERSION = 1
+
+
+class LastStateFile:
+    """
+    Last known unit state persisted on local disk, so a restarted server serves it (marked stale)
+    instead of an empty state until the first refresh completes
+    """
+
+    def __init__(self, path: str, save_interval: float = 60):
+        """
+        :param path: state file path
+        :param save_interval: how often an unchanged state is saved again to keep its refresh time, in seconds
+        """
+        self.path = path
+        self.save_interval = save_interval
+        self._lock = Lock()
+        self._saved_state = None
+        self._saved_at = float('-inf')
+
+    def load(self) -> Optional[Tuple[RpiState, float, float]]:
+        """
+        Loads the persisted state
+        :return: state, last refresh and last change UNIX timestamps, None if there is no usable file
+        """
+        try:
+            with open(self.path, 'rb') as file:
+                saved = json.load(file)
+            if saved.get('version') != VERSION:
+                raise Exception(f'unknown version {saved.get("version")}')
+            return RpiState(**saved['state']), saved['timestamp'], saved['last_modified']
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.getLogger(__name__).warning(f'Ignoring last state file {self.path}: {e}')
+            return None
+
+    def save(self, state: RpiState, timestamp: float, last_modified: float):
+        """
+        Atomically replaces the persisted state if it changed or was saved long enough ago
+        :param state: refreshed state
+        :param timestamp: refresh UNIX timestamp
+        :param last_modified: last change UNIX timestamp
+        """
+        with self._lock:
+            if state == self._saved_state and time.monotonic() - self._saved_at < self.save_interval:
+                return
+            data = json.dumps({'version': VERSION, 'timestamp': timestamp, 'last_modified': last_modified,
+                               'state': state.as_dict()}, separators=(',', ':')).encode('utf-8')
+            temporary = f'{self.path}.tmp'
+            with open(temporary, 'wb') as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self.path)
+            self._saved_state = state
+            self._saved_at = time.monotonic()
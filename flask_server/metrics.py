@@ -0,0 +1,264 @@
+import bisect
+import math
+from threading import Lock, get_ident
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Latency histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class _Sharded:
+    """
+    Per-thread value shards. Every thread only writes its own shard so the hot path takes no lock,
+    shards are summed when the metrics are collected
+    """
+
+    def __init__(self, size: int):
+        self._size = size
+        self._shards = {}
+        self._lock = Lock()
+
+    def shard(self) -> list:
+        shard = self._shards.get(get_ident())
+        if shard is None:
+            with self._lock:
+                shard = self._shards[get_ident()] = [0] * self._size
+        return shard
+
+    def total(self) -> List[float]:
+        with self._lock:
+            shards = list(self._shards.values())
+        return [sum(values) for values in zip(*shards)] if shards else [0] * self._size
+
+
+class _CounterChild(_Sharded):
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount: float = 1):
+        self.shard()[0] += amount
+
+
+class _HistogramChild(_Sharded):
+    def __init__(self, buckets: Sequence[float]):
+        # Bucket counts followed by the sum of the observed values
+        super().__init__(len(buckets) + 2)
+        self._buckets = buckets
+
+    def observe(self, value: float):
+        shard = self.shard()
+        shard[bisect.bisect_left(self._buckets, value)] += 1
+        shard[-1] += value
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), registry=None):
+        """
+        :param name: metric name
+        :param documentation: metric help text
+        :param labels: label names
+        :param registry: registry the metric is exposed in, the default registry if not given
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *values):
+        """
+        Gets the metric child with the given label values
+        :param values: label values in the label names order
+        :return: metric child
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise Exception(f'{self.name} expects labels {self.label_names}, got {values}')
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _items(self) -> List[tuple]:
+        with self._lock:
+            return list(self._children.items())
+
+    def export(self) -> List[Tuple[tuple, List[float]]]:
+        """
+        Gets the raw values of the metric, so another process can expose them
+        :return: (label values, values) pairs
+        """
+        return [(values, child.total()) for values, child in self._items()]
+
+    def _totals(self, extra: Iterable[Tuple[tuple, List[float]]] = ()) -> List[Tuple[tuple, List[float]]]:
+        totals = dict(self.export())
+        for values, other in extra:
+            own = totals.get(values)
+            totals[values] = other if own is None else [a + b for a, b in zip(own, other)]
+        return list(totals.items())
+
+    def samples(self, extra: Iterable[Tuple[tuple, List[float]]] = ()) -> Iterable[str]:
+        """
+        Gets the exposition lines of the metric
+        :param extra: exported values of other processes added to the own values
+        """
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing count, the name has to end with "_total"
+    """
+    kind = 'counter'
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def samples(self, extra: Iterable[Tuple[tuple, List[float]]] = ()) -> Iterable[str]:
+        for values, totals in self._totals(extra):
+            yield f'{self.name}{_format_labels(self.label_names, values)} {_format_value(totals[0])}'
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values in fixed buckets
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS, registry=None):
+        """
+        :param buckets: increasing bucket upper bounds, +Inf is added
+        """
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labels, registry)
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self, extra: Iterable[Tuple[tuple, List[float]]] = ()) -> Iterable[str]:
+        for values, totals in self._totals(extra):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), totals):
+                cumulative += count
+                labels = _format_labels(self.label_names, values, f'le="{_format_value(bound)}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.label_names, values)
+            yield f'{self.name}_sum{labels} {_format_value(totals[-1])}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class Gauge(_Metric):
+    """
+    Value read when the metrics are collected
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 collect: Callable[[], Iterable[Tuple[tuple, float]]] = None, registry=None):
+        """
+        :param collect: callable returning (label values, value) pairs
+        """
+        self.collect = collect
+        super().__init__(name, documentation, labels, registry)
+
+    def export(self) -> List[Tuple[tuple, List[float]]]:
+        # Gauges are collected from the state of their own process
+        return []
+
+    def samples(self, extra: Iterable[Tuple[tuple, List[float]]] = ()) -> Iterable[str]:
+        if self.collect is None:
+            return
+        for values, value in self.collect():
+            if value is not None:
+                yield f'{self.name}{_format_labels(self.label_names, values)} {_format_value(value)}'
+
+
+class Registry:
+    """
+    Set of metrics exposed together in the Prometheus text format
+    """
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = Lock()
+
+    def register(self, metric: _Metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise Exception(f'Metric {metric.name} is already registered')
+            self._metrics[metric.name] = metric
+
+    def get(self, name: str) -> _Metric:
+        return self._metrics.get(name)
+
+    def export(self) -> Dict[str, List[Tuple[tuple, List[float]]]]:
+        """
+        Gets the raw values of the counters and histograms with samples
+        :return: metric name to (label values, values) pairs
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        exported = {metric.name: metric.export() for metric in metrics}
+        return {name: values for name, values in exported.items() if values}
+
+    def render(self, include: Iterable[str] = None, exclude: Iterable[str] = (),
+               extra: Iterable[Dict[str, List[Tuple[tuple, List[float]]]]] = ()) -> str:
+        """
+        Renders the metrics
+        :param include: names of the rendered metrics, every metric if not given
+        :param exclude: names of the metrics which are not rendered
+        :param extra: exports of other processes, their values are added to the values of the same metrics
+        :return: Prometheus text exposition
+        """
+        extra = list(extra)
+        include = set(include) if include is not None else None
+        exclude = set(exclude)
+        with self._lock:
+            metrics = [metric for name, metric in self._metrics.items()
+                       if (include is None or name in include) and name not in exclude]
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            try:
+                lines.extend(metric.samples([item for exported in extra for item in exported.get(metric.name, ())]))
+            except Exception as e:
+                lines.append(f'# {metric.name} collection failed: {_escape(e)}')
+        return ''.join(f'{line}\n' for line in lines)
+
+
+REGISTRY = Registry()
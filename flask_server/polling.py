@@ -0,0 +1,121 @@
+import random
+import time
+from typing import Callable, Dict, Iterable, Set
+
+# State field to base polling interval in seconds
+FIELD_INTERVALS = {
+    'he_temperatures': 30,
+    'feed_temperature': 30,
+    'hysteresis': 120,
+    'outside_temperature': 120,
+    'inside_temperature': 30,
+    'valves_states': 30,
+    'valves_activated_states': 60,
+    'mode': 30,
+}
+
+
+class PollScheduler:
+    """
+    Decides when and which state fields are polled.
+    Polls faster after writes and while clients are watching, slows down while nothing changes
+    and backs off exponentially with jitter while the RPi is failing
+    """
+
+    def __init__(self, intervals: Dict[str, float] = None, fast_interval: float = 2, fast_window: float = 20,
+                 watched_interval: float = 5, max_idle_factor: float = 4, backoff: float = 2,
+                 max_backoff: float = 300, max_property_requests: int = 4, watchers: Callable[[], int] = None):
+        """
+        :param intervals: state field to base polling interval in seconds
+        :param fast_interval: polling interval right after a write
+        :param fast_window: how long to poll fast after a write in seconds
+        :param watched_interval: maximum polling interval while clients are watching
+        :param max_idle_factor: maximum base interval multiplier while nothing changes
+        :param backoff: first retry delay after a failure in seconds
+        :param max_backoff: maximum retry delay in seconds
+        :param max_property_requests: maximum single property requests per poll before
+        falling back to requesting all properties at once
+        :param watchers: callable returning the number of watching clients
+        """
+        self.intervals = dict(FIELD_INTERVALS, **(intervals or {}))
+        self.fast_interval = fast_interval
+        self.fast_window = fast_window
+        self.watched_interval = watched_interval
+        self.max_idle_factor = max_idle_factor
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_property_requests = max_property_requests
+        self.watchers = watchers
+        self._polled = dict.fromkeys(self.intervals, float('-inf'))
+        self._fast_until = 0.
+        self._idle_factor = 1.
+        self._failures = 0
+        self._retry_at = 0.
+
+    def _interval(self, field: str, now: float) -> float:
+        interval = self.intervals[field] * self._idle_factor
+        if self.watchers is not None and self.watchers() > 0:
+            interval = min(interval, self.watched_interval)
+        if now < self._fast_until:
+            interval = min(interval, self.fast_interval)
+        return interval
+
+    def due_fields(self, now: float = None) -> Set[str]:
+        """
+        Gets the fields which have to be polled
+        :param now: current monotonic time
+        :return: due field names
+        """
+        now = time.monotonic() if now is None else now
+        if now < self._retry_at:
+            return set()
+        return {field for field, polled in self._polled.items() if polled + self._interval(field, now) <= now}
+
+    def next_delay(self, now: float = None) -> float:
+        """
+        Gets the time until the next poll
+        :param now: current monotonic time
+        :return: delay in seconds
+        """
+        now = time.monotonic() if now is None else now
+        due = min(polled + self._interval(field, now) for field, polled in self._polled.items())
+        return max(self._retry_at, due) - now
+
+    def completed(self, fields: Iterable[str], changed: bool, now: float = None):
+        """
+        Reschedules successfully polled fields
+        :param fields: polled field names
+        :param changed: whether the poll changed the state
+        :param now: current monotonic time
+        """
+        now = time.monotonic() if now is None else now
+        self._failures = 0
+        self._retry_at = 0.
+        self._idle_factor = 1. if changed else min(self._idle_factor * 1.5, self.max_idle_factor)
+        for field in fields:
+            self._polled[field] = now
+
+    def failed(self, now: float = None, retry_after: float = None) -> float:
+        """
+        Schedules a retry with exponential backoff and jitter
+        :param now: current monotonic time
+        :param retry_after: retry delay requested by an open circuit breaker, replaces the backoff
+        :return: retry delay in seconds
+        """
+        now = time.monotonic() if now is None else now
+        if retry_after is not None:
+            delay = retry_after + random.uniform(0, self.backoff)
+        else:
+            delay = min(self.max_backoff, self.backoff * 2 ** self._failures) * random.uniform(.5, 1.)
+            self._failures += 1
+        self._retry_at = now + delay
+        return delay
+
+    def note_write(self, now: float = None):
+        """
+        Switches to fast polling after a write
+        :param now: current monotonic time
+        """
+        now = time.monotonic() if now is None else now
+        self._fast_until = now + self.fast_window
+        self._idle_factor = 1.
@@ -0,0 +1,151 @@
+import configparser
+import logging
+import os
+import subprocess
+import sys
+import time
+from threading import Event, Lock, Thread
+
+from gunicorn.app.base import BaseApplication
+
+from remote import RemotePrograms, SnapshotClient, SnapshotServer, WorkerMetrics, remote_limits, remote_units
+from server import Server, load_config, load_limits, load_programs, load_units
+from snapshot import SnapshotReader, SnapshotWriter
+from units import UnitRegistry
+
+
+def run_poller(socket_path: str, snapshot_path: str):
+    """
+    Poller process entry point: polls every unit, publishes their states to the shared snapshot file
+    and serves the operations the workers forward
+    :param socket_path: poller process channel unix socket path
+    :param snapshot_path: shared snapshot file path
+    """
+    config = load_config()
+    units = UnitRegistry(load_units(config), config.getint('UNITS', 'PollWorkers'))
+    SnapshotWriter(snapshot_path, units.units).attach(units.poller)
+    programs = load_programs(config, units.units)
+    SnapshotServer(socket_path, units, programs, load_limits(config)).start()
+    units.start()
+    if programs is not None:
+        programs.start()
+    logging.getLogger(__name__).info(f'Poller serving {len(units)} units on {socket_path}')
+    Event().wait()
+
+
+class ProductionApplication(BaseApplication):
+    """
+    Gunicorn application running the API in gthread workers which read the unit states the poller process shares
+    """
+
+    def __init__(self, config: configparser.ConfigParser):
+        self._config = config
+        super().__init__()
+
+    def load_config(self):
+        config = self._config
+        self.cfg.set('bind', f'{config["DEFAULT"]["Host"]}:{config.getint("DEFAULT", "Port")}')
+        self.cfg.set('workers', config.getint('PRODUCTION', 'Workers'))
+        self.cfg.set('worker_class', 'gthread')
+        self.cfg.set('threads', config.getint('PRODUCTION', 'Threads'))
+        self.cfg.set('keepalive', config.getint('PRODUCTION', 'KeepAlive'))
+        self.cfg.set('timeout', config.getint('PRODUCTION', 'Timeout'))
+        self.cfg.set('graceful_timeout', config.getint('PRODUCTION', 'GracefulTimeout'))
+
+    def load(self):
+        config = self._config
+        client = SnapshotClient(config['PRODUCTION']['Socket'])
+        snapshots = SnapshotReader(config['PRODUCTION']['Snapshot'],
+                                   stale_after=config.getfloat('PRODUCTION', 'SnapshotStaleAfter'))
+        units = remote_units(client, snapshots)
+        metrics = WorkerMetrics(client)
+        metrics.start()
+        server = Server(host=config['DEFAULT']['Host'],
+                        port=config.getint('DEFAULT', 'Port'),
+                        debug=False,
+                        units=units,
+                        remote=metrics,
+                        limits=remote_limits(config['PRODUCTION']['Socket'], load_limits(config)),
+                        programs=RemotePrograms(client) if config.getboolean('PROGRAMS', 'Enabled') else None)
+        return server.app
+
+
+class PollerSupervisor:
+    """
+    Runs the poller process and starts it again whenever it exits, backing off while it keeps crashing
+    """
+
+    def __init__(self, args: list, restart_delay: float = 1, max_restart_delay: float = 30):
+        """
+        :param args: poller process command line
+        :param restart_delay: first delay before a restart in seconds
+        :param max_restart_delay: maximum delay before a restart, the delay doubles while the poller keeps crashing
+        """
+        self.args = args
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self._stopping = Event()
+        self._lock = Lock()
+        self._process = None
+        self._pid = None
+
+    def start(self):
+        # Forked gunicorn workers inherit the supervisor and unwind through run_production when they exit
+        self._pid = os.getpid()
+        self._spawn()
+        Thread(daemon=True, target=self._watch, name='poller-supervisor').start()
+
+    def _spawn(self):
+        with self._lock:
+            if not self._stopping.is_set():
+                self._process = subprocess.Popen(self.args)
+
+    def _watch(self):
+        delay = self.restart_delay
+        while True:
+            started = time.monotonic()
+            code = self._process.wait()
+            if self._stopping.is_set():
+                return
+            # A poller which ran for a while crashed once rather than on startup
+            if time.monotonic() - started > 60:
+                delay = self.restart_delay
+            logging.getLogger(__name__).error(f'Poller process exited with {code}, restarting in {delay:.1f} s')
+            if self._stopping.wait(delay):
+                return
+            delay = min(delay * 2, self.max_restart_delay)
+            self._spawn()
+
+    def stop(self):
+        """
+        Stops the poller process, does nothing in processes forked from the one which started it
+        """
+        if os.getpid() != self._pid:
+            return
+        with self._lock:
+            self._stopping.set()
+            if self._process is not None:
+                self._process.terminate()
+                self._process.wait()
+
+
+def run_production(config: configparser.ConfigParser):
+    """
+    Starts the poller process and serves the API with gunicorn
+    :param config: server config
+    """
+    # Workers must not map the snapshot file of a previous poller
+    if os.path.exists(config['PRODUCTION']['Snapshot']):
+        os.unlink(config['PRODUCTION']['Snapshot'])
+    # A separate interpreter rather than a multiprocessing child, which the forked workers would try to join on exit
+    poller = PollerSupervisor([sys.executable, __file__, config['PRODUCTION']['Socket'],
+                               config['PRODUCTION']['Snapshot']])
+    poller.start()
+    try:
+        ProductionApplication(config).run()
+    finally:
+        poller.stop()
+
+
+if __name__ == '__main__':
+    run_poller(sys.argv[1], sys.argv[2])
@@ -0,0 +1,220 @@
+import heapq
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time as day_time, timedelta
+from threading import Condition, Thread
+from typing import Dict, Iterable, List
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9
+    from backports.zoneinfo import ZoneInfo
+
+from metrics import Counter
+from rpi_interface import HvacRpi, write_target
+
+PROGRAM_WRITES = Counter('hvac_program_writes_total', 'Writes run by scheduled programs', ('unit', 'result'))
+
+# Longest sleep of the scheduler thread, so wall clock jumps are noticed
+MAX_SLEEP = 60
+
+
+class ProgramError(Exception):
+    """
+    Invalid program entry
+    """
+    status = 400
+
+
+def next_fire(days: Iterable[int], hour: int, minute: int, after: float, timezone: ZoneInfo = None) -> float:
+    """
+    Gets the next time an entry fires at
+    :param days: weekdays, Monday is 0
+    :param hour: hour of the day
+    :param minute: minute of the hour
+    :param after: UNIX timestamp the fire time has to follow
+    :param timezone: time zone of the weekdays and times, the local time zone of the server if not given
+    :return: UNIX timestamp
+    """
+    start = datetime.fromtimestamp(after, timezone).date()
+    for offset in range(8):
+        day = start + timedelta(days=offset)
+        if day.weekday() in days:
+            fire = datetime.combine(day, day_time(hour, minute), tzinfo=timezone).timestamp()
+            if fire > after:
+                return fire
+    raise ProgramError(f'No weekday in {days}')
+
+
+class ProgramScheduler:
+    """
+    Weekly programs of unit writes, e.g. switching to autoWinter at 06:00 on working days.
+    Entries sit in a heap by their next fire time, the thread sleeps until the earliest one is due,
+    and a fired entry is rescheduled from its own fire time. Entries of a unit due together are sent as one batch
+    """
+
+    def __init__(self, units: Dict[str, HvacRpi], path: str = None, max_workers: int = 4, timezone: str = None):
+        """
+        :param units: unit name to unit interface
+        :param path: JSON file the programs are persisted to, not persisted if not given
+        :param max_workers: maximum number of units written at the same time
+        :param timezone: IANA time zone of the entry times, e.g. "Europe/Berlin", the local time zone of the server
+        (UTC in the Docker image) if not given
+        """
+        self.units = dict(units)
+        self.path = path
+        self.timezone = ZoneInfo(timezone) if timezone else None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='program')
+        self._condition = Condition()
+        self._entries = {}
+        self._heap = []
+        # Entry ID to the UNIX timestamp of its next fire, stale heap items are skipped
+        self._due = {}
+        self._thread = None
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as file:
+                for entry in json.load(file):
+                    self._entries[entry['id']] = entry
+        now = time.time()
+        with self._condition:
+            for entry in self._entries.values():
+                if entry['unit'] in self.units:
+                    self._schedule(entry, now)
+                else:
+                    logging.getLogger(__name__).warning(f'Program {entry["id"]} of unknown unit {entry["unit"]} '
+                                                        f'is kept but not run')
+
+    def _schedule(self, entry: dict, after: float):
+        hour, minute = map(int, entry['time'].split(':'))
+        when = next_fire(entry['days'], hour, minute, after, self.timezone)
+        self._due[entry['id']] = when
+        heapq.heappush(self._heap, (when, entry['id']))
+        self._condition.notify()
+
+    def _save(self):
+        if self.path is None:
+            return
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(list(self._entries.values()), file, indent=1)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path)
+
+    def list(self, unit: str = None) -> List[dict]:
+        """
+        Gets the program entries
+        :param unit: unit name, every unit if not given
+        :return: entries with their next fire UNIX timestamp
+        """
+        with self._condition:
+            return [{**entry, 'next': self._due.get(entry['id'])} for entry in self._entries.values()
+                    if unit is None or entry['unit'] == unit]
+
+    def add(self, unit: str, days: Iterable[int], at: str, write: str, args: Iterable) -> dict:
+        """
+        Adds an entry. It replaces the days it shares with entries writing the same target of the unit at the same time
+        :param unit: unit name
+        :param days: weekdays, Monday is 0
+        :param at: time of the day in the scheduler time zone, "HH:MM"
+        :param write: HvacRpi write method name, e.g. "set_mode"
+        :param args: JSON compatible write method arguments
+        :return: added entry
+        """
+        if unit not in self.units:
+            raise ProgramError(f'Unknown unit {unit}')
+        try:
+            days = sorted(set(int(day) for day in days))
+            hour, minute = map(int, at.split(':'))
+            day_time(hour, minute)
+            args = list(args)
+            target = write_target(write, tuple(args))
+        except Exception as e:
+            raise ProgramError(f'Invalid program entry: {e}')
+        if not days or not all(0 <= day <= 6 for day in days):
+            raise ProgramError(f'Days can be 0-6 (Monday-Sunday), not {days}')
+        entry = {'id': uuid.uuid4().hex, 'unit': unit, 'days': days, 'time': f'{hour:02d}:{minute:02d}',
+                 'write': write, 'args': args}
+        with self._condition:
+            for other in list(self._entries.values()):
+                if other['unit'] != unit or other['time'] != entry['time'] or \
+                        write_target(other['write'], tuple(other['args'])) != target:
+                    continue
+                remaining = [day for day in other['days'] if day not in days]
+                if remaining == other['days']:
+                    continue
+                if remaining:
+                    other['days'] = remaining
+                    self._schedule(other, time.time())
+                else:
+                    del self._entries[other['id']]
+                    self._due.pop(other['id'], None)
+            self._entries[entry['id']] = entry
+            self._schedule(entry, time.time())
+            self._save()
+        return entry
+
+    def remove(self, entry_id: str) -> bool:
+        """
+        Removes an entry
+        :param entry_id: entry ID
+        :return: whether the entry existed
+        """
+        with self._condition:
+            if self._entries.pop(entry_id, None) is None:
+                return False
+            self._due.pop(entry_id, None)
+            self._save()
+        return True
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(daemon=True, target=self._run, name='program-scheduler')
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+                        heapq.heappop(self._heap)
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._condition.wait(min(self._heap[0][0] - now, MAX_SLEEP) if self._heap else MAX_SLEEP)
+                batches = {}
+                while self._heap and self._heap[0][0] <= now:
+                    when, entry_id = heapq.heappop(self._heap)
+                    if self._due.get(entry_id) != when:
+                        continue
+                    entry = self._entries[entry_id]
+                    batches.setdefault(entry['unit'], []).append((entry['write'], tuple(entry['args'])))
+                    self._schedule(entry, max(when, now))
+            for unit, writes in batches.items():
+                self._executor.submit(self._fire, unit, writes)
+
+    def _fire(self, unit: str, writes: list):
+        results = self.units[unit].write_batch(writes)
+        for (write, args), result in zip(writes, results):
+            if isinstance(result, Exception) or not result:
+                PROGRAM_WRITES.labels(unit, 'failure').inc()
+                logging.getLogger(__name__).error(f'Program write {write}{args} of {unit} failed: {result}')
+            else:
+                PROGRAM_WRITES.labels(unit, 'success').inc()
+                logging.getLogger(__name__).info(f'Program write {write}{args} of {unit} done')
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+def program_args(args: Iterable) -> list:
+    """
+    Gets JSON compatible write arguments, enumerations are replaced by their values
+    :param args: write method arguments
+    :return: argument list
+    """
+    return [getattr(arg, 'value', arg) for arg in args]
@@ -0,0 +1,450 @@
+import logging
+import os
+import pickle
+import socket
+import socketserver
+import struct
+import time
+import uuid
+from threading import Event, Lock, Thread, local
+from typing import Dict, List, Optional, Tuple
+
+from admission import RateLimiter, RequestLimits
+from events import sse_stream
+from metrics import REGISTRY
+from programs import ProgramScheduler
+from rpi_interface import Mode, RpiState, state_value
+from snapshot import SnapshotReader
+from units import UnitRegistry
+
+# Message length prefix, messages are pickled tuples exchanged between processes of the same server
+_LENGTH = struct.Struct('!I')
+
+# Unit methods workers may call in the poller process
+WRITE_METHODS = frozenset(('set_feed_temperature', 'set_hysteresis', 'set_mode', 'set_valve_activated',
+                           'open_valve', 'close_valve'))
+
+# Program scheduler methods workers may call in the poller process
+PROGRAM_METHODS = frozenset(('list', 'add', 'remove'))
+
+
+class RemoteError(Exception):
+    """
+    Exception raised in the poller process, keeps its HTTP status and retry delay
+    """
+
+    def __init__(self, message: str, status: int = 500, retry_after: float = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def _send(sock: socket.socket, message):
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+
+def _receive(sock: socket.socket):
+    header = _receive_exactly(sock, _LENGTH.size)
+    if header is None:
+        return None
+    return pickle.loads(_receive_exactly(sock, _LENGTH.unpack(header)[0]))
+
+
+def _receive_exactly(sock: socket.socket, size: int) -> Optional[bytes]:
+    chunks = bytearray()
+    while len(chunks) < size:
+        chunk = sock.recv(size - len(chunks))
+        if not chunk:
+            return None
+        chunks += chunk
+    return bytes(chunks)
+
+
+class SnapshotServer:
+    """
+    Runs the writes, long-polls and history queries the request workers forward to the poller process
+    over a local socket, the workers read the unit states from the shared snapshot file instead
+    """
+
+    def __init__(self, path: str, units: UnitRegistry, programs: ProgramScheduler = None,
+                 limits: RequestLimits = None):
+        """
+        :param path: unix socket path
+        :param units: polled units
+        :param programs: scheduled programs, None if disabled
+        :param limits: client rate limits shared by every worker, None if disabled
+        """
+        self.path = path
+        self.units = units
+        self.programs = programs
+        self.limits = limits
+        # Worker ID to the last metrics exported by the worker, kept after the worker exits so the sums never decrease
+        self._worker_metrics = {}
+        self._metrics_lock = Lock()
+        if os.path.exists(path):
+            os.unlink(path)
+        server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    message = _receive(self.request)
+                    if message is None:
+                        return
+                    _send(self.request, server.dispatch(*message))
+
+        self._server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        self._server.daemon_threads = True
+
+    def start(self):
+        Thread(daemon=True, target=self._server.serve_forever, name='poller-channel').start()
+
+    def dispatch(self, operation: str, unit: str = None, *args) -> tuple:
+        """
+        Runs a forwarded operation
+        :param operation: operation name
+        :param unit: unit name
+        :param args: operation arguments
+        :return: ("ok", result) or ("error", message, status, retry after)
+        """
+        try:
+            return 'ok', self._run(operation, unit, *args)
+        except Exception as e:
+            return 'error', str(e), getattr(e, 'status', 500), getattr(e, 'retry_after', None)
+
+    def _run(self, operation: str, name: str, *args):
+        if operation == 'units':
+            return list(self.units)
+        if operation == 'metrics':
+            worker, exported, render = args
+            with self._metrics_lock:
+                self._worker_metrics[worker] = exported
+                workers = list(self._worker_metrics.values())
+            return REGISTRY.render(extra=workers) if render else None
+        if operation == 'limit':
+            kind, key = args
+            if self.limits is None or kind not in ('reads', 'writes'):
+                raise RemoteError(f'Unknown limit {kind}', 400)
+            return getattr(self.limits, kind).take(key)
+        if operation == 'programs':
+            method, method_args = args[0], args[1:]
+            if self.programs is None:
+                raise Exception('Programs are disabled')
+            if method not in PROGRAM_METHODS:
+                raise RemoteError(f'Unknown programs operation {method}', 400)
+            return getattr(self.programs, method)(*method_args)
+        unit = self.units.get(name)
+        if unit is None:
+            raise RemoteError(f'Unknown unit {name}', 404)
+        if operation == 'write':
+            method, method_args = args
+            if method not in WRITE_METHODS:
+                raise RemoteError(f'Unknown write {method}', 400)
+            return getattr(unit, method)(*method_args)
+        if operation == 'batch':
+            writes = args[0]
+            for method, _ in writes:
+                if method not in WRITE_METHODS:
+                    raise RemoteError(f'Unknown write {method}', 400)
+            return [('error', str(result), getattr(result, 'status', 500), getattr(result, 'retry_after', None))
+                    if isinstance(result, Exception) else ('ok', result) for result in unit.write_batch(writes)]
+        if operation == 'changes':
+            return unit.events.changes(*args)
+        if operation == 'history':
+            if unit.history is None:
+                raise Exception('History is disabled')
+            return unit.history.query(*args)
+        if operation == 'archive':
+            if unit.archive is None:
+                raise Exception('Archive is disabled')
+            return [bytes(records) for records in unit.archive.read(*args)]
+        raise RemoteError(f'Unknown operation {operation}', 400)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class SnapshotClient:
+    """
+    Worker side of the poller process channel, keeps one connection per thread
+    """
+
+    def __init__(self, path: str, connect_timeout: float = 30, reconnect_timeout: float = 3):
+        """
+        :param path: unix socket path
+        :param connect_timeout: how long to wait for the poller process to start listening in seconds
+        :param reconnect_timeout: how long to wait for it once it was reachable, e.g. while it restarts, in seconds
+        """
+        self.path = path
+        self.connect_timeout = connect_timeout
+        self.reconnect_timeout = reconnect_timeout
+        self._connected = False
+        self._local = local()
+
+    def _connect(self) -> socket.socket:
+        deadline = time.monotonic() + (self.reconnect_timeout if self._connected else self.connect_timeout)
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                self._connected = True
+                return sock
+            except OSError:
+                sock.close()
+                if time.monotonic() >= deadline:
+                    raise RemoteError('Poller process is not available', 503, 1)
+                time.sleep(.1)
+
+    def call(self, operation: str, unit: str = None, *args):
+        """
+        Runs an operation in the poller process
+        :param operation: operation name
+        :param unit: unit name
+        :param args: operation arguments
+        :return: operation result
+        """
+        for attempt in range(2):
+            sock = getattr(self._local, 'sock', None)
+            if sock is None:
+                sock = self._local.sock = self._connect()
+            try:
+                _send(sock, (operation, unit, *args))
+                reply = _receive(sock)
+                if reply is None:
+                    raise ConnectionError('Poller process closed the connection')
+                break
+            except OSError:
+                sock.close()
+                self._local.sock = None
+                if attempt:
+                    raise
+        if reply[0] == 'error':
+            raise RemoteError(*reply[1:])
+        return reply[1]
+
+
+class RemoteEvents:
+    """
+    StateEvents compatible view of the events of a unit in the poller process
+    """
+
+    def __init__(self, client: SnapshotClient, unit: str):
+        self._client = client
+        self._unit = unit
+
+    def changes(self, since: int = None, timeout: float = 0) -> Tuple[int, Optional[List[tuple]], dict]:
+        return self._client.call('changes', self._unit, since, timeout)
+
+    def stream(self, since: int = None, heartbeat: float = 15):
+        return sse_stream(self.changes, since, heartbeat)
+
+
+class RemoteHistory:
+    def __init__(self, client: SnapshotClient, unit: str):
+        self._client = client
+        self._unit = unit
+
+    def query(self, start: float, end: float, series=None, resolution: int = None) -> dict:
+        return self._client.call('history', self._unit, start, end, list(series) if series is not None else None,
+                                 resolution)
+
+
+class RemoteArchive:
+    def __init__(self, client: SnapshotClient, unit: str):
+        self._client = client
+        self._unit = unit
+
+    def read(self, start: float, end: float) -> List[bytes]:
+        return self._client.call('archive', self._unit, start, end)
+
+
+class RemotePrograms:
+    """
+    ProgramScheduler compatible view of the programs run in the poller process
+    """
+
+    def __init__(self, client: SnapshotClient):
+        self._client = client
+
+    def list(self, unit: str = None) -> List[dict]:
+        return self._client.call('programs', None, 'list', unit)
+
+    def add(self, unit: str, days: List[int], at: str, write: str, args: list) -> dict:
+        return self._client.call('programs', None, 'add', unit, list(days), at, write, list(args))
+
+    def remove(self, entry_id: str) -> bool:
+        return self._client.call('programs', None, 'remove', entry_id)
+
+
+class RemoteRateLimiter:
+    """
+    RateLimiter compatible view of buckets kept in the poller process, so a client gets the same limit
+    whichever worker its connection lands on. The worker's own buckets are used while the poller process
+    is not reachable
+    """
+
+    def __init__(self, client: SnapshotClient, kind: str, fallback: RateLimiter):
+        """
+        :param client: poller process channel client, which should not wait for the poller process to come back
+        :param kind: "reads" or "writes"
+        :param fallback: local buckets
+        """
+        self._client = client
+        self._kind = kind
+        self._fallback = fallback
+
+    def take(self, key) -> float:
+        try:
+            return self._client.call('limit', None, self._kind, key)
+        except Exception:
+            return self._fallback.take(key)
+
+
+def remote_limits(path: str, limits: RequestLimits) -> RequestLimits:
+    """
+    Makes request limits take from the buckets of the poller process
+    :param path: poller process channel unix socket path
+    :param limits: limits of the worker, their own buckets are the fallback
+    :return: the limits
+    """
+    # A request is not held up waiting for a restarting poller process, its own buckets are used meanwhile
+    client = SnapshotClient(path, connect_timeout=0, reconnect_timeout=0)
+    limits.reads = RemoteRateLimiter(client, 'reads', limits.reads)
+    limits.writes = RemoteRateLimiter(client, 'writes', limits.writes)
+    return limits
+
+
+class WorkerMetrics:
+    """
+    Sends the metrics a request worker records to the poller process, which exposes them summed over every worker,
+    so a scrape reports the same counters whichever worker it reaches
+    """
+
+    def __init__(self, client: SnapshotClient, interval: float = 15):
+        """
+        :param client: poller process channel client
+        :param interval: how often the metrics are sent in seconds, they are also sent when a worker is scraped
+        """
+        self.interval = interval
+        # A restarted worker may get the PID of an exited one, whose totals must be kept
+        self.worker = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self._client = client
+        self._stopping = Event()
+
+    def start(self):
+        Thread(daemon=True, target=self._run, name='worker-metrics').start()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self._client.call('metrics', None, self.worker, REGISTRY.export(), False)
+            except Exception as e:
+                logging.getLogger(__name__).warning(f'Sending worker metrics failed: {e}')
+
+    def render(self) -> str:
+        """
+        Renders the metrics of the poller process and of every worker
+        :return: Prometheus text exposition
+        """
+        return self._client.call('metrics', None, self.worker, REGISTRY.export(), True)
+
+    def stop(self):
+        self._stopping.set()
+
+
+class RemoteHvacRpi:
+    """
+    HvacRpi compatible view of a unit polled in another process. Reads come from the shared snapshot file,
+    writes, long-polls and history queries are forwarded to the poller process
+    """
+
+    def __init__(self, client: SnapshotClient, snapshots: SnapshotReader, name: str):
+        """
+        :param client: poller process channel client
+        :param snapshots: shared unit snapshots
+        :param name: unit name
+        """
+        self.name = name
+        self.on_wake = None
+        self.events = RemoteEvents(client, name)
+        self.history = RemoteHistory(client, name)
+        self.archive = RemoteArchive(client, name)
+        self._client = client
+        self._snapshots = snapshots
+
+    def _write(self, method: str, *args) -> bool:
+        return self._client.call('write', self.name, method, args)
+
+    def write_batch(self, writes: List[Tuple[str, tuple]]) -> list:
+        return [outcome[1] if outcome[0] == 'ok' else RemoteError(*outcome[1:])
+                for outcome in self._client.call('batch', self.name, writes)]
+
+    def get_full_state(self) -> RpiState:
+        return self._snapshots.read(self.name)[0]
+
+    def get_last_modified(self) -> float:
+        return self._snapshots.read(self.name)[1]
+
+    def get_state_age(self) -> Optional[float]:
+        refreshed_at = self._snapshots.read(self.name)[2]
+        return max(time.time() - refreshed_at, 0.) if refreshed_at is not None else None
+
+    def is_stale(self) -> bool:
+        return self._snapshots.read(self.name)[3]
+
+    def _get_param_value(self, param_name: str, num: int = None):
+        return state_value(self.get_full_state(), param_name, num)
+
+    def get_he_temperature(self, number: int) -> float:
+        return self._get_param_value('he_temperatures', number)
+
+    def get_outside_temperature(self) -> float:
+        return self._get_param_value('outside_temperature')
+
+    def get_inside_temperature(self) -> float:
+        return self._get_param_value('inside_temperature')
+
+    def get_valve_opened(self, number: int) -> bool:
+        return self._get_param_value('valves_states', number)
+
+    def get_feed_temperature(self) -> float:
+        return self._get_param_value('feed_temperature')
+
+    def get_hysteresis(self) -> float:
+        return self._get_param_value('hysteresis')
+
+    def get_mode(self) -> Mode:
+        return self._get_param_value('mode')
+
+    def get_valve_activated(self, number) -> bool:
+        return self._get_param_value('valves_activated_states', number)
+
+    def set_feed_temperature(self, temperature) -> bool:
+        return self._write('set_feed_temperature', temperature)
+
+    def set_hysteresis(self, hysteresis) -> bool:
+        return self._write('set_hysteresis', hysteresis)
+
+    def set_mode(self, mode: Mode) -> bool:
+        return self._write('set_mode', Mode(mode))
+
+    def set_valve_activated(self, number, activated) -> bool:
+        return self._write('set_valve_activated', number, activated)
+
+    def open_valve(self, number: int):
+        return self._write('open_valve', number)
+
+    def close_valve(self, number: int):
+        return self._write('close_valve', number)
+
+
+def remote_units(client: SnapshotClient, snapshots: SnapshotReader) -> Dict[str, RemoteHvacRpi]:
+    """
+    Gets views of every unit polled in the poller process
+    :param client: poller process channel client
+    :param snapshots: shared unit snapshots
+    :return: unit name to unit view
+    """
+    return {name: RemoteHvacRpi(client, snapshots, name) for name in client.call('units')}
@@ -1,16 +1,20 @@
-import base64
+import json
 import os
+import time
 import hashlib
-import dataclasses
 import functools
 from enum import Enum
 
 from dotenv import load_dotenv
-from flask import request, make_response, Response
-from flask_restful import Resource, reqparse
-from flask_basic_roles import BasicRoleAuth
-
-from rpi_interface import Mode as OpMode
+from flask import current_app, g, request, make_response, Response, stream_with_context
+from flask_restful import Resource, reqparse, abort
+from analytics import load_records, compute_stats
+from archive import RECORD
+from authentication import RoleAuth
+from encoding import COMPRESSIBLE, ENCODINGS, JSON, MIMETYPES, MIN_COMPRESS_SIZE, compress, encode
+from metrics import REGISTRY, Counter, Histogram
+from programs import program_args
+from rpi_interface import Mode as OpMode, RpiState, state_value, write_target
 
 load_dotenv()
 
@@ -24,7 +28,7 @@ su_password = os.getenv('SU_PASSWORD')
 su_username_hash = f'{hashlib.md5(os.getenv("SU_USERNAME").encode("utf-8")).hexdigest()}'
 su_password_hash = f'{hashlib.md5(os.getenv("SU_PASSWORD").encode("utf-8")).hexdigest()}'
 
-auth = BasicRoleAuth()
+auth = RoleAuth()
 auth.add_user(user=basic_username, password=basic_password, roles='user')
 auth.add_user(user=basic_username_hash, password=basic_password_hash, roles='user')
 auth.add_user(user=su_username, password=su_password, roles='superuser')
@@ -61,6 +65,87 @@ def cross_origin(origin="*"):
     return cross_origin
 
 
+REQUESTS = Counter('hvac_http_requests_total', 'HTTP requests by resource', ('resource', 'method', 'status'))
+REQUEST_LATENCY = Histogram('hvac_http_request_duration_seconds', 'HTTP request latency by resource',
+                            ('resource', 'method'))
+
+
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+def observe_request(response: Response) -> Response:
+    """
+    Records the request count and latency of the resource class which served a request
+    :param response: Flask response
+    :return: Flask response
+    """
+    started = g.pop('request_started', None)
+    if started is not None:
+        view = current_app.view_functions.get(request.endpoint)
+        resource = getattr(getattr(view, 'view_class', None), '__name__', request.endpoint or 'unmatched')
+        REQUEST_LATENCY.labels(resource, request.method).observe(time.perf_counter() - started)
+        REQUESTS.labels(resource, request.method, str(response.status_code)).inc()
+    return response
+
+
+def negotiate_mimetype() -> str:
+    return request.accept_mimetypes.best_match(MIMETYPES, default=JSON)
+
+
+def negotiate_encoding() -> str:
+    return request.accept_encodings.best_match(ENCODINGS, default='identity')
+
+
+def representation(mimetype: str):
+    """
+    Gets a Flask-RESTful representation serializing resource results to a media type
+    :param mimetype: one of MIMETYPES
+    :return: representation function
+    """
+
+    def output(data, code, headers=None):
+        response = make_response(encode(data, mimetype), code)
+        response.headers.extend(headers or {})
+        response.mimetype = mimetype
+        return response
+
+    return vary_accept(output)
+
+
+def vary_accept(output):
+    """
+    Wraps a Flask-RESTful representation, so caches keep the representations of a resource apart
+    :param output: representation function
+    :return: representation function
+    """
+
+    def wrapper(data, code, headers=None):
+        response = output(data, code, headers)
+        response.vary.add('Accept')
+        return response
+
+    return wrapper
+
+
+def compress_response(response: Response) -> Response:
+    """
+    Compresses buffered responses with the content coding the client prefers
+    :param response: Flask response
+    :return: Flask response
+    """
+    if response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers \
+            or response.mimetype not in COMPRESSIBLE or response.status_code in (204, 304):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if encoding == 'identity' or len(response.get_data()) < MIN_COMPRESS_SIZE:
+        return response
+    response.set_data(compress(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
 def catch_error(func):
     """
     Error catching decorator
@@ -72,15 +157,53 @@ def catch_error(func):
         try:
             return func(*args, **kwargs)
         except Exception as e:
-            error, status = e, 500
+            error, status = e, getattr(e, 'status', 500)
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            return str(error), status, {'Retry-After': str(max(int(retry_after + .5), 1))}
         return str(error), status
 
     return wrapper
 
 
-class TemperatureHe(Resource):
+class HvacResource(Resource):
+    """
+    Resource of a single unit. Routes with a "unit" variable are served by that unit, the rest by the default one
+    """
     hvac = None
+    units = None
+    # Whether GET responses are marked with the age and staleness of the unit state
+    serves_state = True
+
+    def dispatch_request(self, *args, **kwargs):
+        unit = kwargs.pop('unit', None)
+        if unit is not None:
+            hvac = self.units.get(unit) if self.units is not None else None
+            if hvac is None:
+                abort(404, message=f'Unknown unit {unit}')
+            self.hvac = hvac
+        if self.serves_state and request.method == 'GET':
+            g.state_unit = self.hvac
+        return super().dispatch_request(*args, **kwargs)
+
+
+def add_state_headers(response: Response) -> Response:
+    """
+    Marks a response served from a unit state with the state age and, while the RPi is failing, as stale
+    :param response: Flask response
+    :return: Flask response
+    """
+    hvac = g.pop('state_unit', None)
+    if hvac is not None:
+        age = hvac.get_state_age()
+        if age is not None:
+            response.headers['Age'] = str(int(age))
+        if hvac.is_stale():
+            response.headers['X-State-Stale'] = 'true'
+    return response
+
 
+class TemperatureHe(HvacResource):
     @catch_error
     @cross_origin()
     @auth.require(roles=('user', 'superuser'))
@@ -88,9 +211,7 @@ class TemperatureHe(Resource):
         return self.hvac.get_he_temperature(number)
 
 
-class TemperatureOutside(Resource):
-    hvac = None
-
+class TemperatureOutside(HvacResource):
     @catch_error
     @cross_origin()
     @auth.require(roles=('user', 'superuser'))
@@ -98,9 +219,7 @@ class TemperatureOutside(Resource):
         return self.hvac.get_outside_temperature()
 
 
-class TemperatureInside(Resource):
-    hvac = None
-
+class TemperatureInside(HvacResource):
     @catch_error
     @cross_origin()
     @auth.require(roles=('user', 'superuser'))
@@ -108,9 +227,7 @@ class TemperatureInside(Resource):
         return self.hvac.get_inside_temperature()
 
 
-class TemperatureFeed(Resource):
-    hvac = None
-
+class TemperatureFeed(HvacResource):
     @catch_error
     @cross_origin()
     @auth.require(roles=('user', 'superuser'))
@@ -127,9 +244,7 @@ class TemperatureFeed(Resource):
         return self.hvac.set_feed_temperature(args.value)
 
 
-class Hysteresis(Resource):
-    hvac = None
-
+class Hysteresis(HvacResource):
     @catch_error
     @cross_origin()
     @auth.require(roles=('user', 'superuser'))
@@ -146,9 +261,7 @@ class Hysteresis(Resource):
         return self.hvac.set_hysteresis(args.value)
 
 
-class Mode(Resource):
-    hvac = None
-
+class Mode(HvacResource):
     @catch_error
     @cross_origin()
     @auth.require(roles=('user', 'superuser'))
@@ -171,9 +284,7 @@ class ValveAction(Enum):
     close = 'close'
 
 
-class Valve(Resource):
-    hvac = None
-
+class Valve(HvacResource):
     @catch_error
     @cross_origin()
     @auth.require(roles=('user', 'superuser'))
@@ -196,9 +307,7 @@ class Valve(Resource):
             raise Exception(f'Incorrect action name {args.action.value}')
 
 
-class ValveActivated(Resource):
-    hvac = None
-
+class ValveActivated(HvacResource):
     @catch_error
     @cross_origin()
     @auth.require(roles=('user', 'superuser'))
@@ -215,14 +324,185 @@ class ValveActivated(Resource):
         return self.hvac.set_valve_activated(number, args.value)
 
 
-class FullState(Resource):
-    hvac = None
-
+class FullState(HvacResource):
     @catch_error
     @cross_origin()
     @auth.require(roles=('user', 'superuser'))
     def get(self):
-        return dataclasses.asdict(self.hvac.get_full_state())
+        state = self.hvac.get_full_state()
+        mimetype, encoding = negotiate_mimetype(), negotiate_encoding()
+        response = Response(state.encoded(mimetype, encoding), mimetype=mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.vary.update(('Accept', 'Accept-Encoding'))
+        # Every representation has its own entity tag, the JSON one stays the bare state hash
+        variant = '' if (mimetype, encoding) == (JSON, 'identity') else f'-{mimetype.rpartition("/")[2]}-{encoding}'
+        response.set_etag(state.etag() + variant)
+        response.last_modified = self.hvac.get_last_modified()
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+
+class RequestError(Exception):
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
+
+# Batch resource name to the state field it reads
+BATCH_READS = {
+    'temperatureHe': 'he_temperatures',
+    'temperatureFeed': 'feed_temperature',
+    'hysteresis': 'hysteresis',
+    'mode': 'mode',
+    'valve': 'valves_states',
+    'valveActivated': 'valves_activated_states',
+}
+
+
+def _json_bool(value) -> bool:
+    # bool() would take the strings "false" and "0" for True
+    if not isinstance(value, bool):
+        raise RequestError(f'Value has to be true or false, not {json.dumps(value)}', 400)
+    return value
+
+
+def _valve_write(item: dict) -> tuple:
+    action = ValveAction(item.get('action'))
+    return 'open_valve' if action == ValveAction.open else 'close_valve', (item.get('number'),)
+
+
+# Batch resource name to (roles allowed to write, write method names, item to (write method name, arguments)),
+# items take the same arguments as the POST of the resource
+BATCH_WRITES = {
+    'temperatureFeed': (('user', 'superuser'), ('set_feed_temperature',),
+                        lambda item: ('set_feed_temperature', (float(item['value']),))),
+    'hysteresis': (('superuser',), ('set_hysteresis',), lambda item: ('set_hysteresis', (int(item['value']),))),
+    'mode': (('superuser',), ('set_mode',), lambda item: ('set_mode', (OpMode(item.get('type')),))),
+    'valve': (('superuser',), ('open_valve', 'close_valve'), _valve_write),
+    'valveActivated': (('superuser',), ('set_valve_activated',),
+                       lambda item: ('set_valve_activated', (item.get('number'), _json_bool(item['value'])))),
+}
+
+# Write method name to the roles allowed to run it
+WRITE_ROLES = {method: allowed for allowed, methods, _ in BATCH_WRITES.values() for method in methods}
+
+
+class Batch(HvacResource):
+    """
+    Several reads and writes in one request, e.g.
+    [{"resource": "temperatureHe", "number": 1}, {"resource": "valve", "number": 2, "action": "open"}].
+    Items with a write argument ("value", "type" or "action") are writes. All reads are served from one state
+    snapshot taken before the writes, which are queued together. Every item gets its own status
+    """
+    serves_state = False
+
+    @staticmethod
+    def is_write(item: dict) -> bool:
+        return any(argument in item for argument in ('value', 'type', 'action'))
+
+    @classmethod
+    def reads_only(cls) -> bool:
+        """
+        Tells whether the current request is a batch of reads, which is rate limited as a read
+        """
+        items = request.get_json(force=True, silent=True)
+        return isinstance(items, list) and all(isinstance(item, dict) and not cls.is_write(item) for item in items)
+
+    @catch_error
+    @cross_origin()
+    @auth.require(roles=('user', 'superuser'))
+    def post(self):
+        items = request.get_json(force=True, silent=True)
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise RequestError('Batch has to be a list of objects', 400)
+        roles = auth.current_user()[1]
+        state = None
+        results = [None] * len(items)
+        writes, write_indices = [], []
+        for index, item in enumerate(items):
+            resource = item.get('resource')
+            try:
+                if self.is_write(item):
+                    if resource not in BATCH_WRITES:
+                        raise RequestError(f'{resource} can not be written', 400)
+                    allowed, _, to_write = BATCH_WRITES[resource]
+                    if not roles & set(allowed):
+                        raise RequestError('You do not have access to this resource', 403)
+                    write = to_write(item)
+                    write_target(*write)
+                    writes.append(write)
+                    write_indices.append(index)
+                    continue
+                if resource not in BATCH_READS:
+                    raise RequestError(f'{resource} can not be read', 400)
+                if state is None:
+                    state = self.hvac.get_full_state()
+                value = state_value(state, BATCH_READS[resource], item.get('number'))
+                results[index] = {'status': 200, 'value': value.value if isinstance(value, OpMode) else value}
+            except Exception as e:
+                results[index] = {'status': getattr(e, 'status', 400), 'error': str(e)}
+        for index, result in zip(write_indices, self.hvac.write_batch(writes) if writes else ()):
+            results[index] = {'status': getattr(result, 'status', 500), 'error': str(result)} \
+                if isinstance(result, Exception) else {'status': 200, 'value': result}
+        return results
+
+
+class Programs(HvacResource):
+    """
+    Weekly programs of the unit, an entry is a batch write item with "days" (0-6, Monday-Sunday)
+    and a "time" ("HH:MM") in the time zone of the scheduler,
+    e.g. {"days": [0, 1, 2, 3, 4], "time": "06:00", "resource": "mode", "type": "autoWinter"}
+    """
+    serves_state = False
+    # Program scheduler, or its view in the poller process, None when disabled
+    scheduler = None
+
+    def _scheduler(self):
+        if self.scheduler is None:
+            raise Exception('Programs are disabled')
+        return self.scheduler
+
+    @catch_error
+    @cross_origin()
+    @auth.require(roles=('user', 'superuser'))
+    def get(self, program_id=None):
+        entries = self._scheduler().list(self.hvac.name)
+        if program_id is None:
+            return entries
+        for entry in entries:
+            if entry['id'] == program_id:
+                return entry
+        raise RequestError(f'Unknown program {program_id}', 404)
+
+    @catch_error
+    @cross_origin()
+    @auth.require(roles=('user', 'superuser'))
+    def post(self, program_id=None):
+        item = request.get_json(force=True, silent=True)
+        if not isinstance(item, dict) or item.get('resource') not in BATCH_WRITES:
+            raise RequestError(f'Program entry has to be a write of {", ".join(BATCH_WRITES)}', 400)
+        allowed, _, to_write = BATCH_WRITES[item['resource']]
+        if not auth.current_user()[1] & set(allowed):
+            raise RequestError('You do not have access to this resource', 403)
+        try:
+            write, args = to_write(item)
+        except Exception as e:
+            raise RequestError(f'Invalid program entry: {e}', 400)
+        return self._scheduler().add(self.hvac.name, item.get('days', range(7)), str(item.get('time')), write,
+                                     program_args(args)), 201
+
+    @catch_error
+    @cross_origin()
+    @auth.require(roles=('user', 'superuser'))
+    def delete(self, program_id=None):
+        entry = next((entry for entry in self._scheduler().list(self.hvac.name) if entry['id'] == program_id), None)
+        if entry is None:
+            raise RequestError(f'Unknown program {program_id}', 404)
+        # Entries are removed by the roles allowed to add them
+        if not auth.current_user()[1] & set(WRITE_ROLES.get(entry['write'], ('superuser',))):
+            raise RequestError('You do not have access to this resource', 403)
+        return self._scheduler().remove(program_id)
 
 
 class SuAccess(Resource):
@@ -230,8 +510,177 @@ class SuAccess(Resource):
     @cross_origin()
     @auth.require(roles=('user', 'superuser'))
     def get():
-        token = request.headers['Authorization']
-        username, password = base64.b64decode(token.split('Basic ')[-1]).decode('utf-8').split(':')
-        if username in [su_username, su_username_hash]:
-            return True
-        return False
+        return 'superuser' in auth.current_user()[1]
+
+
+class Events(HvacResource):
+    @catch_error
+    @cross_origin()
+    @auth.require(roles=('user', 'superuser'))
+    def get(self):
+        since = request.headers.get('Last-Event-ID', request.args.get('since'))
+        since = int(since) if since is not None else None
+        response = Response(stream_with_context(self.hvac.events.stream(since)), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class Changes(HvacResource):
+    @catch_error
+    @cross_origin()
+    @auth.require(roles=('user', 'superuser'))
+    def get(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('since', type=int, location='args', help='Last seen sequence number')
+        parser.add_argument('wait', type=float, default=25, location='args', help='Long-poll timeout in seconds')
+        args = parser.parse_args()
+        sequence, events, state = self.hvac.events.changes(args.since, min(max(args.wait, 0), 60))
+        if events is None:
+            return {'sequence': sequence, 'state': state}
+        return {'sequence': sequence, 'changes': [{'sequence': event_sequence, 'event': event, 'data': data}
+                                                  for event_sequence, event, data in events]}
+
+
+class History(HvacResource):
+    serves_state = False
+
+    @catch_error
+    @cross_origin()
+    @auth.require(roles=('user', 'superuser'))
+    def get(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('start', type=float, location='args', help='Range start UNIX timestamp')
+        parser.add_argument('end', type=float, location='args', help='Range end UNIX timestamp')
+        parser.add_argument('series', type=str, location='args', help='Comma separated series names')
+        parser.add_argument('resolution', type=int, location='args', help='Resolution in seconds, 0 for raw samples')
+        args = parser.parse_args()
+        if self.hvac.history is None:
+            raise Exception('History is disabled')
+        end = args.end if args.end is not None else time.time()
+        start = args.start if args.start is not None else end - 86400
+        series = args.series.split(',') if args.series else None
+        return self.hvac.history.query(start, end, series, args.resolution)
+
+
+# Bytes copied out of the memory-mapped archive per response chunk
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+
+
+def _archive_chunks(records: list):
+    """
+    Copies memory-mapped record slices into bytes chunks, WSGI servers only accept bytes
+    :param records: record slices
+    """
+    for view in records:
+        for offset in range(0, len(view), ARCHIVE_CHUNK_SIZE):
+            yield bytes(view[offset:offset + ARCHIVE_CHUNK_SIZE])
+
+
+class Archive(HvacResource):
+    serves_state = False
+
+    @catch_error
+    @cross_origin()
+    @auth.require(roles=('user', 'superuser'))
+    def get(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('start', type=float, location='args', help='Range start UNIX timestamp')
+        parser.add_argument('end', type=float, location='args', help='Range end UNIX timestamp')
+        args = parser.parse_args()
+        if self.hvac.archive is None:
+            raise Exception('Archive is disabled')
+        end = args.end if args.end is not None else time.time()
+        start = args.start if args.start is not None else end - 86400
+        records = self.hvac.archive.read(start, end)
+        response = Response(_archive_chunks(records), mimetype='application/octet-stream')
+        response.headers['Content-Length'] = str(sum(len(chunk) for chunk in records))
+        response.headers['X-Record-Format'] = RECORD.format
+        return response
+
+
+class Stats(HvacResource):
+    serves_state = False
+
+    @catch_error
+    @cross_origin()
+    @auth.require(roles=('user', 'superuser'))
+    def get(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('start', type=float, location='args', help='Range start UNIX timestamp')
+        parser.add_argument('end', type=float, location='args', help='Range end UNIX timestamp')
+        parser.add_argument('base', type=float, location='args', default=15.5,
+                            help='Heating degree-days base temperature')
+        parser.add_argument('setpoint', type=float, location='args', help='Feed temperature setpoint')
+        args = parser.parse_args()
+        if self.hvac.archive is None:
+            raise Exception('Archive is disabled')
+        end = args.end if args.end is not None else time.time()
+        start = args.start if args.start is not None else end - 7 * 86400
+        records = load_records(self.hvac.archive, start, end)
+        return compute_stats(records, end, args.base, args.setpoint)
+
+
+class UnitsFullState(HvacResource):
+    serves_state = False
+    # Unit states last served and their bodies by (media type, content coding), encoded once until a state changes
+    _cache = ((), {})
+
+    @classmethod
+    def _bodies(cls, states: tuple) -> dict:
+        cached_states, bodies = cls._cache
+        if len(cached_states) != len(states) or \
+                not all(name == cached_name and state is cached_state
+                        for (name, state), (cached_name, cached_state) in zip(states, cached_states)):
+            bodies = {}
+            cls._cache = (states, bodies)
+        return bodies
+
+    @staticmethod
+    def _encode(states: tuple, mimetype: str) -> bytes:
+        if mimetype != JSON:
+            return encode({name: state.as_dict() if isinstance(state, RpiState) else {'error': str(state)}
+                           for name, state in states}, mimetype)
+        parts = []
+        for name, state in states:
+            encoded = state.as_json() if isinstance(state, RpiState) else \
+                json.dumps({'error': str(state)}).encode('utf-8')
+            parts.append(json.dumps(name).encode('utf-8') + b':' + encoded)
+        return b'{' + b','.join(parts) + b'}'
+
+    @catch_error
+    @cross_origin()
+    @auth.require(roles=('user', 'superuser'))
+    def get(self):
+        stale = [name for name in self.units if self.units.get(name).is_stale()]
+        states = tuple(self.units.full_states().items())
+        mimetype, encoding = negotiate_mimetype(), negotiate_encoding()
+        bodies = self._bodies(states)
+        body = bodies.get((mimetype, encoding))
+        if body is None:
+            body = bodies.get((mimetype, 'identity'))
+            if body is None:
+                body = bodies[(mimetype, 'identity')] = self._encode(states, mimetype)
+            if encoding != 'identity':
+                body = bodies[(mimetype, encoding)] = compress(body, encoding)
+        response = Response(body, mimetype=mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.vary.update(('Accept', 'Accept-Encoding'))
+        response.cache_control.no_cache = True
+        if stale:
+            response.headers['X-Stale-Units'] = ','.join(stale)
+        return response
+
+
+class Metrics(Resource):
+    # Worker metrics sender rendering the metrics summed over every worker in the poller process,
+    # None when the units are polled in-process
+    remote = None
+
+    @catch_error
+    @cross_origin()
+    @auth.require(roles=('user', 'superuser'))
+    def get(self):
+        text = REGISTRY.render() if self.remote is None else self.remote.render()
+        return Response(text, content_type=REGISTRY.content_type)
@@ -1,7 +1,15 @@
 import os
+import json
+import hashlib
 import time
-from threading import Thread, Lock
-from typing import Callable
+import logging
+import dataclasses
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from threading import Thread, Lock, Event, Condition
+from operator import attrgetter
+from typing import Callable, Iterable, List, Set, Tuple
 from dataclasses import dataclass
 
 import requests
@@ -9,11 +17,51 @@ import enum
 
 from dotenv import load_dotenv
 
+from encoding import JSON, compress, encode
+from events import StateEvents
+from metrics import Counter, Histogram
+from polling import PollScheduler
+from singleflight import SingleFlight
+from transport import RpiTransport, CircuitOpenError, OverloadedError
+
 load_dotenv()
 
-RPI_HOST = host if 'http://' in (host := os.getenv('RPI_HOST')) else f'http://{host}'
+
+def hvac_url(host: str, name: str) -> str:
+    """
+    Builds the URL of an HVAC thing served by an RPi
+    :param host: RPi host with an optional port and scheme, e.g. "192.168.1.10:8080"
+    :param name: HVAC thing name
+    :return: HVAC URL
+    """
+    return f'{host if "://" in host else f"http://{host}"}/{name}'
+
+
+RPI_HOST = os.getenv('RPI_HOST')
 HVAC_NAME = os.getenv('HVAC_NAME')
-HVAC_URL = f'{RPI_HOST}/{HVAC_NAME}'
+HVAC_URL = hvac_url(RPI_HOST, HVAC_NAME) if RPI_HOST else None
+
+PROPERTY_NAMES = ('temperatureHe1', 'temperatureHe2', 'temperatureHe3', 'temperatureFeed', 'hysteresis',
+                  'temperatureOutside', 'temperatureInside', 'valveOpened1', 'valveOpened2', 'valveOpened3',
+                  'valveOpened4', 'valveActivated1', 'valveActivated2', 'valveActivated3', 'valveActivated4', 'mode')
+
+# RpiState field to the RPi properties it is built from
+FIELD_PROPERTIES = {
+    'he_temperatures': ('temperatureHe1', 'temperatureHe2', 'temperatureHe3'),
+    'feed_temperature': ('temperatureFeed',),
+    'hysteresis': ('hysteresis',),
+    'outside_temperature': ('temperatureOutside',),
+    'inside_temperature': ('temperatureInside',),
+    'valves_states': ('valveOpened1', 'valveOpened2', 'valveOpened3', 'valveOpened4'),
+    'valves_activated_states': ('valveActivated1', 'valveActivated2', 'valveActivated3', 'valveActivated4'),
+    'mode': ('mode',),
+}
+
+_default_transport = None
+_default_transport_lock = Lock()
+
+REFRESHES = Counter('hvac_refreshes_total', 'State refreshes from the RPi', ('unit', 'result'))
+LOCK_WAIT = Histogram('hvac_lock_wait_seconds', 'Time spent waiting for HvacRpi locks', ('unit', 'lock'))
 
 
 class Mode(enum.Enum):
@@ -22,319 +70,881 @@ class Mode(enum.Enum):
     AUTO_SUMMER = 'autoSummer'
 
 
-@dataclass
+@dataclass(frozen=True)
 class RpiState:
-    he_temperatures: list
+    """
+    Immutable RPi state snapshot. The serialized forms are computed once on creation
+    """
+    __slots__ = ('he_temperatures', 'feed_temperature', 'hysteresis', 'outside_temperature', 'inside_temperature',
+                 'valves_states', 'valves_activated_states', 'mode', '_dict', '_json', '_etag', '_encoded')
+
+    he_temperatures: tuple
     feed_temperature: float
     hysteresis: int
     outside_temperature: float
     inside_temperature: float
-    valves_states: list
-    valves_activated_states: list
-    mode: str
+    valves_states: tuple
+    valves_activated_states: tuple
+    mode: Mode
+
+    def __post_init__(self):
+        object.__setattr__(self, 'he_temperatures', tuple(self.he_temperatures))
+        object.__setattr__(self, 'valves_states', tuple(self.valves_states))
+        object.__setattr__(self, 'valves_activated_states', tuple(self.valves_activated_states))
+        object.__setattr__(self, 'mode', Mode(self.mode))
+        state_dict = {
+            'he_temperatures': list(self.he_temperatures),
+            'feed_temperature': self.feed_temperature,
+            'hysteresis': self.hysteresis,
+            'outside_temperature': self.outside_temperature,
+            'inside_temperature': self.inside_temperature,
+            'valves_states': list(self.valves_states),
+            'valves_activated_states': list(self.valves_activated_states),
+            'mode': self.mode.value,
+        }
+        object.__setattr__(self, '_dict', state_dict)
+        object.__setattr__(self, '_json', json.dumps(state_dict, separators=(',', ':')).encode('utf-8'))
+        object.__setattr__(self, '_etag', hashlib.sha1(self._json).hexdigest())
+        object.__setattr__(self, '_encoded', {(JSON, 'identity'): self._json})
+
+    def as_dict(self) -> dict:
+        """
+        Gets the serialized state, must not be modified
+        :return: JSON compatible state
+        """
+        return self._dict
+
+    def as_json(self) -> bytes:
+        """
+        Gets the JSON encoded state
+        :return: UTF-8 JSON bytes
+        """
+        return self._json
+
+    def encoded(self, mimetype: str = JSON, encoding: str = 'identity') -> bytes:
+        """
+        Gets the state in a wire format, every format is encoded once per state
+        :param mimetype: media type, one of encoding.MIMETYPES
+        :param encoding: content coding, one of encoding.ENCODINGS
+        :return: encoded state
+        """
+        body = self._encoded.get((mimetype, encoding))
+        if body is None:
+            body = self._encoded[(mimetype, encoding)] = compress(self.encoded(mimetype), encoding) \
+                if encoding != 'identity' else encode(self._dict, mimetype)
+        return body
+
+    def etag(self) -> str:
+        """
+        Gets the content hash of the JSON encoded state
+        :return: hex digest
+        """
+        return self._etag
+
+
+# Property name to (state field getter, number of items or None for scalars, item name)
+_ACCESSORS = {
+    'he_temperatures': (attrgetter('he_temperatures'), 3, 'Heat exchanger'),
+    'feed_temperature': (attrgetter('feed_temperature'), None, None),
+    'hysteresis': (attrgetter('hysteresis'), None, None),
+    'outside_temperature': (attrgetter('outside_temperature'), None, None),
+    'inside_temperature': (attrgetter('inside_temperature'), None, None),
+    'valves_states': (attrgetter('valves_states'), 4, 'Valve'),
+    'valves_activated_states': (attrgetter('valves_activated_states'), 4, 'Valve'),
+    'mode': (attrgetter('mode'), None, None),
+}
+
+
+# Write method name to a function of its arguments giving (RPi call, call arguments, state field, value, item number)
+_WRITES = {
+    'set_feed_temperature': lambda temperature: (set_feed_temperature, (temperature,), 'feed_temperature',
+                                                 temperature, None),
+    'set_hysteresis': lambda hysteresis: (set_hysteresis, (hysteresis,), 'hysteresis', hysteresis, None),
+    'set_mode': lambda mode: (set_mode, (Mode(mode),), 'mode', Mode(mode), None),
+    'set_valve_activated': lambda number, activated: (set_valve_activated, (number, activated),
+                                                      'valves_activated_states', bool(activated), number),
+    'open_valve': lambda number: (open_valve, (number,), 'valves_states', True, number),
+    'close_valve': lambda number: (close_valve, (number,), 'valves_states', False, number),
+}
+
+
+class CommandTimeoutError(Exception):
+    """
+    Raised when a write command got no result in time
+    """
+    status = 504
+
+    def __init__(self, timeout: float):
+        super().__init__(f'RPi write did not complete in {timeout:.0f} s')
+
+
+class _Command:
+    __slots__ = ('call', 'args', 'futures', 'ready_at')
+
+    def __init__(self, call: Callable, args: tuple, ready_at: float):
+        self.call = call
+        self.args = args
+        self.futures = []
+        self.ready_at = ready_at
+
+
+class CommandQueue:
+    """
+    Coalesces RPi write commands and dispatches them in submission order with limited concurrency.
+    A command submitted while another one with the same key is still queued replaces it,
+    the callers of both get the result of the command that was sent
+    """
+
+    def __init__(self, window: float = 0.05, max_in_flight: int = 2, timeout: float = 30):
+        """
+        :param window: coalescing window in seconds
+        :param max_in_flight: maximum number of commands sent at the same time
+        :param timeout: longest wait for a command result in seconds
+        """
+        self.timeout = timeout
+        self._window = window
+        self._max_in_flight = max_in_flight
+        self._queue = OrderedDict()
+        self._in_flight = set()
+        self._condition = Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='rpi-command')
+        self._dispatcher = None
+
+    def submit(self, key, call: Callable, *args) -> Future:
+        """
+        Queues a command
+        :param key: coalescing key, e.g. the written property
+        :param call: command callable
+        :param args: command arguments
+        :return: future with the command result
+        """
+        future = Future()
+        with self._condition:
+            command = self._queue.get(key)
+            if command is None:
+                command = self._queue[key] = _Command(call, args, time.monotonic() + self._window)
+            else:
+                command.call, command.args = call, args
+                self._queue.move_to_end(key)
+            command.futures.append(future)
+            if self._dispatcher is None:
+                self._dispatcher = Thread(daemon=True, target=self._dispatch, name='rpi-command-dispatcher')
+                self._dispatcher.start()
+            self._condition.notify_all()
+        return future
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                while True:
+                    timeout = None
+                    if self._queue and len(self._in_flight) < self._max_in_flight:
+                        key, command = next(iter(self._queue.items()))
+                        timeout = command.ready_at - time.monotonic()
+                        if key not in self._in_flight and timeout <= 0:
+                            break
+                        if key in self._in_flight:
+                            timeout = None
+                    self._condition.wait(timeout)
+                del self._queue[key]
+                self._in_flight.add(key)
+            try:
+                self._executor.submit(self._run, key, command)
+            except Exception as e:
+                # E.g. the executor was shut down with the interpreter, the callers must not wait forever
+                for future in command.futures:
+                    future.set_exception(e)
+                with self._condition:
+                    self._in_flight.discard(key)
+
+    def _run(self, key, command: _Command):
+        try:
+            result = command.call(*command.args)
+        except Exception as e:
+            for future in command.futures:
+                future.set_exception(e)
+        else:
+            for future in command.futures:
+                future.set_result(result)
+        finally:
+            with self._condition:
+                self._in_flight.discard(key)
+                self._condition.notify_all()
+
 
+class UnitState:
+    """
+    Served state of a unit: the refreshed RPi state with the pending optimistic writes applied, its change events,
+    listeners and staleness. Subclasses refresh it from the RPi and write to it
+    """
 
-class HvacRpi:
-    def __init__(self, log = None):
+    def __init__(self, log=None, scheduler: PollScheduler = None, history=None, archive=None, name: str = None,
+                 last_state=None):
         self._state = RpiState(
-            he_temperatures=[.0, .0, .0],
+            he_temperatures=(.0, .0, .0),
             feed_temperature=.0,
             hysteresis=0,
             outside_temperature=.0,
             inside_temperature=.0,
-            valves_states=[False, False, False, False],
-            valves_activated_states=[True, True, True, True],
+            valves_states=(False, False, False, False),
+            valves_activated_states=(True, True, True, True),
             mode=Mode.MANUAL
         )
         self._updater_thread = None
-        self._pr_lock = Lock()
+        self._state_lock = Lock()
+        self._pending_writes = {}
         self._last_refresh_timestamp = 0
-        self._update_after = 30
-        if log is not None:
-            self.log = log.info
-        else:
-            self.log = self.log
-
-    def _update_values(self):
-        with self._pr_lock:
-            self.log('Starting update')
-            self._state = get_all_states()
-            self.log('Update finished')
-
-    def _updater(self):
-        self.log('Starting thread')
-        while True:
-            self._update_values()
-            time.sleep(self._update_after)
-
-    def start_updater(self):
-        self.log('Requesting an update')
-        self._updater_thread = Thread(daemon=True, target=self._updater)
-        self._updater_thread.start()
+        self._refresh_failed = False
+        self._last_change_timestamp = time.time()
+        self._scheduler = scheduler if scheduler is not None else PollScheduler()
+        self.on_wake = None
+        self.name = name
+        self._metric_unit = name or 'default'
+        self._listeners = []
+        self._refresh_listeners = []
+        log = (log if log is not None else logging.getLogger(__name__)).info
+        self.log = log if name is None else lambda message: log(f'[{name}] {message}')
+        self.last_state = last_state
+        if last_state is not None:
+            self._warm_start(last_state)
+        self.events = StateEvents(self._state.as_dict())
+        self.events.on_subscribe = self._wake_updater
+        if self._scheduler.watchers is None:
+            self._scheduler.watchers = lambda: self.events.subscribers
+        self.add_listener(lambda old_state, new_state: self.events.publish(new_state.as_dict()))
+        self.history = history
+        if history is not None:
+            self.add_refresh_listener(history.append)
+        self.archive = archive
+        if archive is not None:
+            self.add_refresh_listener(archive.append)
+
+    def _warm_start(self, last_state):
+        """
+        Starts from the persisted last known state, served as stale until the first refresh succeeds,
+        and keeps persisting the refreshed states
+        :param last_state: LastStateFile
+        """
+        loaded = last_state.load()
+        if loaded is not None:
+            self._state, self._last_refresh_timestamp, self._last_change_timestamp = loaded
+            self._refresh_failed = True
+            self.log(f'Loaded the state refreshed {max(time.time() - self._last_refresh_timestamp, 0.):.0f} s ago')
+        self.add_refresh_listener(
+            lambda state, timestamp: last_state.save(state, timestamp, self._last_change_timestamp))
+
+    def add_listener(self, listener: Callable[[RpiState, RpiState], None]):
+        """
+        Adds a callback called with the old and the new state whenever the state changes
+        :param listener: state change callback
+        """
+        self._listeners.append(listener)
+
+    def add_refresh_listener(self, listener: Callable[[RpiState, float], None]):
+        """
+        Adds a callback called with the state and the UNIX timestamp after every successful refresh
+        :param listener: refresh callback
+        """
+        self._refresh_listeners.append(listener)
+
+    @contextmanager
+    def _timed_lock(self, lock: Lock, name: str):
+        started = time.perf_counter()
+        with lock:
+            LOCK_WAIT.labels(self._metric_unit, name).observe(time.perf_counter() - started)
+            yield
+
+    def is_stale(self) -> bool:
+        """
+        Checks whether the served state may be outdated because the last refresh failed
+        :return: True when the state is stale
+        """
+        return self._refresh_failed or not self._last_refresh_timestamp
+
+    def get_state_age(self) -> float or None:
+        """
+        Gets the time since the state was last refreshed from the RPi
+        :return: age in seconds, None if it was never refreshed
+        """
+        if not self._last_refresh_timestamp:
+            return None
+        return max(time.time() - self._last_refresh_timestamp, 0.)
+
+    def _current_state(self) -> RpiState:
+        return self._state
 
-    def _get_param_value(self, param_name: str, updater: Callable, num: int = None):
-        if param_name not in self._state.__dict__:
-            raise Exception(f'Class parameter {param_name} is undefined')
-        if isinstance(self._state.__dict__[param_name], list):
-            if num is None:
-                raise Exception(f'Number argument should be defined when list is passed')
-            self.log(f'{param_name} {num} = {self._state.__dict__[param_name][num - 1]}')
-            return self._state.__dict__[param_name][num - 1]
-        else:
-            self.log(f'{param_name} = {self._state.__dict__[param_name]}')
-            return self._state.__dict__[param_name]
+    def _merge_refresh(self, fields: Iterable[str], state: RpiState = None, values: dict = None):
+        """
+        Publishes refreshed fields, either a full state or a field to value mapping,
+        and reconciles them with the pending optimistic writes
+        :param fields: refreshed field names
+        :param state: refreshed full state
+        :param values: refreshed field name to value mapping
+        """
+        with self._timed_lock(self._state_lock, 'state'):
+            if state is None:
+                state = dataclasses.replace(self._state, **values)
+            state, rollbacks = self._reconcile(state, fields)
+            changed = state != self._state
+            self._last_refresh_timestamp = time.time()
+            self._refresh_failed = False
+            self._set_state(state)
+        for listener in self._refresh_listeners:
+            try:
+                listener(state, self._last_refresh_timestamp)
+            except Exception as e:
+                self.log(f'Refresh listener failed: {e}')
+        for rollback in rollbacks:
+            self.log(f'Write of {rollback} was not confirmed, rolled back')
+            self.events.publish(state.as_dict(), event='rollback', data=rollback)
+        self._scheduler.completed(fields, changed)
+        if self._pending_writes:
+            self._scheduler.note_write()
+
+    def _reconcile(self, state: RpiState, fields: Iterable[str]) -> Tuple[RpiState, List[dict]]:
+        now = time.monotonic()
+        rollbacks = []
+        for (field, number), (value, deadline) in list(self._pending_writes.items()):
+            if field not in fields:
+                continue
+            actual = getattr(state, field) if number is None else getattr(state, field)[number - 1]
+            if actual == value:
+                del self._pending_writes[(field, number)]
+            elif now >= deadline:
+                del self._pending_writes[(field, number)]
+                rollbacks.append({'field': field, 'number': number,
+                                  'expected': value.value if isinstance(value, Mode) else value,
+                                  'actual': actual.value if isinstance(actual, Mode) else actual})
+            else:
+                state = _with_value(state, field, value, number)
+        return state, rollbacks
+
+    def _apply_write(self, field: str, value, number: int = None):
+        """
+        Optimistically applies a written value until a refresh confirms or rolls it back
+        :param field: written state field
+        :param value: written value
+        :param number: item number for sequence fields
+        """
+        with self._timed_lock(self._state_lock, 'state'):
+            self._pending_writes[(field, number)] = (value, time.monotonic() + self._scheduler.fast_window)
+            self._set_state(_with_value(self._state, field, value, number))
+        self._note_write()
+
+    def _set_state(self, state: RpiState):
+        if state != self._state:
+            old_state, self._state = self._state, state
+            self._last_change_timestamp = time.time()
+            for listener in self._listeners:
+                try:
+                    listener(old_state, state)
+                except Exception as e:
+                    self.log(f'State listener failed: {e}')
+
+    def _wake_updater(self):
+        if self.on_wake is not None:
+            self.on_wake()
+
+    def _note_write(self):
+        self._scheduler.note_write()
+        self._wake_updater()
+
+    def _get_param_value(self, param_name: str, num: int = None):
+        return state_value(self._current_state(), param_name, num)
 
     def get_he_temperature(self, number: int) -> float:
         # return get_he_temperature(number)
-        return self._get_param_value('_he_temperatures', get_he_temperature, number)
+        return self._get_param_value('he_temperatures', number)
 
     def get_outside_temperature(self) -> float:
         # return get_outside_temperature()
-        return self._get_param_value('_outside_temperature', get_outside_temperature)
+        return self._get_param_value('outside_temperature')
 
     def get_inside_temperature(self) -> float:
         # return get_inside_temperature()
-        return self._get_param_value('_inside_temperature', get_inside_temperature)
+        return self._get_param_value('inside_temperature')
 
     def get_valve_opened(self, number: int) -> bool:
         # return get_valve_opened(number)
-        return self._get_param_value('_valves_states', get_valve_opened, number)
+        return self._get_param_value('valves_states', number)
 
     def get_feed_temperature(self) -> float:
         # return get_feed_temperature()
-        return self._get_param_value('_feed_temperature', get_feed_temperature)
-
-    def set_feed_temperature(self, temperature) -> bool:
-        status = set_feed_temperature(temperature)
-        self._update_values()
-        return status
+        return self._get_param_value('feed_temperature')
 
     def get_hysteresis(self) -> float:
         # return get_hysteresis()
-        return self._get_param_value('_hysteresis', get_hysteresis)
-
-    def set_hysteresis(self, hysteresis) -> bool:
-        status = set_hysteresis(hysteresis)
-        self._update_values()
-        return status
+        return self._get_param_value('hysteresis')
 
     def get_mode(self) -> Mode:
         # return get_mode()
-        return self._get_param_value('_mode', get_mode)
-
-    def set_mode(self, mode: Mode) -> bool:
-        status = set_mode(mode)
-        self._update_values()
-        return status
+        return self._get_param_value('mode')
 
     def get_valve_activated(self, number) -> bool:
         # return get_valve_activated(number)
-        return self._get_param_value('_valves_activated_states', get_valve_activated, number)
+        return self._get_param_value('valves_activated_states', number)
 
-    def set_valve_activated(self, number, activated) -> bool:
-        status = set_valve_activated(number, activated)
-        self._update_values()
+    def get_full_state(self) -> RpiState:
+        return self._current_state()
+
+    def get_cached_state(self) -> RpiState:
+        """
+        Gets the in-memory state without refreshing it, even if it was never refreshed
+        :return: full state
+        """
+        return self._state
+
+    def get_last_modified(self) -> float:
+        """
+        Gets the time the full state last changed
+        :return: UNIX timestamp
+        """
+        return self._last_change_timestamp
+
+
+class HvacRpi(UnitState):
+    """
+    Unit refreshed by an updater thread, writes are coalesced by a CommandQueue
+    """
+
+    def __init__(self, log=None, transport: RpiTransport = None, scheduler: PollScheduler = None,
+                 commands: CommandQueue = None, history=None, archive=None, name: str = None, last_state=None):
+        self._pr_lock = Lock()
+        self._transport = transport if transport is not None else get_default_transport()
+        self._commands = commands if commands is not None else CommandQueue()
+        self._flight = SingleFlight()
+        self._wake = Event()
+        super().__init__(log=log, scheduler=scheduler, history=history, archive=archive, name=name,
+                         last_state=last_state)
+
+    def _update_values(self, fields: Set[str] = None):
+        with self._timed_lock(self._pr_lock, 'refresh'):
+            self.log('Starting update')
+            requests_needed = sum(len(FIELD_PROPERTIES[field]) for field in fields) if fields is not None else None
+            try:
+                if requests_needed is None or requests_needed > self._scheduler.max_property_requests:
+                    state, values, fields = get_all_states(self._transport), None, FIELD_PROPERTIES.keys()
+                else:
+                    state, values = None, get_state_fields(fields, self._transport)
+            except Exception:
+                REFRESHES.labels(self._metric_unit, 'failure').inc()
+                raise
+            self._merge_refresh(fields, state=state, values=values)
+            REFRESHES.labels(self._metric_unit, 'success').inc()
+            self.log('Update finished')
+
+    def refresh(self, fields: Set[str] = None):
+        """
+        Refreshes the state from the RPi. Concurrent refreshes of the same fields share one request
+        :param fields: state fields to refresh, all fields if not given
+        """
+        key = tuple(sorted(fields)) if fields is not None else None
+        try:
+            self._flight.do(key, self._update_values, fields)
+        except Exception:
+            self._refresh_failed = True
+            raise
+
+    def _current_state(self) -> RpiState:
+        if not self._last_refresh_timestamp:
+            try:
+                self.refresh()
+            except Exception as e:
+                self.log(f'Initial refresh failed: {e}')
+        return self._state
+
+    def _submit_write(self, method: str, *args) -> Future:
+        if method not in _WRITES:
+            raise Exception(f'Unknown write {method}')
+        write, write_args, field, value, number = _WRITES[method](*args)
+        return self._commands.submit((field, number), self._send_write, write, write_args, field, value, number)
+
+    def _write(self, method: str, *args) -> bool:
+        return self._command_result(self._submit_write(method, *args))
+
+    def _command_result(self, future: Future) -> bool:
+        try:
+            return future.result(timeout=self._commands.timeout)
+        except FutureTimeoutError:
+            raise CommandTimeoutError(self._commands.timeout)
+
+    def write_batch(self, writes: Iterable[Tuple[str, tuple]]) -> list:
+        """
+        Queues several writes at once, so they share one coalescing window and are sent concurrently
+        :param writes: (write method name, arguments) pairs, e.g. ("open_valve", (2,))
+        :return: result of every write or the exception it failed with
+        """
+        futures = []
+        for method, args in writes:
+            try:
+                futures.append(self._submit_write(method, *args))
+            except Exception as e:
+                futures.append(e)
+        results = []
+        for future in futures:
+            try:
+                results.append(self._command_result(future) if isinstance(future, Future) else future)
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _send_write(self, write: Callable, args: tuple, field: str, value, number: int = None) -> bool:
+        status = write(*args, self._transport)
+        if status:
+            self._apply_write(field, value, number)
         return status
 
+    def poll(self) -> float:
+        """
+        Refreshes the fields that are due
+        :return: delay in seconds until the next poll
+        """
+        self._wake.clear()
+        fields = self._scheduler.due_fields()
+        if fields:
+            try:
+                self.refresh(fields)
+            except CircuitOpenError as e:
+                delay = self._scheduler.failed(retry_after=e.retry_after)
+                self.log(f'RPi circuit is open, retrying in {delay:.1f} s')
+            except OverloadedError as e:
+                delay = self._scheduler.failed(retry_after=e.retry_after)
+                self.log(f'RPi is busy, retrying in {delay:.1f} s')
+            except Exception as e:
+                delay = self._scheduler.failed()
+                self.log(f'Update failed, retrying in {delay:.1f} s: {e}')
+        return max(self._scheduler.next_delay(), .05)
+
+    def _updater(self):
+        self.log('Starting thread')
+        while True:
+            self._wake.wait(self.poll())
+
+    def _wake_updater(self):
+        self._wake.set()
+        super()._wake_updater()
+
+    def start_updater(self):
+        self.log('Requesting an update')
+        self._updater_thread = Thread(daemon=True, target=self._updater)
+        self._updater_thread.start()
+
+    def set_feed_temperature(self, temperature) -> bool:
+        return self._write('set_feed_temperature', temperature)
+
+    def set_hysteresis(self, hysteresis) -> bool:
+        return self._write('set_hysteresis', hysteresis)
+
+    def set_mode(self, mode: Mode) -> bool:
+        return self._write('set_mode', mode)
+
+    def set_valve_activated(self, number, activated) -> bool:
+        return self._write('set_valve_activated', number, activated)
+
     def open_valve(self, number: int):
-        status = open_valve(number)
-        self._update_values()
-        return status
+        return self._write('open_valve', number)
 
     def close_valve(self, number: int):
-        status = close_valve(number)
-        self._update_values()
-        return status
+        return self._write('close_valve', number)
 
-    def get_full_state(self) -> RpiState:
-        return self._state
+
+def state_value(state: RpiState, param_name: str, num: int = None):
+    """
+    Gets a state field or one of its items
+    :param state: RPi state
+    :param param_name: state field name
+    :param num: item number for sequence fields
+    :return: field or item value
+    """
+    getter, size, item_name = _ACCESSORS[param_name]
+    value = getter(state)
+    if size is None:
+        return value
+    if num is None or not (0 < num <= size):
+        raise Exception(f'{item_name} can be 1-{size}, not {num}')
+    return value[num - 1]
+
+
+def write_target(method: str, args: tuple) -> Tuple[str, int]:
+    """
+    Validates a write and gets what it writes
+    :param method: write method name, e.g. "open_valve"
+    :param args: write method arguments
+    :return: state field and item number, None for scalar fields
+    """
+    if method not in _WRITES:
+        raise Exception(f'Unknown write {method}')
+    _, _, field, _, number = _WRITES[method](*args)
+    _, size, item_name = _ACCESSORS[field]
+    if size is not None and not (isinstance(number, int) and 0 < number <= size):
+        raise Exception(f'{item_name} can be 1-{size}, not {number}')
+    return field, number
 
 
-def make_request(method: str, url, **kwargs) -> requests.Response:
+def _with_value(state: RpiState, field: str, value, number: int = None) -> RpiState:
+    if number is not None:
+        items = list(getattr(state, field))
+        items[number - 1] = value
+        value = tuple(items)
+    return dataclasses.replace(state, **{field: value})
+
+
+def get_default_transport() -> RpiTransport:
+    """
+    Gets the transport to the controller configured in the environment
+    :return: shared RpiTransport
+    """
+    global _default_transport
+    if _default_transport is None:
+        if HVAC_URL is None:
+            raise Exception('RPI_HOST is not set, the RPi transport has to be given explicitly')
+        with _default_transport_lock:
+            if _default_transport is None:
+                _default_transport = RpiTransport(HVAC_URL)
+    return _default_transport
+
+
+def make_request(method: str, path: str, transport: RpiTransport = None, **kwargs) -> requests.Response:
     """
     Make a generic request
     :param method: request method, e.g. "get" or "post"
-    :param url: request URL
-    :param kwargs: request parameters, check requests.request function
+    :param path: request path relative to the HVAC URL, e.g. "/properties/mode"
+    :param transport: transport to use, the default transport if not given
+    :param kwargs: request parameters, check requests.Session.request function
     :return: requests.Response
     """
-    response = requests.request(method, url, **kwargs)
+    if transport is None:
+        transport = get_default_transport()
+    response = transport.request(method, path, **kwargs)
     if response.status_code // 100 != 2:
         raise Exception(f'RPi replied with code {response.status_code}')
     return response
 
 
-def get_he_temperature(number: int) -> float:
+def get_property(name: str, transport: RpiTransport = None):
+    """
+    Gets a single RPi property
+    :param name: property name, e.g. "temperatureFeed"
+    :param transport: transport to use, the default transport if not given
+    :return: property value
+    """
+    response = make_request('get', f'/properties/{name}', transport)
+    return response.json()
+
+
+def get_he_temperature(number: int, transport: RpiTransport = None) -> float:
     """
     Gets heat exchanger temperature with a given number
     :param number: heat exchanger number
+    :param transport: transport to use, the default transport if not given
     :return: temperature in Celsius
     """
     if not (0 < number < 4):
         raise Exception(f'Heat exchanger can be 1-3, not {number}')
-    response = make_request('get', f'{HVAC_URL}/properties/temperatureHe{number}')
+    response = make_request('get', f'/properties/temperatureHe{number}', transport)
     return response.json()
 
 
-def get_outside_temperature() -> float:
+def get_outside_temperature(transport: RpiTransport = None) -> float:
     """
     Gets outside temperature with a given number
+    :param transport: transport to use, the default transport if not given
     :return: temperature in Celsius
     """
-    response = make_request('get', f'{HVAC_URL}/properties/temperatureOutside')
+    response = make_request('get', '/properties/temperatureOutside', transport)
     return response.json()
 
 
-def get_inside_temperature() -> float:
+def get_inside_temperature(transport: RpiTransport = None) -> float:
     """
     Gets inside temperature with a given number
+    :param transport: transport to use, the default transport if not given
     :return: temperature in Celsius
     """
-    response = make_request('get', f'{HVAC_URL}/properties/temperatureInside')
+    response = make_request('get', '/properties/temperatureInside', transport)
     return response.json()
 
 
-def get_valve_opened(number: int) -> bool:
+def get_valve_opened(number: int, transport: RpiTransport = None) -> bool:
     """
     Gets valve state with a given number
     :param number: valve number
+    :param transport: transport to use, the default transport if not given
     :return: valve opened status
     """
     if not (0 < number < 5):
         raise Exception(f'Valve can be 1-4, not {number}')
-    response = make_request('get', f'{HVAC_URL}/properties/valveOpened{number}')
+    response = make_request('get', f'/properties/valveOpened{number}', transport)
     return response.json()
 
 
-def get_feed_temperature():
+def get_feed_temperature(transport: RpiTransport = None):
     """
     Gets feed temperature
+    :param transport: transport to use, the default transport if not given
     :return: feed temperature
     """
-    response = make_request('get', f'{HVAC_URL}/properties/temperatureFeed')
+    response = make_request('get', '/properties/temperatureFeed', transport)
     return response.json()
 
 
-def set_feed_temperature(temperature: int):
+def set_feed_temperature(temperature: int, transport: RpiTransport = None):
     """
     Sets feed temperature
     :param temperature: feed temperature
+    :param transport: transport to use, the default transport if not given
     :return: operation success
     """
-    response = make_request('put', f'{HVAC_URL}/properties/temperatureFeed', data=f'{temperature}')
+    response = make_request('put', '/properties/temperatureFeed', transport, data=f'{temperature}')
     return response.status_code // 100 == 2
 
 
-def get_hysteresis():
+def get_hysteresis(transport: RpiTransport = None):
     """
     Gets hysteresis
+    :param transport: transport to use, the default transport if not given
     :return: hysteresis
     """
-    response = make_request('get', f'{HVAC_URL}/properties/hysteresis')
+    response = make_request('get', '/properties/hysteresis', transport)
     return response.json()
 
 
-def set_hysteresis(hysteresis: float):
+def set_hysteresis(hysteresis: float, transport: RpiTransport = None):
     """
     Sets hysteresis
     :param hysteresis: hysteresis
+    :param transport: transport to use, the default transport if not given
     :return: operation success
     """
-    response = make_request('put', f'{HVAC_URL}/properties/hysteresis', data=f'{hysteresis}')
+    response = make_request('put', '/properties/hysteresis', transport, data=f'{hysteresis}')
     return response.status_code // 100 == 2
 
 
-def get_mode() -> Mode:
+def get_mode(transport: RpiTransport = None) -> Mode:
     """
     Gets operation mode
+    :param transport: transport to use, the default transport if not given
     :return: operation mode
     """
-    response = make_request('get', f'{HVAC_URL}/properties/mode')
+    response = make_request('get', '/properties/mode', transport)
     return Mode(response.json())
 
 
-def set_mode(mode: Mode):
+def set_mode(mode: Mode, transport: RpiTransport = None):
     """
     Sets operation mode
     :param mode: operation mode
+    :param transport: transport to use, the default transport if not given
     :return: operation success
     """
-    response = make_request('put', f'{HVAC_URL}/properties/mode', data=mode.value)
+    response = make_request('put', '/properties/mode', transport, data=mode.value)
     return response.status_code // 100 == 2
 
 
-def get_valve_activated(number: int) -> Mode:
+def get_valve_activated(number: int, transport: RpiTransport = None) -> Mode:
     """
     Gets valve activated status
+    :param transport: transport to use, the default transport if not given
     :return: valve activated status
     """
-    response = make_request('get', f'{HVAC_URL}/properties/valveActivated{number}')
+    response = make_request('get', f'/properties/valveActivated{number}', transport)
     return response.json()
 
 
-def set_valve_activated(number: int, activated: bool):
+def set_valve_activated(number: int, activated: bool, transport: RpiTransport = None):
     """
     Sets valve activated status
     :param number: valve number
     :param activated: is valve activated
+    :param transport: transport to use, the default transport if not given
     :return: operation success
     """
-    response = make_request('put', f'{HVAC_URL}/properties/valveActivated{number}', data=f'{"true" if activated else "false"}')
+    if not (0 < number < 5):
+        raise Exception(f'Valve can be 1-4, not {number}')
+    response = make_request('put', f'/properties/valveActivated{number}', transport, data=f'{"true" if activated else "false"}')
     return response.status_code // 100 == 2
 
 
-def open_valve(number: int):
+def open_valve(number: int, transport: RpiTransport = None):
     """
     Opens valve with a given number
     :param number: valve number
+    :param transport: transport to use, the default transport if not given
     :return: operation success
     """
     if not (0 < number < 5):
         raise Exception(f'Valve can be 1-4, not {number}')
-    response = make_request('post', f'{HVAC_URL}/actions/openValve{number}')
+    response = make_request('post', f'/actions/openValve{number}', transport)
     return response.status_code // 100 == 2
 
 
-def close_valve(number: int):
+def close_valve(number: int, transport: RpiTransport = None):
     """
     Closes valve with a given number
     :param number: valve number
+    :param transport: transport to use, the default transport if not given
     :return: operation success
     """
     if not (0 < number < 5):
         raise Exception(f'Valve can be 1-4, not {number}')
-    response = make_request('post', f'{HVAC_URL}/actions/closeValve{number}')
+    response = make_request('post', f'/actions/closeValve{number}', transport)
     return response.status_code // 100 == 2
 
 
-def get_all_states() -> RpiState or None:
+def state_from_properties(properties: dict) -> RpiState:
+    """
+    Builds RPI state from a property name to value mapping
+    :param properties: RPi properties, e.g. a reply of "/all/properties"
+    :return: full state
+    """
+    return RpiState(
+        he_temperatures=(properties['temperatureHe1'],
+                         properties['temperatureHe2'],
+                         properties['temperatureHe3']),
+        feed_temperature=properties['temperatureFeed'],
+        hysteresis=properties['hysteresis'],
+        outside_temperature=properties['temperatureOutside'],
+        inside_temperature=properties['temperatureInside'],
+        valves_states=(properties['valveOpened1'],
+                       properties['valveOpened2'],
+                       properties['valveOpened3'],
+                       properties['valveOpened4']),
+        valves_activated_states=(properties['valveActivated1'],
+                                 properties['valveActivated2'],
+                                 properties['valveActivated3'],
+                                 properties['valveActivated4']),
+        mode=properties['mode']
+    )
+
+
+def get_state_fields(fields: Iterable[str], transport: RpiTransport = None) -> dict:
+    """
+    Gets RPI state fields by requesting their properties one by one
+    :param fields: RpiState field names
+    :param transport: transport to use, the default transport if not given
+    :return: field name to value mapping, sequence fields are tuples
+    """
+    values = {}
+    for field in fields:
+        properties = FIELD_PROPERTIES[field]
+        if len(properties) > 1:
+            values[field] = tuple(get_property(name, transport) for name in properties)
+        else:
+            values[field] = get_property(properties[0], transport)
+    return values
+
+
+def get_all_states(transport: RpiTransport = None) -> RpiState:
     """
     Gets RPI full state
+    :param transport: transport to use, the default transport if not given
     :return: full state
     """
-    response = make_request('get', f'{HVAC_URL}/all/properties')
+    response = make_request('get', '/all/properties', transport)
     response_data = response.json()
-    rpiState = None
-    if response_data:
-        rpiState = RpiState(
-            he_temperatures=[response_data['temperatureHe1'],
-                            response_data['temperatureHe2'],
-                            response_data['temperatureHe3']],
-            feed_temperature=response_data['temperatureFeed'],
-            hysteresis=response_data['hysteresis'],
-            outside_temperature=response_data['temperatureOutside'],
-            inside_temperature=response_data['temperatureInside'],
-            valves_states=[response_data['valveOpened1'], 
-                        response_data['valveOpened2'], 
-                        response_data['valveOpened3'], 
-                        response_data['valveOpened4']],
-            valves_activated_states=[response_data['valveActivated1'], 
-                                    response_data['valveActivated2'], 
-                                    response_data['valveActivated3'], 
-                                    response_data['valveActivated4']],
-            mode=response_data['mode']
-        )
-    return rpiState
+    if not response_data:
+        raise Exception('RPi replied with an empty state')
+    return state_from_properties(response_data)
 
 
 def main():
@@ -1,15 +1,28 @@
 import os
 import configparser
-import threading
+from typing import Dict
 from logging.config import dictConfig
 
 from flask import Flask
 from flask_cors import CORS
 from flask_restful import Api
 
-from rpi_interface import HvacRpi
+from rpi_interface import HvacRpi, CommandQueue, HVAC_NAME, HVAC_URL, hvac_url
+from archive import StateArchive
+from history import HistoryStore
+from last_state import LastStateFile
+from programs import ProgramScheduler
+from polling import PollScheduler, FIELD_INTERVALS
+from transport import RpiTransport, CircuitBreaker, UpstreamLimiter
+from admission import RequestLimits
+from units import UnitRegistry
 from resources import TemperatureHe, TemperatureOutside, TemperatureInside, TemperatureFeed, Hysteresis, Mode, Valve, \
-    FullState, SuAccess, ValveActivated
+    FullState, SuAccess, ValveActivated, Events, Changes, History, Archive, \
+    Stats, Batch, HvacResource, UnitsFullState, Metrics, add_state_headers, start_request_timer, observe_request, \
+    Programs, compress_response, representation, vary_accept
+from encoding import MIMETYPES, JSON
+
+UNIT_SECTION_PREFIX = 'unit:'
 
 dictConfig(
     {
@@ -32,7 +45,18 @@ dictConfig(
 
 
 class Server:
-    def __init__(self, host, port, debug):
+    def __init__(self, host, port, debug, transport: RpiTransport = None, scheduler: PollScheduler = None,
+                 commands: CommandQueue = None, history: HistoryStore = None, archive: StateArchive = None,
+                 units: Dict[str, HvacRpi] = None, poll_workers: int = 8, remote=None,
+                 limits: RequestLimits = None, programs: ProgramScheduler = None):
+        """
+        :param units: unit name to unit interface, a single unit built from the other arguments if not given.
+        The first unit is also served without the unit prefix
+        :param poll_workers: maximum number of units polled at the same time
+        :param remote: worker metrics sender of the poller process channel when the units are polled in another process
+        :param limits: per client rate limits, no limits if not given
+        :param programs: scheduled programs of the units, or their view in the poller process, None if disabled
+        """
         self.host = host
         self.port = port
         self.debug = debug
@@ -40,45 +64,207 @@ class Server:
         self.app.config['CORS_HEADERS'] = 'Content-Type'
         cors = CORS(self.app, resources={r"/*": {"origins": "*"}}, support_credentials=True)
         self.api = Api(self.app)
-        self.hvac = HvacRpi(log=self.app.logger)
-        self._assign_hvac(self.hvac)
+        for mimetype in MIMETYPES:
+            if mimetype != JSON:
+                self.api.representation(mimetype)(representation(mimetype))
+        # The default JSON one is kept, the responses of every representation vary by the Accept header
+        self.api.representation(JSON)(vary_accept(self.api.representations[JSON]))
+        self.app.before_request(start_request_timer)
+        if limits is not None:
+            self.app.before_request(limits.admit)
+        # After request hooks run last to first, the compression sees the final body
+        self.app.after_request(compress_response)
+        self.app.after_request(add_state_headers)
+        self.app.after_request(observe_request)
+        if units is None:
+            name = HVAC_NAME or 'default'
+            units = {name: HvacRpi(log=self.app.logger, transport=transport, scheduler=scheduler, commands=commands,
+                                   history=history, archive=archive, name=name)}
+        self.units = UnitRegistry(units, poll_workers)
+        self.hvac = self.units.default
+        self._assign_hvac(self.hvac, self.units)
+        Metrics.remote = remote
+        Programs.scheduler = programs
+        self.programs = programs
         self._add_resources()
 
     @staticmethod
-    def _assign_hvac(hvac: HvacRpi):
-        TemperatureHe.hvac = hvac
-        TemperatureOutside.hvac = hvac
-        TemperatureInside.hvac = hvac
-        TemperatureFeed.hvac = hvac
-        Hysteresis.hvac = hvac
-        Mode.hvac = hvac
-        Valve.hvac = hvac
-        ValveActivated.hvac = hvac
-        FullState.hvac = hvac
+    def _assign_hvac(hvac: HvacRpi, units: UnitRegistry):
+        HvacResource.hvac = hvac
+        HvacResource.units = units
+
+    def _add_unit_resource(self, resource, path: str):
+        self.api.add_resource(resource, path, f'/<string:unit>{path}')
 
     def _add_resources(self):
-        self.api.add_resource(TemperatureHe, '/temperatureHe/<int:number>')
-        self.api.add_resource(TemperatureOutside, '/temperatureOutside')
-        self.api.add_resource(TemperatureInside, '/temperatureInside')
-        self.api.add_resource(TemperatureFeed, '/temperatureFeed')
-        self.api.add_resource(Hysteresis, '/hysteresis')
-        self.api.add_resource(Mode, '/mode')
-        self.api.add_resource(Valve, '/valve/<int:number>')
-        self.api.add_resource(ValveActivated, '/valveActivated/<int:number>')
-        self.api.add_resource(FullState, '/fullState')
+        self._add_unit_resource(TemperatureHe, '/temperatureHe/<int:number>')
+        self._add_unit_resource(TemperatureOutside, '/temperatureOutside')
+        self._add_unit_resource(TemperatureInside, '/temperatureInside')
+        self._add_unit_resource(TemperatureFeed, '/temperatureFeed')
+        self._add_unit_resource(Hysteresis, '/hysteresis')
+        self._add_unit_resource(Mode, '/mode')
+        self._add_unit_resource(Valve, '/valve/<int:number>')
+        self._add_unit_resource(ValveActivated, '/valveActivated/<int:number>')
+        self._add_unit_resource(FullState, '/fullState')
+        self._add_unit_resource(Batch, '/batch')
+        self.api.add_resource(Programs, '/programs', '/programs/<string:program_id>', '/<string:unit>/programs',
+                              '/<string:unit>/programs/<string:program_id>')
         self.api.add_resource(SuAccess, '/suAccess')
+        self._add_unit_resource(Events, '/events')
+        self._add_unit_resource(Changes, '/changes')
+        self._add_unit_resource(History, '/history')
+        self._add_unit_resource(Archive, '/archive')
+        self._add_unit_resource(Stats, '/stats')
+        self.api.add_resource(UnitsFullState, '/units/fullState')
+        self.api.add_resource(Metrics, '/metrics')
 
     def run(self):
-        threading.Thread(target=lambda: self.app.run(self.host, self.port, self.debug, threaded=True, use_reloader=False)).start()
-        self.hvac.start_updater()
+        self.units.start()
+        if self.programs is not None:
+            self.programs.start()
+        # Served in the main thread: once it exits the interpreter shuts the pollers' executors down
+        self.app.run(self.host, self.port, self.debug, threaded=True, use_reloader=False)
 
 
-def main():
+def _make_unit(config: configparser.ConfigParser, name: str, url: str, section: str = None) -> HvacRpi:
+    """
+    Builds a unit interface from the config
+    :param config: server config
+    :param name: unit name
+    :param url: HVAC URL
+    :param section: unit config section overriding RPI and POLLING options, None for the unit from the environment
+    :return: unit interface
+    """
+    def option(getter, fallback_section: str, key: str):
+        value = getter(fallback_section, key, fallback=None)
+        return value if section is None else getter(section, key, fallback=value)
+
+    server_dir = os.path.dirname(os.path.abspath(__file__))
+    transport = RpiTransport(url,
+                             connect_timeout=option(config.getfloat, 'RPI', 'ConnectTimeout'),
+                             read_timeout=option(config.getfloat, 'RPI', 'ReadTimeout'),
+                             pool_size=option(config.getint, 'RPI', 'PoolSize'),
+                             retries=option(config.getint, 'RPI', 'Retries'),
+                             retry_backoff=option(config.getfloat, 'RPI', 'RetryBackoff'),
+                             breaker=CircuitBreaker(
+                                 failure_threshold=option(config.getint, 'RPI', 'BreakerFailures'),
+                                 reset_timeout=option(config.getfloat, 'RPI', 'BreakerResetTimeout'),
+                                 max_reset_timeout=option(config.getfloat, 'RPI', 'BreakerMaxResetTimeout')),
+                             limiter=UpstreamLimiter(
+                                 max_in_flight=option(config.getint, 'RPI', 'MaxInFlight'),
+                                 max_queued=option(config.getint, 'RPI', 'MaxQueued'),
+                                 queue_timeout=option(config.getfloat, 'RPI', 'QueueTimeout')))
+    scheduler = PollScheduler(intervals={field: option(config.getfloat, 'POLLING', field)
+                                         for field in FIELD_INTERVALS
+                                         if option(config.getfloat, 'POLLING', field) is not None},
+                              fast_interval=option(config.getfloat, 'POLLING', 'FastInterval'),
+                              fast_window=option(config.getfloat, 'POLLING', 'FastWindow'),
+                              watched_interval=option(config.getfloat, 'POLLING', 'WatchedInterval'),
+                              max_idle_factor=option(config.getfloat, 'POLLING', 'MaxIdleFactor'),
+                              backoff=option(config.getfloat, 'POLLING', 'Backoff'),
+                              max_backoff=option(config.getfloat, 'POLLING', 'MaxBackoff'),
+                              max_property_requests=option(config.getint, 'POLLING', 'MaxPropertyRequests'))
+    commands = CommandQueue(window=option(config.getfloat, 'RPI', 'CommandWindow'),
+                            max_in_flight=option(config.getint, 'RPI', 'CommandConcurrency'),
+                            timeout=option(config.getfloat, 'RPI', 'CommandTimeout'))
+    history = None
+    if config.getboolean('HISTORY', 'Enabled'):
+        path = os.path.join(server_dir, config['HISTORY']['Path'])
+        if section is not None:
+            root, extension = os.path.splitext(path)
+            path = f'{root}-{name}{extension}'
+        history = HistoryStore(path,
+                               retention={0: config.getfloat('HISTORY', 'RawRetentionDays') * 86400,
+                                          60: config.getfloat('HISTORY', 'MinuteRetentionDays') * 86400,
+                                          900: config.getfloat('HISTORY', 'QuarterRetentionDays') * 86400,
+                                          3600: config.getfloat('HISTORY', 'HourRetentionDays') * 86400},
+                               max_points=config.getint('HISTORY', 'MaxPoints'))
+    archive = None
+    if config.getboolean('ARCHIVE', 'Enabled'):
+        path = os.path.join(server_dir, config['ARCHIVE']['Path'])
+        if section is not None:
+            path = os.path.join(path, name)
+        archive = StateArchive(path,
+                               segment_span=int(config.getfloat('ARCHIVE', 'SegmentDays') * 86400),
+                               index_stride=config.getint('ARCHIVE', 'IndexStride'))
+    last_state = None
+    if config.getboolean('WARMSTART', 'Enabled'):
+        path = os.path.join(server_dir, config['WARMSTART']['Path'])
+        if section is not None:
+            root, extension = os.path.splitext(path)
+            path = f'{root}-{name}{extension}'
+        last_state = LastStateFile(path, save_interval=config.getfloat('WARMSTART', 'SaveInterval'))
+    return HvacRpi(transport=transport, scheduler=scheduler, commands=commands, history=history,
+                   archive=archive, name=name, last_state=last_state)
+
+
+def load_config() -> configparser.ConfigParser:
     config = configparser.ConfigParser()
     config.read(f'{os.path.dirname(os.path.abspath(__file__))}/server.ini')
+    return config
+
+
+def load_units(config: configparser.ConfigParser) -> Dict[str, HvacRpi]:
+    """
+    Builds the units configured in [unit:<name>] sections or the unit from the environment
+    :param config: server config
+    :return: unit name to unit interface
+    """
+    units = {}
+    for section in config.sections():
+        if section.startswith(UNIT_SECTION_PREFIX):
+            name = section[len(UNIT_SECTION_PREFIX):]
+            url = hvac_url(config[section]['RpiHost'], config[section]['HvacName'])
+            units[name] = _make_unit(config, name, url, section)
+    if not units:
+        if HVAC_URL is None:
+            raise Exception(f'No [{UNIT_SECTION_PREFIX}<name>] sections in server.ini and RPI_HOST is not set')
+        units[HVAC_NAME or 'default'] = _make_unit(config, HVAC_NAME or 'default', HVAC_URL)
+    return units
+
+
+def load_limits(config: configparser.ConfigParser) -> RequestLimits:
+    """
+    Builds the client rate limits
+    :param config: server config
+    :return: request limits
+    """
+    return RequestLimits(read_rate=config.getfloat('LIMITS', 'ReadRate'),
+                         read_burst=config.getfloat('LIMITS', 'ReadBurst'),
+                         write_rate=config.getfloat('LIMITS', 'WriteRate'),
+                         write_burst=config.getfloat('LIMITS', 'WriteBurst'),
+                         max_clients=config.getint('LIMITS', 'MaxClients'),
+                         client_header=config['LIMITS']['ClientHeader'],
+                         proxy_hops=config.getint('LIMITS', 'ProxyHops'))
+
+
+def load_programs(config: configparser.ConfigParser, units: Dict[str, HvacRpi]) -> ProgramScheduler:
+    """
+    Builds the program scheduler
+    :param config: server config
+    :param units: unit name to unit interface
+    :return: program scheduler, None if disabled
+    """
+    if not config.getboolean('PROGRAMS', 'Enabled'):
+        return None
+    return ProgramScheduler(units, os.path.join(os.path.dirname(os.path.abspath(__file__)), config['PROGRAMS']['Path']),
+                            timezone=config['PROGRAMS']['TimeZone'] or None)
+
+
+def main():
+    config = load_config()
+    if config['DEFAULT']['Serving'] == 'production':
+        from production import run_production
+        run_production(config)
+        return
+    units = load_units(config)
     server = Server(host=config['DEFAULT']['Host'],
                     port=config.getint('DEFAULT', 'Port'),
-                    debug=config.getboolean('DEFAULT', 'Debug'))
+                    debug=config.getboolean('DEFAULT', 'Debug'),
+                    units=units,
+                    poll_workers=config.getint('UNITS', 'PollWorkers'),
+                    limits=load_limits(config),
+                    programs=load_programs(config, units))
     server.run()
 
 
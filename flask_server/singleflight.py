@@ -0,0 +1,51 @@
+from threading import Event, Lock
+from typing import Callable, Hashable
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls: callers asking for the same key while a call
+    for it is running wait for that call and share its result
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+
+    def do(self, key: Hashable, call: Callable, *args, **kwargs):
+        """
+        Runs a call unless one with the same key is in flight
+        :param key: deduplication key
+        :param call: callable to run
+        :param args: call arguments
+        :param kwargs: call keyword arguments
+        :return: call result, the exception of the call is raised in every caller
+        """
+        with self._lock:
+            flight = self._calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._calls[key] = _Call()
+        if leader:
+            try:
+                flight.result = call(*args, **kwargs)
+            except Exception as e:
+                flight.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                flight.done.set()
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
@@ -0,0 +1,241 @@
+import json
+import math
+import mmap
+import os
+import struct
+import time
+from threading import Lock, Thread
+from typing import Dict, Iterable, Optional, Tuple
+
+from rpi_interface import HvacRpi, RpiState
+
+# Magic, format version, number of slots and slot size
+HEADER = struct.Struct('<4sIII')
+MAGIC = b'HVSS'
+VERSION = 2
+# UNIX timestamp the writer last showed it is alive at, follows the header
+HEARTBEAT = struct.Struct('<d')
+HEARTBEAT_INTERVAL = 1
+# Everything before the first slot
+PREFIX_SIZE = HEADER.size + HEARTBEAT.size
+# Unit name, padded with zero bytes
+NAME = struct.Struct('<64s')
+# Sequence number, odd while the slot is being written
+SEQUENCE = struct.Struct('<Q')
+# Last change UNIX timestamp, last refresh UNIX timestamp (NaN if never refreshed), stale flag
+# and the length of the JSON encoded state following it
+FIELDS = struct.Struct('<dd?xxxI')
+PAYLOAD_SIZE = 1024
+SLOT_SIZE = NAME.size + SEQUENCE.size + FIELDS.size + PAYLOAD_SIZE
+
+
+def _slot_offsets(index: int) -> Tuple[int, int, int]:
+    """
+    :param index: slot index
+    :return: offsets of the slot name, sequence number and fields
+    """
+    name = PREFIX_SIZE + index * SLOT_SIZE
+    return name, name + NAME.size, name + NAME.size + SEQUENCE.size
+
+
+class SnapshotWriter:
+    """
+    Publishes the state of every unit into a memory-mapped file with one fixed-size slot per unit.
+    Every slot is guarded by a sequence number which is odd while the slot is rewritten (a seqlock),
+    so readers in other processes never block the poller and retry on torn reads
+    """
+
+    def __init__(self, path: str, units: Dict[str, HvacRpi]):
+        """
+        :param path: snapshot file path, preferably on a memory file system such as /dev/shm
+        :param units: unit name to unit interface
+        """
+        self.path = path
+        self.units = dict(units)
+        self._slots = {}
+        self._locks = {}
+        size = PREFIX_SIZE + len(self.units) * SLOT_SIZE
+        temporary = f'{path}.{os.getpid()}'
+        with open(temporary, 'wb') as file:
+            file.truncate(size)
+        with open(temporary, 'r+b') as file:
+            self._map = mmap.mmap(file.fileno(), size)
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, len(self.units), SLOT_SIZE)
+        HEARTBEAT.pack_into(self._map, HEADER.size, time.time())
+        for index, name in enumerate(self.units):
+            encoded = name.encode('utf-8')
+            if len(encoded) > NAME.size:
+                raise Exception(f'Unit name {name} is longer than {NAME.size} bytes')
+            name_offset, _, _ = _slot_offsets(index)
+            NAME.pack_into(self._map, name_offset, encoded)
+            self._slots[name] = index
+            self._locks[name] = Lock()
+        # Readers only ever see a complete directory
+        os.replace(temporary, path)
+
+    def attach(self, poller=None):
+        """
+        Publishes the units whenever their state changes or is refreshed
+        :param poller: unit poller, publishes a unit after every poll to spread failed refreshes too
+        """
+        for name, unit in self.units.items():
+            unit.add_listener(lambda old_state, new_state, name=name: self.publish(name))
+            unit.add_refresh_listener(lambda state, timestamp, name=name: self.publish(name))
+            self.publish(name)
+        if poller is not None:
+            poller.on_polled = self.publish
+        Thread(daemon=True, target=self._heartbeat, name='snapshot-heartbeat').start()
+
+    def _heartbeat(self):
+        while True:
+            HEARTBEAT.pack_into(self._map, HEADER.size, time.time())
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    def publish(self, name: str):
+        """
+        Writes the current state of a unit into its slot
+        :param name: unit name
+        """
+        unit = self.units[name]
+        state = unit.get_cached_state()
+        age = unit.get_state_age()
+        refreshed_at = time.time() - age if age is not None else math.nan
+        payload = state.as_json()
+        if len(payload) > PAYLOAD_SIZE:
+            raise Exception(f'State of {name} does not fit in {PAYLOAD_SIZE} bytes')
+        _, sequence_offset, fields_offset = _slot_offsets(self._slots[name])
+        with self._locks[name]:
+            sequence = SEQUENCE.unpack_from(self._map, sequence_offset)[0]
+            SEQUENCE.pack_into(self._map, sequence_offset, sequence + 1)
+            FIELDS.pack_into(self._map, fields_offset, unit.get_last_modified(), refreshed_at, unit.is_stale(),
+                             len(payload))
+            payload_offset = fields_offset + FIELDS.size
+            self._map[payload_offset:payload_offset + len(payload)] = payload
+            SEQUENCE.pack_into(self._map, sequence_offset, sequence + 2)
+
+    def close(self):
+        self._map.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class _Mapping:
+    """
+    One mapped snapshot file and its unit slots
+    """
+    __slots__ = ('inode', 'map', 'view', 'slots', 'cache')
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self.inode = os.fstat(file.fileno()).st_ino
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        magic, version, count, slot_size = HEADER.unpack_from(self.view, 0)
+        if magic != MAGIC or version != VERSION or slot_size != SLOT_SIZE:
+            raise Exception(f'Snapshot file {path} has an unknown format')
+        self.slots = {}
+        for index in range(count):
+            name_offset, _, _ = _slot_offsets(index)
+            self.slots[NAME.unpack_from(self.view, name_offset)[0].rstrip(b'\0').decode('utf-8')] = index
+        # Unit name to (sequence number, state, last modified, refreshed at, stale)
+        self.cache = {}
+
+
+class SnapshotReader:
+    """
+    Reads the unit states a SnapshotWriter publishes without any round-trip to its process.
+    A slot is decoded again only when its sequence number moved. A file replaced by a restarted writer
+    is mapped again, and the states are stale while the writer heartbeat is late
+    """
+
+    def __init__(self, path: str, open_timeout: float = 30, stale_after: float = 5, check_interval: float = 1):
+        """
+        :param path: snapshot file path
+        :param open_timeout: how long to wait for the writer to create the file in seconds
+        :param stale_after: heartbeat age the writer is considered gone after in seconds
+        :param check_interval: how often the file is checked for a replacement in seconds
+        """
+        self.path = path
+        self.stale_after = stale_after
+        self.check_interval = check_interval
+        deadline = time.monotonic() + open_timeout
+        while not os.path.exists(path):
+            if time.monotonic() >= deadline:
+                raise Exception(f'Snapshot file {path} does not exist')
+            time.sleep(.1)
+        self._mapping = _Mapping(path)
+        self._checked_at = time.monotonic()
+        self._lock = Lock()
+
+    @property
+    def names(self) -> Iterable[str]:
+        return self._current().slots.keys()
+
+    def _current(self) -> _Mapping:
+        """
+        Gets the mapping of the current snapshot file, remapped when a restarted writer replaced it
+        """
+        mapping = self._mapping
+        if time.monotonic() - self._checked_at < self.check_interval:
+            return mapping
+        with self._lock:
+            self._checked_at = time.monotonic()
+            try:
+                if os.stat(self.path).st_ino != self._mapping.inode:
+                    # The old mapping is left to the garbage collector, other threads may still read it
+                    self._mapping = _Mapping(self.path)
+            except Exception:
+                pass
+            return self._mapping
+
+    def writer_alive(self, mapping: _Mapping = None) -> bool:
+        """
+        Checks whether the writer heartbeat is recent
+        :param mapping: mapping to check, the current one if not given
+        :return: True while the writer keeps publishing
+        """
+        mapping = mapping if mapping is not None else self._current()
+        return time.time() - HEARTBEAT.unpack_from(mapping.view, HEADER.size)[0] < self.stale_after
+
+    def read(self, name: str, retries: int = 1000) -> Tuple[RpiState, float, Optional[float], bool]:
+        """
+        Reads the last published state of a unit
+        :param name: unit name
+        :param retries: number of attempts while the slot is being rewritten
+        :return: state, last modified UNIX timestamp, last refresh UNIX timestamp or None, stale flag
+        """
+        mapping = self._current()
+        state, last_modified, refreshed_at, stale = self._read(mapping, name, retries)
+        return state, last_modified, refreshed_at, stale or not self.writer_alive(mapping)
+
+    def _read(self, mapping: _Mapping, name: str, retries: int) -> Tuple[RpiState, float, Optional[float], bool]:
+        view = mapping.view
+        _, sequence_offset, fields_offset = _slot_offsets(mapping.slots[name])
+        cache = mapping.cache
+        cached = cache.get(name)
+        for _ in range(retries):
+            sequence = SEQUENCE.unpack_from(view, sequence_offset)[0]
+            if cached is not None and cached[0] == sequence:
+                return cached[1:]
+            if sequence & 1 or sequence == 0:
+                time.sleep(0)
+                continue
+            last_modified, refreshed_at, stale, length = FIELDS.unpack_from(view, fields_offset)
+            payload_offset = fields_offset + FIELDS.size
+            payload = bytes(view[payload_offset:payload_offset + min(length, PAYLOAD_SIZE)])
+            if SEQUENCE.unpack_from(view, sequence_offset)[0] != sequence:
+                continue
+            with self._lock:
+                cached = cache.get(name)
+                if cached is None or cached[0] != sequence:
+                    state = cached[1] if cached is not None and cached[1].as_json() == payload else \
+                        RpiState(**json.loads(payload))
+                    cached = (sequence, state, last_modified, None if math.isnan(refreshed_at) else refreshed_at,
+                              stale)
+                    cache[name] = cached
+            return cached[1:]
+        raise Exception(f'Snapshot of {name} is not available')
+
+    def close(self):
+        self._mapping.view.release()
+        self._mapping.map.close()
@@ -0,0 +1,234 @@
+import time
+from threading import Condition, Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import Counter, Histogram
+
+UPSTREAM_LATENCY = Histogram('hvac_upstream_request_duration_seconds', 'RPi request round-trip time including retries',
+                             ('method', 'path'))
+UPSTREAM_ERRORS = Counter('hvac_upstream_errors_total', 'Failed or rejected RPi requests', ('method', 'path', 'reason'))
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request while the circuit breaker is open
+    """
+    status = 503
+
+    def __init__(self, retry_after: float):
+        super().__init__(f'RPi is unavailable, retrying in {retry_after:.0f} s')
+        self.retry_after = retry_after
+
+
+class OverloadedError(Exception):
+    """
+    Raised instead of sending a request while too many requests to the RPi are in flight and queued
+    """
+    status = 503
+
+    def __init__(self, retry_after: float):
+        super().__init__('RPi is busy, try again later')
+        self.retry_after = retry_after
+
+
+class UpstreamLimiter:
+    """
+    Bounds the requests in flight to the RPi. A few more wait a short time for a free slot,
+    the rest are rejected right away
+    """
+
+    def __init__(self, max_in_flight: int = 2, max_queued: int = 8, queue_timeout: float = 2):
+        """
+        :param max_in_flight: maximum number of requests sent at the same time
+        :param max_queued: maximum number of requests waiting for a slot
+        :param queue_timeout: maximum wait for a slot in seconds
+        """
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self._condition = Condition()
+        self._in_flight = 0
+        self._queued = 0
+
+    def acquire(self):
+        """
+        Takes a request slot
+        :raises OverloadedError: the queue is full or no slot got free in time
+        """
+        with self._condition:
+            if self._in_flight < self.max_in_flight:
+                self._in_flight += 1
+                return
+            if self._queued >= self.max_queued:
+                raise OverloadedError(self.queue_timeout)
+            self._queued += 1
+            try:
+                if not self._condition.wait_for(lambda: self._in_flight < self.max_in_flight, self.queue_timeout):
+                    raise OverloadedError(self.queue_timeout)
+                self._in_flight += 1
+            finally:
+                self._queued -= 1
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a failing RPi. Opens after consecutive failures, lets a single trial
+    request through once the reset timeout passes (half-open) and closes again when it succeeds
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30, max_reset_timeout: float = 300):
+        """
+        :param failure_threshold: consecutive failures which open the circuit
+        :param reset_timeout: time the circuit stays open before a trial request in seconds
+        :param max_reset_timeout: maximum open time, the open time doubles with every failed trial
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._lock = Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._open_timeout = reset_timeout
+        self._opened_at = 0.
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() >= self._opened_at + self._open_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def before(self):
+        """
+        Checks whether a request can be sent
+        :raises CircuitOpenError: the circuit is open or a half-open trial is already running
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            retry_after = self._opened_at + self._open_timeout - time.monotonic()
+            if retry_after > 0 or self._trial:
+                raise CircuitOpenError(max(retry_after, 0))
+            self._state = self.HALF_OPEN
+            self._trial = True
+
+    def success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._open_timeout = self.reset_timeout
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN:
+                self._open_timeout = min(self._open_timeout * 2, self.max_reset_timeout)
+            elif self._state == self.CLOSED and self._failures < self.failure_threshold:
+                return
+            self._state = self.OPEN
+            self._opened_at = time.monotonic()
+            self._trial = False
+
+    def retry_after(self) -> float:
+        """
+        Gets the time until the next trial request
+        :return: delay in seconds, 0 when requests are let through
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return 0.
+            return max(self._opened_at + self._open_timeout - time.monotonic(), 0.)
+
+
+class RpiTransport:
+    """
+    Pooled keep-alive HTTP transport to a single RPi HVAC controller.
+    Idempotent GET requests are retried with backoff, writes are never retried
+    """
+
+    def __init__(self, url: str, connect_timeout: float = 3.05, read_timeout: float = 10,
+                 pool_size: int = 4, retries: int = 2, retry_backoff: float = 0.3,
+                 breaker: CircuitBreaker = None, limiter: UpstreamLimiter = None):
+        """
+        :param url: controller base URL, e.g. "http://host:port/hvac"
+        :param connect_timeout: TCP connect timeout in seconds
+        :param read_timeout: response read timeout in seconds
+        :param pool_size: maximum number of kept-alive connections
+        :param retries: number of retries for GET requests
+        :param retry_backoff: retry backoff factor in seconds
+        :param breaker: circuit breaker, a default one if not given
+        :param limiter: bound of the requests in flight, only the connection pool limits them if not given
+        """
+        self.url = url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.limiter = limiter
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+                      backoff_factor=retry_backoff, allowed_methods=frozenset(['GET']),
+                      status_forcelist=(502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+        self._session = requests.Session()
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        Make a request relative to the controller URL
+        :param method: request method, e.g. "get" or "post"
+        :param path: path relative to the controller URL, e.g. "/properties/mode"
+        :param kwargs: request parameters, check requests.Session.request function
+        :return: requests.Response
+        :raises CircuitOpenError: the RPi kept failing and the circuit breaker is open
+        :raises OverloadedError: too many requests to the RPi are in flight
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        method = method.upper()
+        if self.limiter is not None:
+            try:
+                self.limiter.acquire()
+            except OverloadedError:
+                UPSTREAM_ERRORS.labels(method, path, 'overloaded').inc()
+                raise
+        try:
+            return self._send(method, path, **kwargs)
+        finally:
+            if self.limiter is not None:
+                self.limiter.release()
+
+    def _send(self, method: str, path: str, **kwargs) -> requests.Response:
+        try:
+            self.breaker.before()
+        except CircuitOpenError:
+            UPSTREAM_ERRORS.labels(method, path, 'circuit_open').inc()
+            raise
+        started = time.perf_counter()
+        try:
+            response = self._session.request(method, f'{self.url}{path}', **kwargs)
+        except Exception:
+            UPSTREAM_ERRORS.labels(method, path, 'error').inc()
+            self.breaker.failure()
+            raise
+        finally:
+            UPSTREAM_LATENCY.labels(method, path).observe(time.perf_counter() - started)
+        if response.status_code >= 500:
+            UPSTREAM_ERRORS.labels(method, path, 'status').inc()
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        return response
+
+    def close(self):
+        self._session.close()
@@ -0,0 +1,187 @@
+import heapq
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Thread
+from typing import Dict, Iterator, Tuple, Union
+
+from metrics import Gauge
+from rpi_interface import HvacRpi, Mode, RpiState
+
+STATE_AGE = Gauge('hvac_state_age_seconds', 'Time since the unit state was last refreshed', ('unit',))
+STATE_STALE = Gauge('hvac_state_stale', 'Whether the last refresh of the unit state failed', ('unit',))
+TEMPERATURE = Gauge('hvac_temperature_celsius', 'Unit temperatures', ('unit', 'sensor'))
+HYSTERESIS = Gauge('hvac_hysteresis', 'Unit hysteresis', ('unit',))
+VALVE_OPENED = Gauge('hvac_valve_opened', 'Whether a unit valve is opened', ('unit', 'valve'))
+VALVE_ACTIVATED = Gauge('hvac_valve_activated', 'Whether a unit valve is activated', ('unit', 'valve'))
+MODE = Gauge('hvac_mode', 'Unit operation mode, 1 for the current one', ('unit', 'mode'))
+
+
+class UnitPoller:
+    """
+    Polls many units on a bounded thread pool instead of a thread per unit.
+    A unit is polled again after the delay its scheduler asks for, waking it moves the next poll to now
+    """
+
+    def __init__(self, max_workers: int = 8):
+        """
+        :param max_workers: maximum number of units polled at the same time
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='rpi-poll')
+        self._condition = Condition()
+        self._units = {}
+        self._heap = []
+        # Unit name to the monotonic time of its next poll, None while it is being polled
+        self._due = {}
+        self._woken = set()
+        self._thread = None
+        # Called with the unit name after every poll
+        self.on_polled = None
+
+    def add(self, name: str, unit: HvacRpi):
+        """
+        Adds a unit polled right away
+        :param name: unit name
+        :param unit: unit interface
+        """
+        unit.on_wake = lambda: self.wake(name)
+        with self._condition:
+            self._units[name] = unit
+            self._schedule(name, time.monotonic())
+
+    def _schedule(self, name: str, when: float):
+        self._due[name] = when
+        heapq.heappush(self._heap, (when, name))
+        self._condition.notify()
+
+    def wake(self, name: str):
+        """
+        Polls a unit as soon as possible
+        :param name: unit name
+        """
+        with self._condition:
+            if name not in self._due:
+                return
+            if self._due[name] is None:
+                self._woken.add(name)
+            elif self._due[name] > time.monotonic():
+                self._schedule(name, time.monotonic())
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(daemon=True, target=self._run, name='rpi-poller')
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    while self._heap and self._due[self._heap[0][1]] != self._heap[0][0]:
+                        heapq.heappop(self._heap)
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+                _, name = heapq.heappop(self._heap)
+                self._due[name] = None
+            try:
+                self._executor.submit(self._poll, name)
+            except Exception as e:
+                # E.g. the executor was shut down with the interpreter, keep the unit polled from this thread
+                logging.getLogger(__name__).error(f'Scheduling the poll of {name} failed, polling inline: {e}')
+                self._poll(name)
+
+    def _poll(self, name: str):
+        delay = 1.
+        try:
+            delay = self._units[name].poll()
+        except Exception as e:
+            logging.getLogger(__name__).error(f'Polling {name} failed: {e}')
+        finally:
+            if self.on_polled is not None:
+                try:
+                    self.on_polled(name)
+                except Exception as e:
+                    logging.getLogger(__name__).error(f'Poll callback of {name} failed: {e}')
+            with self._condition:
+                woken = name in self._woken
+                self._woken.discard(name)
+                self._schedule(name, time.monotonic() + (0 if woken else delay))
+
+
+class UnitRegistry:
+    """
+    Named RPi HVAC units served by one server, the first unit is the default one
+    """
+
+    def __init__(self, units: Dict[str, HvacRpi], poll_workers: int = 8):
+        """
+        :param units: unit name to unit interface, in order
+        :param poll_workers: maximum number of units polled or fetched at the same time
+        """
+        if not units:
+            raise Exception('At least one unit has to be configured')
+        self.units = dict(units)
+        self.default = next(iter(self.units.values()))
+        self.poller = UnitPoller(poll_workers)
+        self._executor = ThreadPoolExecutor(max_workers=poll_workers, thread_name_prefix='rpi-fanout')
+        STATE_AGE.collect = lambda: (((name,), unit.get_state_age()) for name, unit in self.units.items())
+        STATE_STALE.collect = lambda: (((name,), unit.is_stale()) for name, unit in self.units.items())
+        TEMPERATURE.collect = self._collect_temperatures
+        HYSTERESIS.collect = lambda: (((name,), state.hysteresis) for name, state in self._states())
+        VALVE_OPENED.collect = lambda: self._collect_valves('valves_states')
+        VALVE_ACTIVATED.collect = lambda: self._collect_valves('valves_activated_states')
+        MODE.collect = self._collect_modes
+
+    def _states(self) -> Iterator[Tuple[str, RpiState]]:
+        for name, unit in self.units.items():
+            yield name, unit.get_full_state()
+
+    def _collect_temperatures(self) -> Iterator[Tuple[tuple, float]]:
+        for name, state in self._states():
+            for i, temperature in enumerate(state.he_temperatures):
+                yield (name, f'he{i + 1}'), temperature
+            yield (name, 'feed'), state.feed_temperature
+            yield (name, 'inside'), state.inside_temperature
+            yield (name, 'outside'), state.outside_temperature
+
+    def _collect_valves(self, field: str) -> Iterator[Tuple[tuple, bool]]:
+        for name, state in self._states():
+            for i, value in enumerate(getattr(state, field)):
+                yield (name, str(i + 1)), value
+
+    def _collect_modes(self) -> Iterator[Tuple[tuple, bool]]:
+        for name, state in self._states():
+            for mode in Mode:
+                yield (name, mode.value), mode == state.mode
+
+    def get(self, name: str) -> HvacRpi:
+        return self.units.get(name)
+
+    def __iter__(self):
+        return iter(self.units)
+
+    def __len__(self):
+        return len(self.units)
+
+    def full_states(self) -> Dict[str, Union[RpiState, Exception]]:
+        """
+        Gets the full state of every unit in parallel
+        :return: unit name to full state or to the exception getting it raised
+        """
+        futures = {name: self._executor.submit(unit.get_full_state) for name, unit in self.units.items()}
+        states = {}
+        for name, future in futures.items():
+            try:
+                states[name] = future.result()
+            except Exception as e:
+                states[name] = e
+        return states
+
+    def start(self):
+        """
+        Starts polling every unit
+        """
+        for name, unit in self.units.items():
+            self.poller.add(name, unit)
+        self.poller.start()
@@ -0,0 +1,70 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+from threading import Thread
+
+import requests
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'flask_server'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'bench'))
+
+USER = ('test', 'test')
+os.environ.setdefault('USERNAME', USER[0])
+os.environ.setdefault('PASSWORD', USER[1])
+os.environ.setdefault('SU_USERNAME', 'test-su')
+os.environ.setdefault('SU_PASSWORD', 'test-su')
+
+from werkzeug.serving import make_server  # noqa: E402
+
+from archive import RECORD, StateArchive  # noqa: E402
+from fake_rpi import FakeRpi  # noqa: E402
+from rpi_interface import HvacRpi, Mode, RpiState, hvac_url  # noqa: E402
+from server import Server  # noqa: E402
+from transport import RpiTransport  # noqa: E402
+
+
+class ArchiveWsgiTest(unittest.TestCase):
+    """
+    Reads /archive through a real WSGI server, which unlike the Flask test client only accepts bytes
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.archive = StateArchive(self.directory.name, segment_span=3600)
+        self.rpi = FakeRpi().start()
+        unit = HvacRpi(transport=RpiTransport(hvac_url(self.rpi.address, 'hvac')), archive=self.archive,
+                       name='test')
+        self.server = make_server('127.0.0.1', 0, Server('127.0.0.1', 0, False, units={'test': unit}).app,
+                                  threaded=True)
+        Thread(daemon=True, target=self.server.serve_forever).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.rpi.stop()
+        self.archive.close()
+        self.directory.cleanup()
+
+    def test_records_span_segments(self):
+        state = RpiState(he_temperatures=(40., 41., 39.), feed_temperature=55., hysteresis=2,
+                         outside_temperature=-3., inside_temperature=21., valves_states=(False, True, False, False),
+                         valves_activated_states=(True, True, True, True), mode=Mode.MANUAL)
+        start = time.time() - 3 * 3600
+        timestamps = [start + i * 60 for i in range(180)]
+        for timestamp in timestamps:
+            self.archive.append(state, timestamp)
+
+        response = requests.get(f'{self.url}/archive', params={'start': start, 'end': time.time()}, auth=USER,
+                                timeout=10)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Record-Format'], RECORD.format)
+        self.assertEqual(len(response.content), len(timestamps) * RECORD.size)
+        self.assertEqual([record[0] for record in RECORD.iter_unpack(response.content)], timestamps)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import asyncio
+import os
+import sys
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'flask_server'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'bench'))
+
+from async_rpi_interface import AsyncHvacRpi, AsyncRpiTransport  # noqa: E402
+from fake_rpi import FakeRpi  # noqa: E402
+from rpi_interface import Mode, hvac_url  # noqa: E402
+from transport import CircuitBreaker  # noqa: E402
+
+
+class AsyncHvacRpiTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Drives AsyncHvacRpi against a fake RPi
+    """
+
+    async def asyncSetUp(self):
+        self.rpi = FakeRpi().start()
+        self.transport = AsyncRpiTransport(hvac_url(self.rpi.address, 'hvac'), read_timeout=2)
+        self.unit = AsyncHvacRpi(transport=self.transport, name='test')
+
+    async def asyncTearDown(self):
+        await self.unit.stop_updater()
+        await self.transport.close()
+        self.rpi.stop()
+
+    async def test_refresh(self):
+        self.assertTrue(self.unit.is_stale())
+
+        await self.unit.refresh()
+
+        self.assertFalse(self.unit.is_stale())
+        self.assertEqual(self.unit.get_feed_temperature(), 55.)
+        self.assertEqual(self.unit.get_he_temperature(2), 41.)
+        self.assertTrue(self.unit.get_valve_opened(2))
+        self.assertEqual(self.unit.get_mode(), Mode.MANUAL)
+
+    async def test_writes_apply_optimistically(self):
+        await self.unit.refresh()
+        changes = []
+        self.unit.add_listener(lambda old_state, new_state: changes.append(new_state))
+
+        self.assertTrue(await self.unit.set_feed_temperature(60))
+        self.assertTrue(await self.unit.open_valve(1))
+        self.assertTrue(await self.unit.set_mode(Mode.AUTO_WINTER))
+
+        self.assertEqual(self.unit.get_feed_temperature(), 60)
+        self.assertTrue(self.unit.get_valve_opened(1))
+        self.assertEqual(self.unit.get_mode(), Mode.AUTO_WINTER)
+        self.assertEqual(len(changes), 3)
+        self.assertEqual(self.rpi.properties['temperatureFeed'], 60.)
+        self.assertTrue(self.rpi.properties['valveOpened1'])
+        self.assertEqual(self.rpi.properties['mode'], 'autoWinter')
+
+        await self.unit.refresh()
+
+        self.assertEqual(self.unit.get_feed_temperature(), 60.)
+        self.assertFalse(self.unit._pending_writes)
+
+    async def test_updater_refreshes_until_stopped(self):
+        self.unit.start_updater()
+        for _ in range(100):
+            if not self.unit.is_stale():
+                break
+            await asyncio.sleep(.02)
+        self.assertFalse(self.unit.is_stale())
+        task = self.unit._updater_thread
+
+        await self.unit.stop_updater()
+
+        self.assertTrue(task.cancelled())
+
+    async def test_cancelled_refresh_ends_half_open_trial(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=.05)
+        transport = AsyncRpiTransport(hvac_url(self.rpi.address, 'hvac'), breaker=breaker)
+        unit = AsyncHvacRpi(transport=transport, all_properties_timeout=5)
+        try:
+            breaker.failure()
+            await asyncio.sleep(.1)
+            self.rpi.latency = 1
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(unit.refresh(), .2)
+            self.assertTrue(unit.is_stale())
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+            self.rpi.latency = 0
+            await asyncio.sleep(.15)
+            await unit.refresh()
+
+            self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+            self.assertFalse(unit.is_stale())
+        finally:
+            await transport.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
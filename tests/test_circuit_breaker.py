@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'flask_server'))
+
+from transport import CircuitBreaker, CircuitOpenError  # noqa: E402
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    """
+    State transitions of the RPi circuit breaker
+    """
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=.1, max_reset_timeout=.3)
+
+    def open(self):
+        for _ in range(3):
+            self.breaker.before()
+            self.breaker.failure()
+
+    def test_opens_after_consecutive_failures(self):
+        for _ in range(2):
+            self.breaker.before()
+            self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.success()
+        for _ in range(2):
+            self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+        self.breaker.failure()
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError) as error:
+            self.breaker.before()
+        self.assertGreater(error.exception.retry_after, 0)
+        self.assertGreater(self.breaker.retry_after(), 0)
+
+    def test_half_open_trial_closes(self):
+        self.open()
+        time.sleep(.15)
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+
+        self.breaker.before()
+        # Only one trial request at a time
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before()
+        self.breaker.success()
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.retry_after(), 0)
+        self.breaker.before()
+
+    def test_failed_trial_reopens_for_longer(self):
+        self.open()
+        time.sleep(.15)
+        self.breaker.before()
+        self.breaker.failure()
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        time.sleep(.15)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        time.sleep(.1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+
+        self.breaker.before()
+        self.breaker.failure()
+        # The open time doubles up to the maximum
+        self.assertLessEqual(self.breaker.retry_after(), .3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import sys
+import time
+import unittest
+from threading import Event, Lock
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'flask_server'))
+
+from rpi_interface import CommandQueue  # noqa: E402
+
+
+class CommandQueueTest(unittest.TestCase):
+    """
+    Coalescing and ordering of the RPi write commands
+    """
+
+    def setUp(self):
+        self.calls = []
+        self._lock = Lock()
+
+    def record(self, key, value):
+        with self._lock:
+            self.calls.append((key, value))
+        return value
+
+    def test_same_key_is_coalesced(self):
+        queue = CommandQueue(window=.1)
+        first = queue.submit('feed', self.record, 'feed', 50)
+        second = queue.submit('feed', self.record, 'feed', 55)
+
+        self.assertEqual(first.result(5), 55)
+        self.assertEqual(second.result(5), 55)
+        self.assertEqual(self.calls, [('feed', 55)])
+
+    def test_different_keys_are_not_coalesced(self):
+        queue = CommandQueue(window=.05)
+        futures = [queue.submit(key, self.record, key, True) for key in ('valve1', 'valve2')]
+
+        self.assertEqual([future.result(5) for future in futures], [True, True])
+        self.assertEqual(sorted(self.calls), [('valve1', True), ('valve2', True)])
+
+    def test_submission_order(self):
+        queue = CommandQueue(window=.05, max_in_flight=1)
+        futures = [queue.submit(key, self.record, key, index) for index, key in enumerate(('a', 'b', 'c'))]
+        for future in futures:
+            future.result(5)
+
+        self.assertEqual([key for key, _ in self.calls], ['a', 'b', 'c'])
+
+    def test_replaced_command_moves_to_the_end(self):
+        queue = CommandQueue(window=.1, max_in_flight=1)
+        futures = [queue.submit('a', self.record, 'a', 1), queue.submit('b', self.record, 'b', 2),
+                   queue.submit('a', self.record, 'a', 3)]
+        for future in futures:
+            future.result(5)
+
+        self.assertEqual(self.calls, [('b', 2), ('a', 3)])
+
+    def test_key_in_flight_waits(self):
+        queue = CommandQueue(window=0, max_in_flight=2)
+        started, release = Event(), Event()
+
+        def slow(value):
+            started.set()
+            release.wait(5)
+            return self.record('mode', value)
+
+        first = queue.submit('mode', slow, 'manual')
+        self.assertTrue(started.wait(5))
+        second = queue.submit('mode', self.record, 'mode', 'autoWinter')
+        time.sleep(.1)
+        self.assertEqual(self.calls, [])
+        release.set()
+
+        self.assertEqual(first.result(5), 'manual')
+        self.assertEqual(second.result(5), 'autoWinter')
+        self.assertEqual(self.calls, [('mode', 'manual'), ('mode', 'autoWinter')])
+
+    def test_failure_reaches_every_caller(self):
+        queue = CommandQueue(window=.05)
+
+        def fail():
+            raise ConnectionError('RPi is down')
+
+        futures = [queue.submit('hysteresis', fail), queue.submit('hysteresis', fail)]
+
+        for future in futures:
+            with self.assertRaises(ConnectionError):
+                future.result(5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import sys
+import unittest
+from datetime import datetime, timezone
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'flask_server'))
+
+from programs import ProgramError, ZoneInfo, next_fire  # noqa: E402
+
+UTC = ZoneInfo('UTC')
+BERLIN = ZoneInfo('Europe/Berlin')
+
+
+def timestamp(*args, zone=UTC) -> float:
+    return datetime(*args, tzinfo=zone).timestamp()
+
+
+def utc(when: float) -> datetime:
+    return datetime.fromtimestamp(when, timezone.utc).replace(tzinfo=None)
+
+
+class NextFireTest(unittest.TestCase):
+    """
+    Weekly program fire times
+    """
+
+    def test_later_today(self):
+        # Friday 2026-10-16
+        after = timestamp(2026, 10, 16, 5, 0)
+
+        self.assertEqual(utc(next_fire([4], 6, 0, after, UTC)), datetime(2026, 10, 16, 6, 0))
+
+    def test_passed_today_moves_to_next_weekday(self):
+        after = timestamp(2026, 10, 16, 7, 0)
+
+        self.assertEqual(utc(next_fire([0, 1, 2, 3, 4], 6, 0, after, UTC)), datetime(2026, 10, 19, 6, 0))
+
+    def test_same_weekday_next_week(self):
+        after = timestamp(2026, 10, 16, 6, 0)
+
+        # A fire time equal to "after" already fired
+        self.assertEqual(utc(next_fire([4], 6, 0, after, UTC)), datetime(2026, 10, 23, 6, 0))
+
+    def test_week_wraps_to_monday(self):
+        # Sunday 2026-10-18
+        after = timestamp(2026, 10, 18, 23, 59)
+
+        self.assertEqual(utc(next_fire([0], 0, 0, after, UTC)), datetime(2026, 10, 19, 0, 0))
+
+    def test_time_zone(self):
+        after = timestamp(2026, 10, 16, 0, 0)
+
+        self.assertEqual(utc(next_fire([4], 6, 0, after, BERLIN)), datetime(2026, 10, 16, 4, 0))
+
+    def test_across_dst_end(self):
+        # Berlin goes from CEST (UTC+2) to CET (UTC+1) on Sunday 2026-10-25
+        after = timestamp(2026, 10, 24, 7, 0, zone=BERLIN)
+
+        saturday = next_fire([5, 6], 6, 0, after - 2 * 3600, BERLIN)
+        sunday = next_fire([5, 6], 6, 0, after, BERLIN)
+
+        self.assertEqual(utc(saturday), datetime(2026, 10, 24, 4, 0))
+        self.assertEqual(utc(sunday), datetime(2026, 10, 25, 5, 0))
+        self.assertEqual(sunday - saturday, 25 * 3600)
+
+    def test_across_dst_start(self):
+        # Berlin goes from CET (UTC+1) to CEST (UTC+2) on Sunday 2026-03-29
+        after = timestamp(2026, 3, 28, 7, 0, zone=BERLIN)
+
+        self.assertEqual(utc(next_fire([6], 6, 0, after, BERLIN)), datetime(2026, 3, 29, 4, 0))
+
+    def test_no_weekday(self):
+        with self.assertRaises(ProgramError):
+            next_fire([], 6, 0, timestamp(2026, 10, 16, 0, 0), UTC)
+
+
+if __name__ == '__main__':
+    unittest.main()
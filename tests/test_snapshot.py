@@ -0,0 +1,110 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+from threading import Timer
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'flask_server'))
+
+from rpi_interface import Mode, RpiState, UnitState  # noqa: E402
+from snapshot import FIELDS, HEADER, HEARTBEAT, SEQUENCE, SnapshotReader, SnapshotWriter, _slot_offsets  # noqa: E402
+
+
+def make_state(feed_temperature: float) -> RpiState:
+    return RpiState(he_temperatures=(40., 41., 39.), feed_temperature=feed_temperature, hysteresis=2,
+                    outside_temperature=-3., inside_temperature=21., valves_states=(False, True, False, False),
+                    valves_activated_states=(True, True, True, True), mode=Mode.MANUAL)
+
+
+class SnapshotTest(unittest.TestCase):
+    """
+    Seqlock guarded unit slots shared between the poller and the workers
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'snapshot')
+        self.unit = UnitState(name='hall')
+        self.unit._merge_refresh(('feed_temperature',), state=make_state(55.))
+        self.writer = SnapshotWriter(self.path, {'hall': self.unit})
+        self.writer.publish('hall')
+        self.reader = SnapshotReader(self.path, open_timeout=1, stale_after=5)
+        _, self.sequence_offset, _ = _slot_offsets(0)
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+        self.directory.cleanup()
+
+    def set_sequence(self, sequence: int):
+        SEQUENCE.pack_into(self.writer._map, self.sequence_offset, sequence)
+
+    def test_reads_published_state(self):
+        state, last_modified, refreshed_at, stale = self.reader.read('hall')
+
+        self.assertEqual(state, make_state(55.))
+        self.assertEqual(last_modified, self.unit.get_last_modified())
+        self.assertAlmostEqual(refreshed_at, time.time(), delta=5)
+        self.assertFalse(stale)
+
+    def test_republished_state_is_read_again(self):
+        self.reader.read('hall')
+        self.unit._merge_refresh(('feed_temperature',), state=make_state(60.))
+        self.writer.publish('hall')
+
+        self.assertEqual(self.reader.read('hall')[0].feed_temperature, 60.)
+
+    def test_retries_while_slot_is_written(self):
+        sequence = SEQUENCE.unpack_from(self.writer._map, self.sequence_offset)[0]
+        # A writer in the middle of the slot, it completes the write a bit later
+        self.set_sequence(sequence + 1)
+
+        def complete():
+            _, _, fields_offset = _slot_offsets(0)
+            payload = make_state(60.).as_json()
+            FIELDS.pack_into(self.writer._map, fields_offset, time.time(), time.time(), False, len(payload))
+            payload_offset = fields_offset + FIELDS.size
+            self.writer._map[payload_offset:payload_offset + len(payload)] = payload
+            self.set_sequence(sequence + 2)
+
+        Timer(.05, complete).start()
+
+        state = self.reader.read('hall', retries=10 ** 7)
+
+        self.assertEqual(state[0].feed_temperature, 60.)
+
+    def test_torn_read_is_not_served(self):
+        sequence = SEQUENCE.unpack_from(self.writer._map, self.sequence_offset)[0]
+        self.set_sequence(sequence + 1)
+
+        with self.assertRaises(Exception):
+            self.reader.read('hall', retries=10)
+
+        self.set_sequence(sequence + 2)
+        self.assertEqual(self.reader.read('hall')[0].feed_temperature, 55.)
+
+    def test_late_heartbeat_is_stale(self):
+        self.assertFalse(self.reader.read('hall')[3])
+
+        HEARTBEAT.pack_into(self.writer._map, HEADER.size, time.time() - 10)
+
+        self.assertFalse(self.reader.writer_alive())
+        self.assertTrue(self.reader.read('hall')[3])
+
+    def test_replaced_file_is_mapped_again(self):
+        other = UnitState(name='hall')
+        other._merge_refresh(('feed_temperature',), state=make_state(70.))
+        self.reader.check_interval = 0
+        replacement = SnapshotWriter(self.path, {'hall': other})
+        try:
+            replacement.publish('hall')
+
+            self.assertEqual(self.reader.read('hall')[0].feed_temperature, 70.)
+        finally:
+            replacement._map.close()
+
+
+if __name__ == '__main__':
+    unittest.main()